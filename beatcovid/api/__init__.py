@@ -0,0 +1 @@
+default_app_config = "beatcovid.api.apps.ApiConfig"
@@ -1,3 +1,19 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import QueuedSubmission
+
+
+@admin.register(QueuedSubmission)
+class QueuedSubmissionAdmin(admin.ModelAdmin):
+    list_display = [
+        "instance_id",
+        "form_id",
+        "status",
+        "attempts",
+        "next_attempt_at",
+        "created_at",
+        "sent_at",
+    ]
+    list_filter = ["status", "form_id"]
+    search_fields = ["instance_id"]
+    readonly_fields = ["instance_id", "form_id", "parcel", "response", "created_at"]
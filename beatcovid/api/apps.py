@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = "beatcovid.api"
+
+    def ready(self):
+        from .externs import register_default_externs
+
+        register_default_externs()
@@ -0,0 +1,495 @@
+import contextlib
+import copy
+import io
+import json
+import logging
+import os
+import time
+import timeit
+import tracemalloc
+from unittest import mock
+
+from django.test import RequestFactory, override_settings
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from beatcovid.core import cache
+from beatcovid.core.parsers import FastJSONParser
+from beatcovid.core.renderers import FastJSONRenderer
+from beatcovid.respondent.models import Respondent
+
+from . import controllers
+from .transformers import (
+    _parse_question,
+    _render_label_memo,
+    build_choice_lists,
+    clear_compiled_schemas,
+    get_label_table,
+    get_supported_locales,
+    parse_form_label,
+    parse_kobo_json,
+    translate_form_label,
+)
+
+logger = logging.getLogger(__name__)
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+
+SYMTRACKER_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "symtracker", "fixtures"
+)
+
+BASELINE_PATH = os.path.join(BASE_PATH, "schema_benchmark_baseline.json")
+
+KOBO_FORM_SERVER = "http://kpi.benchmark/"
+KOBOCAT_API = "http://kc.benchmark/"
+
+
+def load_asset_fixture(fixture_name="kobo_asset"):
+    with open(os.path.join(BASE_PATH, f"{fixture_name}.json")) as fh:
+        return json.load(fh)
+
+
+def scale_asset(asset, rows=500, choices_per_list=0):
+    """
+        Grows the fixture asset by repeating its groups (with renamed
+        questions) until the survey has at least rows rows, and pads every
+        choice list with choices_per_list extra choices
+    """
+    asset = copy.deepcopy(asset)
+    content = asset["content"]
+    survey = content["survey"]
+    groups = []
+    group = []
+
+    for si in survey:
+        if group or si["type"] == "begin_group":
+            group.append(si)
+        if si["type"] == "end_group":
+            groups.append(group)
+            group = []
+
+    n = 0
+    while len(survey) < rows:
+        n += 1
+        for g in groups:
+            for si in g:
+                _si = dict(si)
+                _si["$kuid"] = "{}_{}".format(si["$kuid"], n)
+                if "name" in si:
+                    _si["name"] = "{}_{}".format(si["name"], n)
+                survey.append(_si)
+
+    list_names = {c["list_name"] for c in content["choices"]}
+
+    for list_name in sorted(list_names):
+        for i in range(choices_per_list):
+            content["choices"].append(
+                {"list_name": list_name, "name": f"extra_{i}", "label": [f"Extra {i}"]}
+            )
+
+    return asset
+
+
+def resolve_choices_linear(asset, user_language="en"):
+    """ the choice lookup as it was done before the choice index """
+    choices = asset["content"]["choices"]
+    resolved = []
+
+    for si in asset["content"]["survey"]:
+        if "select_from_list_name" not in si:
+            continue
+
+        c = list(filter(lambda d: d["list_name"] == si["select_from_list_name"], choices))
+        resolved.append(
+            [
+                {
+                    "id": si["name"],
+                    "value": i["name"],
+                    "key": "{}.{}".format(i["list_name"], i["name"]),
+                    "label": translate_form_label(
+                        "{}.{}".format(i["list_name"], i["name"]), user_language
+                    ),
+                }
+                for i in c
+                if "name" in si and "name" in i
+            ]
+        )
+
+    return resolved
+
+
+def resolve_choices_indexed(asset, user_language="en"):
+    choice_lists = build_choice_lists(asset["content"]["choices"], user_language)
+    resolved = []
+
+    for si in asset["content"]["survey"]:
+        if "select_from_list_name" not in si:
+            continue
+
+        c = choice_lists.get(si["select_from_list_name"], [])
+        resolved.append([dict(id=si["name"], **i) for i in c if "name" in si])
+
+    return resolved
+
+
+def benchmark_choice_index(rows=500, choices_per_list=20, repeat=5, number=10):
+    asset = scale_asset(load_asset_fixture(), rows, choices_per_list)
+
+    if resolve_choices_linear(asset) != resolve_choices_indexed(asset):
+        raise Exception("Indexed choice lookup does not match the linear lookup")
+
+    linear = min(
+        timeit.repeat(lambda: resolve_choices_linear(asset), repeat=repeat, number=number)
+    )
+    indexed = min(
+        timeit.repeat(
+            lambda: resolve_choices_indexed(asset), repeat=repeat, number=number
+        )
+    )
+
+    return {
+        "rows": len(asset["content"]["survey"]),
+        "choices": len(asset["content"]["choices"]),
+        "linear_ms": linear / number * 1000,
+        "indexed_ms": indexed / number * 1000,
+        "speedup": linear / indexed,
+    }
+
+
+class StubResponse:
+    def __init__(self, body):
+        self.body = body
+        self.status_code = 200
+
+    def json(self):
+        return self.body
+
+
+class StubKobo:
+    """ stands in for the kobo client, serving the asset fixture """
+
+    def __init__(self, asset, submissions=None):
+        self.asset = asset
+        self.submissions = submissions or []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        path = url.split("?", 1)[0]
+
+        if path == f"{KOBO_FORM_SERVER}assets/":
+            listing = {k: v for k, v in self.asset.items() if k != "content"}
+            return StubResponse({"count": 1, "results": [listing]})
+
+        if path == f"{KOBO_FORM_SERVER}assets/{self.asset['uid']}":
+            return StubResponse(self.asset)
+
+        if path == f"{KOBOCAT_API}api/v1/forms":
+            return StubResponse([{"formid": 1, "id_string": self.asset["uid"]}])
+
+        if path == f"{KOBOCAT_API}api/v1/data/1":
+            return StubResponse(self.submissions)
+
+        raise Exception(f"StubKobo has no response for {url}")
+
+
+@contextlib.contextmanager
+def stub_kobo(asset, submissions=None):
+    """
+        Runs the controllers offline - the form server and kobocat are
+        served from the fixture and the cache is an in memory dict
+    """
+    store = {}
+
+    def get_many(items):
+        return [store.get((name, key), False) for name, key in items]
+
+    def set_many(items, ttl=None):
+        for name, key, value in items:
+            store[(name, key)] = value
+        return len(items)
+
+    def get_or_set_cache(name, key, compute, ttl=None, stale_ttl=None, refresh=None):
+        if store.get((name, key), None) is None:
+            store[(name, key)] = compute()
+        return store[(name, key)]
+
+    with override_settings(
+        KOBO_FORM_SERVER=KOBO_FORM_SERVER,
+        KOBO_FORM_TOKEN="benchmark",
+        KOBOCAT_API=KOBOCAT_API,
+        KOBOCAT_CREDENTIALS="benchmark",
+    ), mock.patch.object(
+        controllers, "kobo", StubKobo(asset, submissions)
+    ), mock.patch.object(
+        controllers, "get_many", get_many
+    ), mock.patch.object(
+        controllers, "set_many", set_many
+    ), mock.patch.object(
+        cache, "get_or_set_cache", get_or_set_cache
+    ):
+        yield
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(round(p / 100 * (len(timings) - 1))))]
+
+
+def measure(fn, iterations):
+    """
+        Calls fn iterations times and reports latency percentiles in ms,
+        then once more under tracemalloc for the allocations
+    """
+    timings = []
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    output = fn()
+    allocated, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "p50": percentile(timings, 50),
+        "p90": percentile(timings, 90),
+        "p99": percentile(timings, 99),
+        "mean": sum(timings) / len(timings),
+        "allocated_kb": allocated / 1024,
+        "peak_kb": peak / 1024,
+    }
+
+    if output is not None:
+        result["size"] = len(json.dumps(output, default=str))
+
+    return result
+
+
+def get_benchmark_request(locale):
+    request = RequestFactory().get("/")
+    request.LANGUAGE_CODE = locale
+    return request
+
+
+def get_benchmark_cases(asset, locales):
+    """ returns {case name: callable} for every stage of the pipeline """
+    user = Respondent()
+    survey = asset["content"]["survey"]
+    choices = asset["content"]["choices"]
+    cases = {}
+
+    label_texts = [si["label"] for si in survey if "label" in si]
+
+    def render_labels():
+        _render_label_memo.cache_clear()
+        return [parse_form_label(l) for l in label_texts]
+
+    cases["parse_form_label[all labels]"] = render_labels
+
+    for locale in locales:
+        request = get_benchmark_request(locale)
+        keys = list(get_label_table()[locale.replace("-", "_")].keys())
+        choice_lists = build_choice_lists(choices, locale)
+        questions = [
+            si for si in survey if si["type"] not in ["begin_group", "end_group"]
+        ]
+
+        def cold(request=request):
+            clear_compiled_schemas()
+            return parse_kobo_json(asset, request, user)
+
+        def warm(request=request):
+            return parse_kobo_json(asset, request, user)
+
+        def translate_labels(locale=locale, keys=keys):
+            return [translate_form_label(k, locale) for k in keys]
+
+        def parse_questions(
+            locale=locale, choice_lists=choice_lists, questions=questions
+        ):
+            return [_parse_question(si, choice_lists, locale) for si in questions]
+
+        def form_schema(request=request):
+            return controllers.get_form_schema(asset["name"], request, user)
+
+        cases[f"parse_kobo_json[cold,{locale}]"] = cold
+        cases[f"parse_kobo_json[warm,{locale}]"] = warm
+        cases[f"translate_form_label[all keys,{locale}]"] = translate_labels
+        cases[f"_parse_question[all rows,{locale}]"] = parse_questions
+        cases[f"get_form_schema[stubbed kobo,{locale}]"] = form_schema
+
+    return cases
+
+
+def run_benchmarks(iterations=50, locales=None, asset=None):
+    """
+        Benchmarks every case offline against the asset fixture, for all
+        supported locales by default
+
+        @returns {case name: measurements}
+    """
+    if asset is None:
+        asset = load_asset_fixture()
+
+    if locales is None:
+        locales = get_supported_locales()
+
+    results = {}
+
+    with stub_kobo(asset):
+        for name, fn in get_benchmark_cases(asset, locales).items():
+            logger.debug(f"Benchmarking {name}")
+            results[name] = measure(fn, iterations)
+
+    return results
+
+
+def load_submissions_fixture():
+    """ the submissions the symtracker tests use """
+    with open(os.path.join(SYMTRACKER_PATH, "symptom_tests.json")) as fh:
+        return json.load(fh)
+
+
+def get_report_payload(schema):
+    """ the SymptomTracker report for the fixture submissions """
+    from beatcovid.symtracker.controllers import get_user_report_from_survey
+
+    surveys = load_submissions_fixture()
+
+    for n, survey in enumerate(surveys):
+        survey.setdefault("_id", n)
+        survey.setdefault("_uuid", f"benchmark-{n}")
+
+    return get_user_report_from_survey(surveys, schema)
+
+
+def benchmark_json(iterations=50, locale="en", asset=None):
+    """
+        Compares DRF's stdlib JSON renderer and parser with the orjson ones
+        on the schema and report responses and a form submission body
+
+        @returns {payload: {"size", "stdlib", "fast", "speedup"}}
+    """
+    if asset is None:
+        asset = load_asset_fixture()
+
+    user = Respondent()
+
+    with stub_kobo(asset):
+        schema = parse_kobo_json(asset, get_benchmark_request(locale), user)
+        report = get_report_payload(schema)
+
+    body = JSONRenderer().render(load_submissions_fixture()[0])
+    cases = {}
+
+    for name, payload in [("schema", schema), ("report", report)]:
+        if JSONRenderer().render(payload) != FastJSONRenderer().render(payload):
+            raise Exception(f"FastJSONRenderer output differs for the {name} payload")
+
+        cases[f"render {name}"] = (
+            len(JSONRenderer().render(payload)),
+            lambda payload=payload: JSONRenderer().render(payload),
+            lambda payload=payload: FastJSONRenderer().render(payload),
+        )
+
+    cases["parse submission"] = (
+        len(body),
+        lambda: JSONParser().parse(io.BytesIO(body)),
+        lambda: FastJSONParser().parse(io.BytesIO(body)),
+    )
+
+    results = {}
+
+    for name, (size, stdlib_fn, fast_fn) in cases.items():
+        stdlib_ms = (
+            min(timeit.repeat(stdlib_fn, repeat=5, number=iterations)) / iterations
+        )
+        fast_ms = min(timeit.repeat(fast_fn, repeat=5, number=iterations)) / iterations
+
+        results[name] = {
+            "size": size,
+            "stdlib": stdlib_ms * 1000,
+            "fast": fast_ms * 1000,
+            "speedup": stdlib_ms / fast_ms,
+        }
+
+    return results
+
+
+def benchmark_codecs(iterations=50, asset=None):
+    """
+        Compares the cache codecs and compressors on the KPI asset
+
+        @returns {"codec+compression": {"size", "encode", "decode"}}
+    """
+    if asset is None:
+        asset = load_asset_fixture()
+
+    results = {}
+
+    for codec in cache.CODECS:
+        for compression in [""] + list(cache.COMPRESSORS):
+            with override_settings(
+                CACHE_CODEC=codec,
+                CACHE_COMPRESSION=compression,
+                CACHE_COMPRESS_MIN_BYTES=0,
+            ):
+                serialised, _ = cache.serialise_entry("get_form_schema", asset, 1)
+
+                encode = min(
+                    timeit.repeat(
+                        lambda: cache.serialise_entry("get_form_schema", asset, 1),
+                        repeat=5,
+                        number=iterations,
+                    )
+                )
+                decode = min(
+                    timeit.repeat(
+                        lambda: cache.deserialise_entry("get_form_schema", serialised),
+                        repeat=5,
+                        number=iterations,
+                    )
+                )
+
+            results["+".join(filter(None, [codec, compression]))] = {
+                "size": len(serialised),
+                "encode": encode / iterations * 1000,
+                "decode": decode / iterations * 1000,
+            }
+
+    return results
+
+
+def load_baseline(baseline_path=BASELINE_PATH):
+    if not os.path.isfile(baseline_path):
+        return None
+
+    with open(baseline_path) as fh:
+        return json.load(fh)
+
+
+def save_baseline(results, baseline_path=BASELINE_PATH):
+    with open(baseline_path, "w+") as fh:
+        json.dump(results, fh, indent=4, sort_keys=True)
+
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """
+        Compares median latency and peak allocations against a baseline
+
+        @param tolerance - allowed fractional increase before a case regresses
+        @returns list of (case, metric, baseline value, value)
+    """
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for metric in ["p50", "peak_kb"]:
+            if result[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append((name, metric, baseline[name][metric], result[metric]))
+
+    return regressions
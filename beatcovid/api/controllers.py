@@ -2,22 +2,63 @@ import collections
 import json
 import logging
 import os
+import random
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+from urllib.parse import quote_plus
 
 import redis
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
 from django.utils.translation import get_language_from_request
 
-from beatcovid.core import http
-from beatcovid.core.cache import get_cache, set_cache
+from beatcovid.core import akobo, kobo
+from beatcovid.core.cache import cached, get_args_key, get_many, set_many
+from beatcovid.core.http_connection import CircuitOpenError
+from beatcovid.core.metrics import format_metric
 from beatcovid.core.mongo import get_mongo_db
 
-from .transformers import parse_kobo_json
+from .models import QueuedSubmission
+from .transformers import (
+    get_schema_etag,
+    get_schema_version,
+    get_static_schema,
+    get_user_schema,
+    parse_kobo_json,
+)
 from .utils import get_user_agent
 
 logger = logging.getLogger(__name__)
 
+# get_form_index takes no arguments
+FORM_INDEX_KEY = get_args_key(())
+
+# the kobocat _ fields kept in submissions
+SUBMISSION_FIELDS_KEPT = ["_id", "_submission_time", "_uuid"]
+
+# kobocat's _ fields, left out by mongo so they aren't sent over to be dropped
+SUBMISSION_MONGO_PROJECTION = {
+    field: False
+    for field in [
+        "_attachments",
+        "_bamboo_dataset_id",
+        "_deleted_at",
+        "_edited",
+        "_geolocation",
+        "_notes",
+        "_status",
+        "_submitted_by",
+        "_tags",
+        "_userform_id",
+        "_validation_status",
+        "_xform_id_string",
+        "__version__",
+    ]
+}
+
 
 def get_formserver_uri():
     if settings.KOBO_FORM_SERVER:
@@ -55,140 +96,213 @@ def get_respondent_count_base():
     return 0
 
 
-def get_server_form_by_name(form_name):
+def get_server_forms():
     """
-        Get list of forms from server
+        Get the list of forms (kpi assets) from the form server, following
+        the listing's pages
 
-        @param form_name - name of the form to find
-        @returns
+        @returns list of assets or None
     """
-    cache_key = "get_server_form_by_name"
-    form_id = get_cache(cache_key, form_name)
-
-    if form_id:
-        logger.debug("CACHE HIT for {}".format(form_name))
-        return form_id
-
-    logger.debug("CACHE MISS for {}".format(form_name))
-
-    logger.debug(f"Retrieving {form_name} from form server")
-
     _formserver = get_formserver_uri()
     _token = get_formserver_token()
 
     assets_url = f"{_formserver}assets/"
     _headers = {"Accept": "application/json", "Authorization": f"Token {_token}"}
 
-    # @TODO breakout requests objects to module and cache
-    f = http.get(assets_url, headers=_headers)
-    r = f.json()
+    forms = []
+    page_url = assets_url
 
-    if not "count" in r:
-        logger.debug(f"No result from form server. Check auth token: {assets_url}")
-        logger.debug(r)
-        return None
+    while page_url:
+        f = kobo.get(page_url, headers=_headers)
+        r = f.json()
 
-    if r["count"] < 1:
+        if not "count" in r:
+            logger.debug(f"No result from form server. Check auth token: {page_url}")
+            logger.debug(r)
+            return None
+
+        forms += r["results"]
+        page_url = r.get("next", None)
+
+    if len(forms) < 1:
         logger.debug(f"No results from form server. Check auth token: {assets_url}")
         return None
 
-    m = list(filter(lambda d: d["name"] == form_name, r["results"]))
+    return forms
 
-    available_forms = ",".join([i["name"] for i in r["results"]])
 
-    if len(m) < 1:
-        logger.debug(
-            f"No result matching {form_name} from server. Available forms: {available_forms}"
-        )
+def get_kobocat_form_pks():
+    """
+        Get the pk of every form deployed to kobocat
+
+        @returns {kpi asset uid: kobocat form pk} or None
+    """
+    _formserver = get_kobocat_uri()
+    _token = get_kobocat_token()
+
+    data_endpoint = f"{_formserver}api/v1/forms"
+    _headers = {
+        "Accept": "application/json",
+        "X-Forwarded-Proto": "https",
+        "Authorization": f"Basic {_token}",
+    }
+
+    try:
+        f = kobo.get(data_endpoint, headers=_headers)
+        server_response = f.json()
+    except Exception as e:
+        logger.error(e)
         return None
 
-    set_cache(cache_key, form_name, m[0])
+    if not type(server_response) is list:
+        logger.debug(server_response)
+        return None
 
-    return m[0]
+    return {form["id_string"]: form["formid"] for form in server_response}
 
 
-def get_form_id_from_name(form_name):
-    form = get_server_form_by_name(form_name)
+def build_form_index(forms=None):
+    """
+        Builds the form index from the form server listing and kobocat.
+        When kobocat can't be reached the pks are None, forms still resolve
+        for the form server and the next refresh fills them in.
+
+        @param forms - the form server listing if it was already fetched
+        @returns {form name: {"uid", "pk", "version", "date_modified"}}
+            or None
+    """
+    if forms is None:
+        forms = get_server_forms()
+
+    if not forms:
+        return None
+
+    form_pks = get_kobocat_form_pks()
+
+    if form_pks is None:
+        logger.info("build_form_index got no form pks from kobocat")
+        form_pks = {}
+
+    index = {}
+
+    for form in forms:
+        if form.get("asset_type", "survey") != "survey" or form["name"] in index:
+            continue
+
+        index[form["name"]] = {
+            "uid": form["uid"],
+            "pk": form_pks.get(form["uid"], None),
+            "version": form.get("deployed_version_id", None)
+            or form.get("version_id", None),
+            "date_modified": form["date_modified"],
+        }
+
+    return index
+
+
+@cached("get_form_index")
+def get_form_index():
+    """
+        The form index, kept warm by refresh_form_schemas
+
+        @returns {form name: {"uid", "pk", "version", "date_modified"}}
+    """
+    logger.debug("Retrieving the form index from the form server")
+
+    return build_form_index()
+
+
+def get_form_from_index(form_name):
+    """
+        Resolves a form name
 
-    if not type(form) is dict:
-        logger.error(f"Bad response when getting form id for name {form_name}")
+        @returns the form's index entry or None
+    """
+    index = get_form_index()
+
+    if not index:
         return None
 
-    if not "uid" in form:
-        logger.error(
-            f"Malformed server return: no field uid in response from form server"
+    if not form_name in index:
+        logger.debug(
+            f"No result matching {form_name} from server. "
+            f"Available forms: {','.join(index)}"
         )
         return None
 
-    return form["uid"]
+    return index[form_name]
 
 
-def get_form_pk_from_name(form_name):
+def get_cached_form(form_name):
     """
-        Get the kobocat form pk from a form name.
-
-        @param formid - kpi form id
+        Reads everything cached for a form in a single round trip
 
+        @param form_name - the name of the form
+        @returns (form index entry, kobocat form pk, kpi asset JSON), each
+            False if not cached or stale
     """
-    cache_key = "get_form_pk_from_name"
-    kobo_form_pk = get_cache(cache_key, form_name)
+    index, kobo_schema = get_many(
+        [("get_form_index", FORM_INDEX_KEY), ("get_form_schema", form_name)]
+    )
+    form = (index or {}).get(form_name, None) or False
 
-    if kobo_form_pk:
-        return kobo_form_pk
+    return form, form and form["pk"], kobo_schema
 
-    # @TODO switch this to using kpi rather than kobocat
 
-    form_id = get_form_id_from_name(form_name)
+def get_form_id_from_name(form_name):
+    form = get_form_from_index(form_name)
 
-    if not form_id:
-        logger.info(f"get_form_id_from_name got no form id for form: {form_name}")
+    if not form:
         return None
 
-    _formserver = get_kobocat_uri()
-    _token = get_kobocat_token()
+    return form["uid"]
 
-    data_endpoint = f"{_formserver}api/v1/forms"
-    _headers = {
-        "Accept": "application/json",
-        "X-Forwarded-Proto": "https",
-        "Authorization": f"Basic {_token}",
-    }
 
-    request_paramaters = {"id_string": form_id}
+def get_form_pk_from_name(form_name):
+    """
+        Get the kobocat form pk from a form name.
 
-    f = None
+        @param form_name - the name of the form
+    """
+    form = get_form_from_index(form_name)
 
-    try:
-        f = http.get(data_endpoint, params=request_paramaters, headers=_headers)
-    except Exception as e:
-        logger.error(e)
+    if not form:
         return None
 
-    # @TODO catch JSON parsing errors (the server can? something throw back HTML)
-    server_response = f.json()
+    return form["pk"]
 
-    if not type(server_response) is list:
-        logger.debug(server_response)
+
+def get_user_last_submission(form_name, user, form_pk=None):
+    if not user or not user.id:
         return None
 
-    kobo_form_pk = server_response[0]["formid"]
-    set_cache(cache_key, form_name, kobo_form_pk)
+    result = get_submission_data(
+        form_name, limit=1, form_pk=form_pk, **get_user_submissions_query(user)
+    )
 
-    return kobo_form_pk
+    return pick_last_submission(result)
 
 
-def get_user_last_submission(form_name, user):
+async def get_user_last_submission_async(form_name, user, form_pk=None):
     if not user or not user.id:
         return None
 
-    query = {"user_id": str(user.id)}
-    limit = 1
-    sort = {
-        "_submission_time": -1,
+    result = await get_submission_data_async(
+        form_name, limit=1, form_pk=form_pk, **get_user_submissions_query(user)
+    )
+
+    return pick_last_submission(result)
+
+
+def get_user_submissions_query(user):
+    """ kobocat query for a user's submissions, newest first """
+    return {
+        "query": {"user_id": str(user.id)},
+        "sort": {"_submission_time": -1},
     }
 
-    result = get_submission_data(form_name, query=query, limit=limit, sort=sort)
 
+def pick_last_submission(result):
     if not type(result) is list:
         return None
 
@@ -199,21 +313,23 @@ def get_user_last_submission(form_name, user):
 
 
 def get_user_submissions(form_name, user):
-    query = {"user_id": str(user.id)}
-    sort = {
-        "_submission_time": -1,
-    }
-
-    results = get_submission_data(form_name, query, sort=sort)
+    results = get_submission_data(form_name, **get_user_submissions_query(user))
 
     if not type(results) is list:
         logger.debug(f"No submissions for user: {user.id}")
         return None
 
-    sorted_results = []
+    return results
 
-    for s in results:
-        sorted_results.append(collections.OrderedDict(sorted(s.items())))
+
+async def get_user_submissions_async(form_name, user):
+    results = await get_submission_data_async(
+        form_name, **get_user_submissions_query(user)
+    )
+
+    if not type(results) is list:
+        logger.debug(f"No submissions for user: {user.id}")
+        return None
 
     return results
 
@@ -228,57 +344,270 @@ def submission_cast_date(value):
     return value
 
 
-def get_form_schema(form_name, request, user):
+def fetch_kobo_form_schema(form_name, formid):
     """
-        Get the form schema from kobo toolbox
+        Fetch a form asset from the form server, bypassing the cache
 
-        @param form_name - the name of the form
-        @returns parsed form schema JSON
+        @param formid - kpi asset uid
+        @returns kpi asset JSON
     """
+    _formserver = get_formserver_uri()
+    _token = get_formserver_token()
+
+    asset_url = f"{_formserver}assets/{formid}"
+    _headers = {"Accept": "application/json", "Authorization": f"Token {_token}"}
+
+    req = None
 
+    try:
+        req = kobo.get(asset_url, headers=_headers)
+    except Exception as e:
+        logger.error(e)
+        return None
+
+    kobo_schema = req.json()
+
+    if not kobo_schema or "url" not in kobo_schema:
+        logger.debug(
+            f"No or bad result from form server for form {form_name}. "
+            f"Check auth token: {asset_url}"
+        )
+        return None
+
+    return kobo_schema
+
+
+@cached("get_form_schema")
+def get_kobo_form_schema(form_name):
+    """
+        Get the raw form asset from kobo toolbox
+
+        @param form_name - the name of the form
+        @returns kpi asset JSON
+    """
     formid = get_form_id_from_name(form_name)
 
     if not formid:
         logger.info(f"get_form_id_from_name got no form id for form: {form_name}")
         return None
 
-    _formserver = get_formserver_uri()
-    _token = get_formserver_token()
+    return fetch_kobo_form_schema(form_name, formid)
 
-    asset_url = f"{_formserver}assets/{formid}"
-    _headers = {"Accept": "application/json", "Authorization": f"Token {_token}"}
 
-    cache_key = "get_form_schema"
-    req = None
-    kobo_schema = get_cache(cache_key, form_name)
+def refresh_form_schemas():
+    """
+        Polls the form server for changed forms and refreshes the cached
+        form index and assets, so requests don't have to wait on the
+        form server when the cache expires. Unchanged entries are written
+        back to extend their expiry.
+
+        @returns names of the forms that changed
+    """
+    forms = get_server_forms()
+
+    if not forms:
+        logger.info("refresh_form_schemas got no forms from the form server")
+        return []
+
+    index = build_form_index(forms)
+
+    if not index:
+        logger.info("refresh_form_schemas could not build the form index")
+        return []
+
+    set_many([("get_form_index", FORM_INDEX_KEY, index)])
+
+    cached_schemas = get_many([("get_form_schema", form_name) for form_name in index])
+    changed = []
+
+    for (form_name, form), kobo_schema in zip(index.items(), cached_schemas):
+        if not kobo_schema or kobo_schema["date_modified"] != form["date_modified"]:
+            logger.info(f"Form {form_name} changed, refreshing schema")
+
+            kobo_schema = fetch_kobo_form_schema(form_name, form["uid"])
+
+            if not kobo_schema:
+                continue
+
+            changed.append(form_name)
+
+        set_many([("get_form_schema", form_name, kobo_schema)])
+
+    return changed
+
+
+def get_form_schema_conditional(form_name, request, user, if_none_match=None):
+    """
+        Get the form schema and its ETag. The schema is only parsed when
+        the ETag is not one of if_none_match
+
+        @param form_name - the name of the form
+        @param if_none_match - list of ETags the client already has
+        @returns (parsed form schema JSON, etag). The schema is None if it
+            matched if_none_match and etag is None on error
+    """
+    _, form_pk, kobo_schema = get_cached_form(form_name)
 
     if not kobo_schema:
-        try:
-            req = http.get(asset_url, headers=_headers)
-        except Exception as e:
-            logger.error(e)
-            return None
+        kobo_schema = get_kobo_form_schema(form_name)
 
-        kobo_schema = req.json()
+    if not kobo_schema:
+        return None, None
 
-        if not kobo_schema or "url" not in kobo_schema:
-            logger.debug(
-                f"No or bad result from form server for form {form_name}. Check auth token: {asset_url}"
-            )
-            return None
+    last_submission = get_user_last_submission(form_name, user, form_pk)
 
-        set_cache(cache_key, form_name, kobo_schema)
+    return build_form_schema_conditional(
+        kobo_schema, request, user, last_submission, if_none_match
+    )
 
-    return_schema = None
 
-    last_submission = get_user_last_submission(form_name, user)
+async def get_form_schema_conditional_async(form_name, request, user, if_none_match=None):
+    """
+        get_form_schema_conditional for the async views. The user's last
+        submission is requested on the event loop, cache reads run in a
+        worker thread and the schema is built on the thread that runs
+        the ORM.
+    """
+    _, form_pk, kobo_schema = await sync_to_async(
+        get_cached_form, thread_sensitive=False
+    )(form_name)
+
+    if not kobo_schema:
+        kobo_schema = await sync_to_async(get_kobo_form_schema, thread_sensitive=False)(
+            form_name
+        )
+
+    if not kobo_schema:
+        return None, None
+
+    last_submission = await get_user_last_submission_async(form_name, user, form_pk)
+
+    return await sync_to_async(build_form_schema_conditional, thread_sensitive=True)(
+        kobo_schema, request, user, last_submission, if_none_match
+    )
+
+
+def etag_matches(etag, if_none_match):
+    """
+        If-None-Match compares weakly (RFC 7232 3.2), proxies that compress
+        the response make the ETag weak
+    """
+
+    def strip_weak(e):
+        return e[2:] if e.startswith("W/") else e
+
+    etags = [strip_weak(e) for e in if_none_match]
+
+    return "*" in etags or strip_weak(etag) in etags
+
+
+def build_form_schema_conditional(
+    kobo_schema, request, user, last_submission, if_none_match=None
+):
+    """
+        @returns (parsed form schema JSON, etag) as get_form_schema_conditional
+    """
+    variant = ""
+
+    if hasattr(request, "accepted_renderer"):
+        variant = request.accepted_renderer.format
+
+    try:
+        etag = get_schema_etag(
+            kobo_schema, request.LANGUAGE_CODE, user, last_submission, variant
+        )
+    except Exception as e:
+        logging.exception(e)
+        return None, None
+
+    if if_none_match and etag_matches(etag, if_none_match):
+        return None, etag
+
+    return_schema = None
 
     try:
         return_schema = parse_kobo_json(kobo_schema, request, user, last_submission)
     except Exception as e:
         logging.exception(e)
+        return None, None
+
+    return return_schema, etag
+
+
+def get_form_schema_static(form_name, locale):
+    """
+        Get the user independent form schema for a locale
+
+        @param form_name - the name of the form
+        @param locale - the locale to translate the schema to
+        @returns (schema JSON, schema version)
+    """
+    kobo_schema = get_kobo_form_schema(form_name)
+
+    if not kobo_schema:
+        return None, None
+
+    try:
+        return get_static_schema(kobo_schema, locale), get_schema_version(kobo_schema)
+    except Exception as e:
+        logging.exception(e)
+        return None, None
+
+
+def get_form_schema_user(form_name, request, user):
+    """
+        Get the per user part of the form schema
+
+        @param form_name - the name of the form
+        @returns (user block JSON, schema version)
+    """
+    _, form_pk, kobo_schema = get_cached_form(form_name)
+
+    if not kobo_schema:
+        kobo_schema = get_kobo_form_schema(form_name)
+
+    if not kobo_schema:
+        return None, None
+
+    last_submission = get_user_last_submission(form_name, user, form_pk)
+
+    try:
+        user_schema = get_user_schema(
+            kobo_schema, request.LANGUAGE_CODE, user, last_submission
+        )
+    except Exception as e:
+        logging.exception(e)
+        return None, None
+
+    return user_schema, get_schema_version(kobo_schema)
+
+
+def get_form_schema(form_name, request, user):
+    """
+        Get the form schema from kobo toolbox
+
+        @param form_name - the name of the form
+        @returns parsed form schema JSON
+    """
+    return_schema, _ = get_form_schema_conditional(form_name, request, user)
+
+    return return_schema
+
+
+def build_form_schema(kobo_schema, request, user, last_submission):
+    """
+        The parsed form schema for a caller that already has the kpi asset
+        and the user's last submission
+
+        @returns parsed form schema JSON or None
+    """
+    if not kobo_schema:
         return None
 
+    return_schema, _ = build_form_schema_conditional(
+        kobo_schema, request, user, last_submission
+    )
+
     return return_schema
 
 
@@ -301,6 +630,65 @@ def submit_form(form_name, form_data, user, request):
         logger.info(f"get_form_id_from_name got no form id for form: {form_name}")
         return None
 
+    submission_endpoint, submission_parcel, _headers = get_submission_parcel(
+        formid, form_data, user, request
+    )
+
+    if getattr(settings, "SUBMISSION_QUEUE", False):
+        return queue_submission(formid, submission_parcel)
+
+    try:
+        f = kobo.post(submission_endpoint, json=submission_parcel, headers=_headers)
+    except Exception as e:
+        logger.error(e)
+        return None
+
+    server_response = f.json()
+
+    return server_response
+
+
+async def submit_form_async(form_name, form_data, user, request):
+    """
+        submit_form for the async views, the kobocat request is made on
+        the event loop
+    """
+    if getattr(settings, "SUBMISSION_QUEUE", False):
+        # only saves the submission
+        return await sync_to_async(submit_form, thread_sensitive=True)(
+            form_name, form_data, user, request
+        )
+
+    formid = await sync_to_async(get_form_id_from_name, thread_sensitive=False)(form_name)
+
+    if not formid:
+        logger.info(f"get_form_id_from_name got no form id for form: {form_name}")
+        return None
+
+    # reads the session
+    submission_endpoint, submission_parcel, _headers = await sync_to_async(
+        get_submission_parcel, thread_sensitive=True
+    )(formid, form_data, user, request)
+
+    try:
+        f = await akobo.post(
+            submission_endpoint, json=submission_parcel, headers=_headers
+        )
+    except Exception as e:
+        logger.error(e)
+        return None
+
+    server_response = f.json()
+
+    return server_response
+
+
+def get_submission_parcel(formid, form_data, user, request):
+    """
+        Builds the kobocat submission for the form values
+
+        @returns (submission endpoint, submission parcel, headers)
+    """
     _formserver = get_kobocat_uri()
     _token = get_kobocat_token()
 
@@ -312,8 +700,6 @@ def submit_form(form_name, form_data, user, request):
     }
     _uuid = uuid.uuid4()
 
-    f = None
-
     # filter out the __ fields which are usually labels
     form_data = {k: v for k, v in form_data.items() if not k.startswith("__")}
 
@@ -349,15 +735,231 @@ def submit_form(form_name, form_data, user, request):
     if not "user_agent" in _submit_form_data:
         _submit_form_data["user_agent"] = get_user_agent(request)
 
+    return submission_endpoint, submission_parcel, _headers
+
+
+def queue_submission(formid, submission_parcel):
+    """
+        Saves a submission for the queue workers to forward to kobocat
+
+        @param formid - kpi asset id
+        @param submission_parcel - the kobocat submission
+        @returns the acknowledgement for the client, shaped like the
+            kobocat response
+    """
+    from .tasks import forward_submissions_task
+
+    instance_id = submission_parcel["meta"]["instanceID"]
+
+    submission = QueuedSubmission.objects.create(
+        instance_id=uuid.UUID(instance_id.replace("uuid:", "")),
+        form_id=formid,
+        parcel=json.dumps(submission_parcel),
+    )
+
+    def enqueue():
+        try:
+            forward_submissions_task()
+        except Exception as e:
+            # the periodic task forwards it
+            logger.error(f"Could not enqueue forwarding {instance_id}: {e}")
+
+    transaction.on_commit(enqueue)
+
+    submission_date = submission.created_at.isoformat()
+
+    return {
+        "message": "Successful submission.",
+        "formid": formid,
+        "encrypted": False,
+        "instanceID": instance_id,
+        "submissionDate": submission_date,
+        "markedAsCompleteDate": submission_date,
+    }
+
+
+def get_submission_backoff(attempts):
+    """ seconds before retrying, half fixed and half jitter """
+    backoff = min(
+        getattr(settings, "SUBMISSION_RETRY_MAX", 3600),
+        getattr(settings, "SUBMISSION_RETRY_BACKOFF", 30) * 2 ** attempts,
+    )
+
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def claim_submissions(batch_size):
+    """
+        Leases a batch of due submissions to this worker, other workers
+        skip them until the lease runs out
+    """
+    now = timezone.now()
+    lease = now + timedelta(seconds=getattr(settings, "SUBMISSION_LEASE", 300))
+
+    with transaction.atomic():
+        batch = list(
+            QueuedSubmission.objects.select_for_update(skip_locked=True)
+            .filter(status=QueuedSubmission.PENDING, next_attempt_at__lte=now)
+            .order_by("id")[:batch_size]
+        )
+
+        QueuedSubmission.objects.filter(pk__in=[s.pk for s in batch]).update(
+            next_attempt_at=lease
+        )
+
+    return batch
+
+
+def forward_submission(submission, submission_endpoint, _headers):
+    """
+        Sends a queued submission to kobocat and records the outcome.
+        kobocat answers resent submissions (same instanceID) with a 202.
+
+        @raises CircuitOpenError while kobocat is failing
+    """
+    submission.attempts += 1
+
     try:
-        f = http.post(submission_endpoint, json=submission_parcel, headers=_headers)
+        f = kobo.post(
+            submission_endpoint, json=json.loads(submission.parcel), headers=_headers
+        )
+    except CircuitOpenError:
+        submission.attempts -= 1
+        raise
     except Exception as e:
-        logger.error(e)
-        return None
+        f = None
+        submission.last_error = str(e)
+
+    if f is not None and f.status_code < 300:
+        submission.status = QueuedSubmission.SENT
+        submission.sent_at = timezone.now()
+        submission.response = f.text
+        submission.last_error = ""
+    else:
+        if f is not None:
+            submission.last_error = f"{f.status_code} {f.text}"
 
-    server_response = f.json()
+        rejected = f is not None and 400 <= f.status_code < 500 and f.status_code != 429
+
+        if rejected or submission.attempts >= getattr(
+            settings, "SUBMISSION_MAX_ATTEMPTS", 10
+        ):
+            logger.error(
+                f"Giving up forwarding submission {submission.instance_id}: "
+                f"{submission.last_error}"
+            )
+            submission.status = QueuedSubmission.FAILED
+        else:
+            submission.next_attempt_at = timezone.now() + timedelta(
+                seconds=get_submission_backoff(submission.attempts)
+            )
+
+    submission.save()
+
+    return submission.status == QueuedSubmission.SENT
 
-    return server_response
+
+def forward_submissions(batch_size=None):
+    """
+        Forwards a batch of due queued submissions to kobocat
+
+        @returns (number sent, number still due)
+    """
+    batch = claim_submissions(
+        batch_size or getattr(settings, "SUBMISSION_BATCH_SIZE", 50)
+    )
+
+    if not batch:
+        return 0, 0
+
+    submission_endpoint = f"{get_kobocat_uri()}api/v1/submissions"
+    _headers = {
+        "Accept": "application/json",
+        "X-Forwarded-Proto": "https",
+        "Authorization": f"Basic {get_kobocat_token()}",
+    }
+
+    sent = 0
+
+    for submission in batch:
+        try:
+            sent += forward_submission(submission, submission_endpoint, _headers)
+        except CircuitOpenError as e:
+            # the rest of the batch is retried when the lease runs out
+            logger.warning(f"Not forwarding submissions: {e}")
+            return sent, 0
+
+    logger.info(f"Forwarded {sent} of {len(batch)} queued submissions")
+
+    remaining = QueuedSubmission.objects.filter(
+        status=QueuedSubmission.PENDING, next_attempt_at__lte=timezone.now()
+    ).count()
+
+    return sent, remaining
+
+
+def purge_sent_submissions(days=None):
+    """
+        Deletes submissions forwarded more than SUBMISSION_RETENTION_DAYS
+        days ago, kobocat has them by then
+
+        @returns number of submissions deleted
+    """
+    if days is None:
+        days = getattr(settings, "SUBMISSION_RETENTION_DAYS", 7)
+
+    deleted, _ = QueuedSubmission.objects.filter(
+        status=QueuedSubmission.SENT, sent_at__lt=timezone.now() - timedelta(days=days)
+    ).delete()
+
+    return deleted
+
+
+def get_submission_queue_stats():
+    """
+        @returns {"pending", "failed", "oldest_pending_seconds"}
+    """
+    counts = dict(
+        QueuedSubmission.objects.filter(
+            status__in=[QueuedSubmission.PENDING, QueuedSubmission.FAILED]
+        )
+        .values_list("status")
+        .annotate(Count("id"))
+        .order_by()
+    )
+
+    oldest = (
+        QueuedSubmission.objects.filter(status=QueuedSubmission.PENDING)
+        .order_by("created_at")
+        .values_list("created_at", flat=True)
+        .first()
+    )
+
+    return {
+        "pending": counts.get(QueuedSubmission.PENDING, 0),
+        "failed": counts.get(QueuedSubmission.FAILED, 0),
+        "oldest_pending_seconds": (timezone.now() - oldest).total_seconds()
+        if oldest
+        else 0,
+    }
+
+
+def render_submission_queue_metrics(stats):
+    """ the submission queue stats in Prometheus text format """
+    lines = format_metric(
+        "beatcovid_submission_queue_depth",
+        "gauge",
+        "Queued submissions by status",
+        [("", {"status": status}, stats[status]) for status in ["pending", "failed"]],
+    )
+    lines += format_metric(
+        "beatcovid_submission_queue_oldest_seconds",
+        "gauge",
+        "Age of the oldest submission waiting to be forwarded",
+        [("", {}, stats["oldest_pending_seconds"])],
+    )
+
+    return "\n".join(lines) + "\n"
 
 
 def get_survey_user_count(form_name="beatcovid19now"):
@@ -368,39 +970,93 @@ def get_survey_user_count(form_name="beatcovid19now"):
         @param form_name - the name of the form, defaults to "beatcovid19now"
 
     """
-    cache_key = "get_survey_user_count"
-    respondent_count_base = get_respondent_count_base()
+    survey_user_count = get_survey_submission_count(form_name)
+
+    return (survey_user_count or 0) + get_respondent_count_base()
 
-    survey_user_count = get_cache(cache_key, form_name)
 
-    if survey_user_count is not None:
-        return respondent_count_base + respondent_count_base
+@cached("get_survey_user_count")
+def get_survey_submission_count(form_name):
+    """
+        Get the number of submissions for a form from kobocat
 
+        @returns the count or None
+    """
     q = get_submission_data(form_name, query={}, count=1)
 
     if q and type(q) is dict and "count" in q:
-        survey_user_count = int(q["count"])
-    else:
-        survey_user_count = 0
-
-    set_cache(cache_key, form_name, survey_user_count)
+        return int(q["count"])
 
-    return survey_user_count + respondent_count_base
+    return None
 
 
-def get_submission_data(form_name, query, limit=None, count=None, sort=None):
+def get_submission_data(
+    form_name, query, limit=None, count=None, sort=None, form_pk=None
+):
     """
         Gets submissoin data for a form
 
         @param formid - kpi asset id
         @param query - query the data as object with kobocat params
+        @param form_pk - the kobocat form pk if already known
     """
-    form_id = get_form_pk_from_name(form_name)
+    if settings.SUBMISSIONS_FROM_MONGO:
+        return get_submission_data_mongo(form_name, query, limit, count, sort)
+
+    form_id = form_pk or get_form_pk_from_name(form_name)
 
     if not form_id:
         logger.info(f"get_form_pk_from_name got no form id for form: {form_name}")
         return None
 
+    url, _headers = get_submission_request(form_id, query, limit, count, sort)
+
+    try:
+        f = kobo.get(url, headers=_headers)
+    except Exception as e:
+        logger.error(e)
+        return None
+
+    return parse_submission_response(f, url, count)
+
+
+async def get_submission_data_async(
+    form_name, query, limit=None, count=None, sort=None, form_pk=None
+):
+    """
+        get_submission_data for the async views, the kobocat request is
+        made on the event loop
+    """
+    if settings.SUBMISSIONS_FROM_MONGO:
+        return await sync_to_async(get_submission_data_mongo, thread_sensitive=False)(
+            form_name, query, limit, count, sort
+        )
+
+    form_id = form_pk or await sync_to_async(
+        get_form_pk_from_name, thread_sensitive=False
+    )(form_name)
+
+    if not form_id:
+        logger.info(f"get_form_pk_from_name got no form id for form: {form_name}")
+        return None
+
+    url, _headers = get_submission_request(form_id, query, limit, count, sort)
+
+    try:
+        f = await akobo.get(url, headers=_headers)
+    except Exception as e:
+        logger.error(e)
+        return None
+
+    return parse_submission_response(f, url, count)
+
+
+def get_submission_request(form_id, query, limit=None, count=None, sort=None):
+    """
+        Builds the kobocat data request for a submission query
+
+        @returns (url, headers)
+    """
     _formserver = get_kobocat_uri()
     _token = get_kobocat_token()
 
@@ -411,8 +1067,6 @@ def get_submission_data(form_name, query, limit=None, count=None, sort=None):
         "Authorization": f"Basic {_token}",
     }
 
-    f = None
-
     _q = {}
 
     if query:
@@ -427,43 +1081,91 @@ def get_submission_data(form_name, query, limit=None, count=None, sort=None):
     if sort:
         _q["sort"] = json.dumps(sort)
 
-    from urllib.parse import quote_plus
-
     payload_str = "&".join("%s=%s" % (k, quote_plus(str(v))) for k, v in _q.items())
 
     logger.debug("get_data query: %s %s", data_endpoint, payload_str)
 
-    try:
-        f = http.get(f"{data_endpoint}?{payload_str}", headers=_headers)
-    except Exception as e:
-        logger.error(e)
-        return None
+    return f"{data_endpoint}?{payload_str}", _headers
 
+
+def parse_submission_response(f, url, count=None):
+    """
+        Parses a kobocat data response
+
+        @returns the submissions, the count response for count queries or
+            False if the response isn't JSON
+    """
     _resp = None
 
     try:
         _resp = f.json()
     except Exception as e:
-        logger.error("get_data query: %s %s", data_endpoint, payload_str)
+        logger.error("get_data query: %s", url)
         logger.exception(e)
         logger.error("Error parsing response JSON %s".format(e))
         return False
 
+    # count queries return {"count": n}
+    if count and type(_resp) is dict:
+        return _resp
+
     if not type(_resp) is list:
         _resp = []
 
-    _resp = [
-        {
-            k: submission_cast_date(v)
-            for k, v in i.items()
-            if not (k.startswith("_") and not k in ["_id", "_submission_time", "_uuid"])
-        }
-        for i in _resp
-    ]
+    _resp = [clean_submission(i) for i in _resp]
 
     return _resp
 
 
+def clean_submission(submission):
+    """ drops kobocat's _ fields we don't use and casts the dates """
+    return {
+        k: submission_cast_date(v)
+        for k, v in submission.items()
+        if not (k.startswith("_") and not k in SUBMISSION_FIELDS_KEPT)
+    }
+
+
+def get_submission_data_mongo(form_name, query, limit=None, count=None, sort=None):
+    """
+        get_submission_data reading kobocat's instances collection directly,
+        with the filtering kobocat adds to data API queries. Results are
+        the same as the data API's.
+
+        @param form_name - the name of the form
+        @param query - mongo query as passed to kobocat
+        @returns the submissions, {"count": n} for count queries or None
+    """
+    form_id = get_form_id_from_name(form_name)
+
+    if not form_id:
+        logger.info(f"get_form_id_from_name got no form id for form: {form_name}")
+        return None
+
+    _filter = dict(query or {})
+    _filter.update({"_xform_id_string": form_id, "_deleted_at": None})
+
+    try:
+        db = get_mongo_db()
+
+        if count:
+            return {"count": db.count_documents(_filter)}
+
+        cursor = db.find(_filter, SUBMISSION_MONGO_PROJECTION)
+
+        if sort:
+            cursor = cursor.sort([(k, int(v)) for k, v in sort.items()])
+
+        if limit:
+            cursor = cursor.limit(int(limit))
+
+        return [clean_submission(i) for i in cursor]
+    except Exception as e:
+        logger.error(f"get_data mongo query: {form_id} {_filter}")
+        logger.exception(e)
+        return None
+
+
 def kobocat_transform_transport(record):
     SKIP_FIELDS = ["meta/instanceID", "_bamboo_dataset_id", "_attachments"]
     record_out = {}
@@ -546,7 +1248,7 @@ def get_submission_stats(form_name):
     f = None
 
     try:
-        f = http.get(data_endpoint, params=request_paramaters, headers=_headers)
+        f = kobo.get(data_endpoint, params=request_paramaters, headers=_headers)
     except Exception as e:
         logger.error(e)
         return None
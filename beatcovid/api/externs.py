@@ -0,0 +1,281 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from beatcovid.core.cache import get_redis
+
+logger = logging.getLogger(__name__)
+
+# bumped whenever an extern's model changes, in whichever process that is
+EXTERNS_VERSION_KEY = "externs:version"
+
+# seconds between each process checking EXTERNS_VERSION_KEY
+VERSION_CHECK_INTERVAL = 5
+
+_version = None
+_version_checked = None
+
+# list_name -> (model, get_rows, get_top_value)
+_extern_sources = {}
+
+# list_name -> [(value, label)] in model order
+_extern_rows = {}
+
+# list_name -> set of the values
+_extern_values = {}
+
+# list_name -> digest of the rows
+_extern_digests = {}
+
+# (list_name, top value) -> choice list with the top value first
+_extern_lists = {}
+
+_externs_lock = threading.Lock()
+
+
+def register_extern(list_name, model, get_rows, get_top_value):
+    """
+        Registers a select list that is loaded from the database rather
+        than from the form choices.
+
+        @param model - model the rows come from, changes to it invalidate the list
+        @param get_rows - callable returning [(value, label)] for the list
+        @param get_top_value - callable mapping a user locale to the value
+            that is listed first
+    """
+    _extern_sources[list_name] = (model, get_rows, get_top_value)
+
+    post_save.connect(externs_changed, sender=model, dispatch_uid=f"externs_{list_name}")
+    post_delete.connect(
+        externs_changed, sender=model, dispatch_uid=f"externs_delete_{list_name}"
+    )
+
+
+def clear_externs(list_name=None):
+    with _externs_lock:
+        if list_name:
+            _extern_rows.pop(list_name, None)
+            _extern_values.pop(list_name, None)
+            _extern_digests.pop(list_name, None)
+            for k in [k for k in _extern_lists if k[0] == list_name]:
+                del _extern_lists[k]
+        else:
+            _extern_rows.clear()
+            _extern_values.clear()
+            _extern_digests.clear()
+            _extern_lists.clear()
+
+
+def externs_changed(sender, **kwargs):
+    """
+        model signal receiver, fires for every row a fixture (re)loads.
+        Models are usually changed by another process, such as loaddata,
+        so the other processes are told through EXTERNS_VERSION_KEY
+    """
+    from .transformers import clear_compiled_schemas
+
+    for list_name, (model, _, _) in _extern_sources.items():
+        if model is sender:
+            clear_externs(list_name)
+
+    # compiled schemas include the extern choices
+    clear_compiled_schemas()
+
+    try:
+        get_redis().incr(EXTERNS_VERSION_KEY)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not tell other processes the externs changed: {e}")
+
+
+def check_externs_version():
+    """
+        Drops the cached externs and compiled schemas when another process
+        changed an extern's model, checking at most every
+        VERSION_CHECK_INTERVAL seconds
+    """
+    global _version, _version_checked
+
+    now = time.monotonic()
+
+    if _version_checked is not None and now - _version_checked < VERSION_CHECK_INTERVAL:
+        return
+
+    _version_checked = now
+
+    try:
+        version = get_redis().get(EXTERNS_VERSION_KEY)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not check the externs version: {e}")
+        return
+
+    if version != _version:
+        from .transformers import clear_compiled_schemas
+
+        _version = version
+        clear_externs()
+        clear_compiled_schemas()
+
+
+def get_extern_rows(list_name):
+    """ the cached [(value, label)] of an extern """
+    with _externs_lock:
+        rows = _extern_rows.get(list_name, None)
+
+    if rows is None:
+        logger.debug(f"Loading extern {list_name}")
+        rows = list(_extern_sources[list_name][1]())
+
+        with _externs_lock:
+            _extern_rows[list_name] = rows
+            _extern_values[list_name] = {value for value, _ in rows}
+            _extern_digests[list_name] = get_rows_digest(rows)
+
+    return rows
+
+
+def get_rows_digest(rows):
+    return hashlib.sha1(json.dumps(rows, default=str).encode("utf-8")).hexdigest()
+
+
+def get_externs_version():
+    """
+        Identifies the content of every extern, for the schema versions
+        and ETags of schemas that include the extern choices
+    """
+    check_externs_version()
+
+    digests = []
+
+    for list_name in sorted(_extern_sources):
+        with _externs_lock:
+            digest = _extern_digests.get(list_name, None)
+
+        if digest is None:
+            digest = get_rows_digest(get_extern_rows(list_name))
+
+        digests.append(f"{list_name}:{digest}")
+
+    return hashlib.sha1(" ".join(digests).encode("utf-8")).hexdigest()[:16]
+
+
+def get_extern_top_value(list_name, user_language):
+    """
+        The value listed first for a locale, None if the locale doesn't
+        map onto one of the extern's values
+    """
+    check_externs_version()
+
+    if not user_language:
+        user_language = "en"
+
+    top_value = _extern_sources[list_name][2](user_language)
+    values = _extern_values.get(list_name, None)
+
+    if values is None:
+        get_extern_rows(list_name)
+        values = _extern_values.get(list_name, set())
+
+    if top_value not in values:
+        return None
+
+    return top_value
+
+
+def get_extern_top_values(user_language):
+    """ the top value of every extern for a locale, in list name order """
+    return tuple(
+        get_extern_top_value(list_name, user_language)
+        for list_name in sorted(_extern_sources)
+    )
+
+
+def get_extern_choices(list_name, user_language):
+    """
+        Returns the cached choice list for an extern with the value for
+        the user's locale first, followed by a -- separator. The list is
+        shared between requests and must not be modified.
+    """
+    if list_name not in _extern_sources:
+        return None
+
+    top_value = get_extern_top_value(list_name, user_language)
+    key = (list_name, top_value)
+
+    with _externs_lock:
+        if key in _extern_lists:
+            return _extern_lists[key]
+
+    rows = get_extern_rows(list_name)
+
+    choices_top = []
+    choices = []
+
+    for value, label in rows:
+        choice = {"id": list_name, "value": value, "label": label}
+
+        if value == top_value:
+            choices_top.append(choice)
+        else:
+            choices.append(choice)
+
+    choices_top.append({"id": list_name, "value": None, "label": "--"})
+
+    with _externs_lock:
+        _extern_lists[key] = choices_top + choices
+
+        return _extern_lists[key]
+
+
+def get_language_rows():
+    from languages_plus.models import Language
+
+    return Language.objects.values_list("iso_639_1", "name_en")
+
+
+def get_language_top_value(user_language):
+    return user_language[:2]
+
+
+def get_country_rows():
+    from countries_plus.models import Country
+
+    return Country.objects.values_list("iso", "name")
+
+
+def get_country_top_value(user_language):
+    """ region of the locale, ie. AU for en-AU """
+    for separator in ["-", "_"]:
+        if separator in user_language:
+            return user_language.split(separator, 1)[1].upper()
+    return None
+
+
+def register_languages():
+    from languages_plus.models import Language
+
+    register_extern("languages", Language, get_language_rows, get_language_top_value)
+
+
+def register_countries():
+    from countries_plus.models import Country
+
+    register_extern("countries", Country, get_country_rows, get_country_top_value)
+
+
+# externs that can be turned on with the EXTERNS setting
+DEFAULT_EXTERNS = {
+    "languages": register_languages,
+    "countries": register_countries,
+}
+
+
+def register_default_externs():
+    """ registers the externs listed in the EXTERNS setting """
+    for list_name in getattr(settings, "EXTERNS", ["languages"]):
+        DEFAULT_EXTERNS[list_name]()
@@ -0,0 +1,134 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from beatcovid.api.benchmarks import (
+    BASELINE_PATH,
+    benchmark_choice_index,
+    benchmark_codecs,
+    benchmark_json,
+    find_regressions,
+    load_baseline,
+    run_benchmarks,
+    save_baseline,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the form schema transformation"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--iterations", type=int, default=50, help="Calls to time for each case",
+        )
+        parser.add_argument(
+            "--locale",
+            action="append",
+            dest="locales",
+            help="Locale to benchmark, can be repeated. "
+            "Defaults to all translated locales",
+        )
+        parser.add_argument(
+            "--baseline", default=BASELINE_PATH, help="Path of the stored baseline",
+        )
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="Store these results as the baseline",
+        )
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Fail if any case regressed against the baseline",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.25,
+            help="Allowed fractional increase over the baseline",
+        )
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=500,
+            help="Number of survey rows to scale to for the choice index benchmark",
+        )
+        parser.add_argument(
+            "--choices",
+            type=int,
+            default=20,
+            help="Extra choices to add to every choice list "
+            "for the choice index benchmark",
+        )
+
+    def handle(self, *args, **options):
+        # keep per call debug logging out of the timings
+        if options["verbosity"] < 2:
+            logging.getLogger("beatcovid").setLevel(logging.INFO)
+
+        results = run_benchmarks(options["iterations"], options["locales"])
+
+        self.stdout.write(
+            "{:<48} {:>9} {:>9} {:>9} {:>10} {:>10} {:>9}".format(
+                "case", "p50 ms", "p90 ms", "p99 ms", "alloc KB", "peak KB", "size B"
+            )
+        )
+
+        for name, r in results.items():
+            self.stdout.write(
+                "{:<48} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.1f} {:>10.1f} {:>9}".format(
+                    name,
+                    r["p50"],
+                    r["p90"],
+                    r["p99"],
+                    r["allocated_kb"],
+                    r["peak_kb"],
+                    r.get("size", "-"),
+                )
+            )
+
+        choice_index = benchmark_choice_index(options["rows"], options["choices"])
+
+        self.stdout.write(
+            "choice lookup over {rows} rows and {choices} choices: "
+            "linear {linear_ms:.2f}ms, indexed {indexed_ms:.2f}ms "
+            "({speedup:.1f}x)".format(**choice_index)
+        )
+
+        for name, r in benchmark_json(options["iterations"]).items():
+            self.stdout.write(
+                "{} ({} bytes): stdlib {:.3f}ms, orjson {:.3f}ms ({:.1f}x)".format(
+                    name, r["size"], r["stdlib"], r["fast"], r["speedup"]
+                )
+            )
+
+        for name, r in benchmark_codecs(options["iterations"]).items():
+            self.stdout.write(
+                "cache codec {}: {} bytes, encode {:.3f}ms, decode {:.3f}ms".format(
+                    name, r["size"], r["encode"], r["decode"]
+                )
+            )
+
+        if options["save_baseline"]:
+            save_baseline(results, options["baseline"])
+            self.stdout.write(f"Saved baseline to {options['baseline']}")
+
+        if options["check"]:
+            baseline = load_baseline(options["baseline"])
+
+            if not baseline:
+                raise CommandError(f"No baseline at {options['baseline']}")
+
+            regressions = find_regressions(results, baseline, options["tolerance"])
+
+            for name, metric, before, after in regressions:
+                self.stderr.write(
+                    f"{name} {metric} regressed: {before:.3f} -> {after:.3f}"
+                )
+
+            if regressions:
+                raise CommandError(f"{len(regressions)} benchmark regressions")
+
+            self.stdout.write("No regressions against the baseline")
@@ -0,0 +1,90 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from beatcovid.api.standin import StandinStore, make_standin_server
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Runs a local stand-in for the form server and kobocat"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+        parser.add_argument("--port", type=int, default=8001, help="Port to listen on")
+        parser.add_argument(
+            "--data-dir",
+            help="Directory of recorded forms and submissions. Without it the "
+            "fixture form and submissions are served and nothing is saved",
+        )
+        parser.add_argument(
+            "--record",
+            action="store_true",
+            help="Send GETs to KOBO_FORM_SERVER and KOBOCAT_API and save the "
+            "responses to --data-dir",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="Milliseconds added to every response",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            default=0,
+            help="Up to this many milliseconds more or less latency",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0,
+            help="Fraction of requests answered with a 503",
+        )
+
+    def handle(self, *args, **options):
+        store = StandinStore(options["data_dir"])
+        kpi_upstream = None
+        kobocat_upstream = None
+
+        if options["record"]:
+            if not options["data_dir"]:
+                raise CommandError("--record needs a --data-dir to save to")
+
+            kpi_upstream = settings.KOBO_FORM_SERVER
+            kobocat_upstream = settings.KOBOCAT_API
+
+            if not kpi_upstream or not kobocat_upstream:
+                raise CommandError("Recording needs KOBO_FORM_SERVER and KOBOCAT_API")
+        elif not store.assets:
+            store.seed()
+
+        server = make_standin_server(
+            options["host"],
+            options["port"],
+            store,
+            latency=options["latency"] / 1000,
+            jitter=options["jitter"] / 1000,
+            error_rate=options["error_rate"],
+            kpi_upstream=kpi_upstream,
+            kobocat_upstream=kobocat_upstream,
+        )
+
+        base_url = f"http://{options['host']}:{server.server_address[1]}/"
+
+        self.stdout.write(
+            f"Serving {len(store.assets)} forms, set KOBO_FORM_SERVER and KOBOCAT_API "
+            f"to {base_url}"
+        )
+
+        if kpi_upstream:
+            self.stdout.write(f"Recording {kpi_upstream} and {kobocat_upstream}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
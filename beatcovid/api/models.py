@@ -0,0 +1,29 @@
+from django.db import models
+from django.utils import timezone
+
+
+class QueuedSubmission(models.Model):
+    """
+        A form submission saved for forwarding to kobocat by the
+        submission queue workers
+    """
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+
+    STATUS_CHOICES = [(PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed")]
+
+    instance_id = models.UUIDField(verbose_name="Submission instanceID", unique=True)
+    form_id = models.CharField(max_length=64, verbose_name="kpi form uid")
+    parcel = models.TextField(verbose_name="kobocat submission JSON")
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True
+    )
+    attempts = models.IntegerField(default=0)
+    # also leased forward while a worker is sending it
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    response = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
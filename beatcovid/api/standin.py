@@ -0,0 +1,443 @@
+"""
+    Local stand-in for the form server (kpi) and kobocat, for load testing
+    the API offline. Point KOBO_FORM_SERVER and KOBOCAT_API at it.
+
+    Serves
+        GET  assets/                paginated with limit and offset
+        GET  assets/<uid>
+        GET  api/v1/forms
+        GET  api/v1/data/<pk>       query, sort, start, limit and count
+        POST api/v1/submissions     stored, never sent upstream
+
+    The forms and submissions come from a data directory
+
+        assets/<uid>.json           full kpi assets
+        forms.json                  kobocat form listing
+        data/<pk>.json              submissions of a form
+
+    In record mode GETs are sent to the real servers and the responses
+    are saved to the data directory, later runs replay them.
+"""
+import datetime
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests as requestslib
+
+from .benchmarks import load_asset_fixture, load_submissions_fixture
+
+logger = logging.getLogger(__name__)
+
+ASSETS_PAGE_SIZE = 100
+
+QUERY_OPERATORS = {
+    "$eq": lambda value, arg: value == arg,
+    "$ne": lambda value, arg: value != arg,
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$in": lambda value, arg: value in arg,
+    "$nin": lambda value, arg: value not in arg,
+}
+
+
+def match_query(submission, query):
+    """
+        Matches a submission against the subset of mongo queries kobocat
+        takes: field equality, comparison operators and $exists
+    """
+    for field, condition in query.items():
+        value = submission.get(field, None)
+
+        if type(condition) is not dict:
+            if value != condition:
+                return False
+            continue
+
+        for operator, arg in condition.items():
+            if operator == "$exists":
+                if (field in submission) != bool(arg):
+                    return False
+            elif operator not in QUERY_OPERATORS:
+                raise Exception(f"Unsupported query operator {operator}")
+            elif not QUERY_OPERATORS[operator](value, arg):
+                return False
+
+    return True
+
+
+def sort_submissions(submissions, sort):
+    """ sort is {field: 1 or -1}, applied in order """
+    for field, direction in reversed(list(sort.items())):
+        submissions = sorted(
+            submissions,
+            key=lambda s: (s.get(field, None) is not None, s.get(field, None)),
+            reverse=int(direction) < 0,
+        )
+
+    return submissions
+
+
+def query_submissions(submissions, params):
+    """
+        Runs a kobocat data query
+
+        @param params - the query string, {name: value}
+        @returns the matching submissions or {"count": n} for count queries
+    """
+    query = json.loads(params.get("query", None) or "{}")
+    result = [s for s in submissions if match_query(s, query)]
+
+    if params.get("count", None):
+        return {"count": len(result)}
+
+    if params.get("sort", None):
+        result = sort_submissions(result, json.loads(params["sort"]))
+
+    start = int(params.get("start", None) or 0)
+    result = result[start:]
+
+    if params.get("limit", None):
+        result = result[: int(params["limit"])]
+
+    return result
+
+
+class StandinStore:
+    """ the forms and submissions served, optionally kept in a data directory """
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.assets = {}
+        self.forms = []
+        self.data = {}
+
+        if data_dir and os.path.isdir(data_dir):
+            self.load()
+
+    def seed(self):
+        """ serves the fixture form and submissions """
+        asset = load_asset_fixture()
+        submissions = load_submissions_fixture()
+
+        for n, submission in enumerate(submissions):
+            submission.setdefault("_id", n + 1)
+            submission.setdefault("_uuid", str(uuid.uuid4()))
+
+        self.assets[asset["uid"]] = asset
+        self.forms = [{"formid": 1, "id_string": asset["uid"], "title": asset["name"]}]
+        self.data[1] = submissions
+
+    def load(self):
+        assets_dir = os.path.join(self.data_dir, "assets")
+
+        for file_name in os.listdir(assets_dir) if os.path.isdir(assets_dir) else []:
+            with open(os.path.join(assets_dir, file_name)) as fh:
+                asset = json.load(fh)
+                self.assets[asset["uid"]] = asset
+
+        self.forms = self.read("forms.json") or []
+
+        for form in self.forms:
+            self.data[form["formid"]] = self.read("data", f"{form['formid']}.json") or []
+
+        logger.info(
+            f"Loaded {len(self.assets)} assets and "
+            f"{sum(len(d) for d in self.data.values())} submissions from {self.data_dir}"
+        )
+
+    def read(self, *path):
+        file_path = os.path.join(self.data_dir, *path)
+
+        if not os.path.isfile(file_path):
+            return None
+
+        with open(file_path) as fh:
+            return json.load(fh)
+
+    def write(self, value, *path):
+        if not self.data_dir:
+            return
+
+        file_path = os.path.join(self.data_dir, *path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with open(file_path + ".tmp", "w") as fh:
+            json.dump(value, fh)
+
+        os.replace(file_path + ".tmp", file_path)
+
+    def get_listing(self):
+        return [
+            {k: v for k, v in asset.items() if k != "content"}
+            for asset in self.assets.values()
+        ]
+
+    def record_asset(self, asset):
+        with self.lock:
+            self.assets[asset["uid"]] = asset
+            self.write(asset, "assets", f"{asset['uid']}.json")
+
+    def record_listing(self, listing):
+        """ listings don't have the content, only new assets are stored """
+        with self.lock:
+            for asset in listing:
+                if asset["uid"] not in self.assets:
+                    self.assets[asset["uid"]] = asset
+                    self.write(asset, "assets", f"{asset['uid']}.json")
+
+    def record_forms(self, forms):
+        with self.lock:
+            stored = {f["formid"]: f for f in self.forms}
+            stored.update({f["formid"]: f for f in forms})
+
+            self.forms = list(stored.values())
+            self.write(self.forms, "forms.json")
+
+    def record_submissions(self, form_pk, submissions):
+        with self.lock:
+            stored = {s["_id"]: s for s in self.data.get(form_pk, [])}
+            stored.update({s["_id"]: s for s in submissions if "_id" in s})
+
+            self.data[form_pk] = list(stored.values())
+            self.write(self.data[form_pk], "data", f"{form_pk}.json")
+
+    def add_submission(self, id_string, submission, instance_id):
+        """
+            @returns the stored submission or None if there is no form with
+                id_string
+        """
+        form = next((f for f in self.forms if f["id_string"] == id_string), None)
+
+        if not form:
+            return None
+
+        with self.lock:
+            submissions = self.data.setdefault(form["formid"], [])
+            submission = dict(submission)
+            submission["_id"] = max([s.get("_id", 0) for s in submissions] or [0]) + 1
+            submission["_uuid"] = instance_id.replace("uuid:", "")
+            submission["_xform_id_string"] = id_string
+            submission["_submission_time"] = datetime.datetime.utcnow().strftime(
+                "%Y-%m-%dT%H:%M:%S"
+            )
+            submissions.append(submission)
+
+        return submission
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """ set up by make_standin_server """
+
+    store = None
+    latency = 0
+    jitter = 0
+    error_rate = 0
+    kpi_upstream = None
+    kobocat_upstream = None
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        """ @returns False if the request should fail """
+        if self.latency or self.jitter:
+            time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.send_json({"detail": "Injected error"}, status=503)
+            return False
+
+        return True
+
+    def do_GET(self):
+        if not self.delay():
+            return
+
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split("/") if p]
+
+        try:
+            if parts[:1] == ["assets"]:
+                return self.get_assets(url, parts, params)
+
+            if parts[:3] == ["api", "v1", "forms"]:
+                return self.get_forms(url, params)
+
+            if parts[:3] == ["api", "v1", "data"] and len(parts) == 4:
+                return self.get_data(url, int(parts[3]), params)
+        except Exception as e:
+            logger.exception(e)
+            return self.send_json({"detail": str(e)}, status=500)
+
+        self.send_json({"detail": "Not found."}, status=404)
+
+    def do_POST(self):
+        if not self.delay():
+            return
+
+        if urlsplit(self.path).path.rstrip("/") != "/api/v1/submissions":
+            return self.send_json({"detail": "Not found."}, status=404)
+
+        parcel = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        instance_id = parcel.get("meta", {}).get("instanceID", f"uuid:{uuid.uuid4()}")
+
+        submission = self.store.add_submission(
+            parcel.get("id", None), parcel.get("submission", {}), instance_id
+        )
+
+        if not submission:
+            return self.send_json({"detail": "Form not found."}, status=404)
+
+        self.send_json(
+            {
+                "message": "Successful submission.",
+                "formid": parcel["id"],
+                "encrypted": False,
+                "instanceID": instance_id,
+                "submissionDate": submission["_submission_time"],
+                "markedAsCompleteDate": submission["_submission_time"],
+            },
+            status=201,
+        )
+
+    def get_upstream(self, upstream, url):
+        """
+            Forwards the request to the real server with our caller's
+            credentials. Links to the real server are rewritten to here.
+        """
+        upstream_url = upstream + url.path.lstrip("/")
+
+        if url.query:
+            upstream_url += "?" + url.query
+
+        headers = {
+            k: v for k, v in self.headers.items() if k in ["Accept", "Authorization"]
+        }
+        r = requestslib.get(upstream_url, headers=headers, timeout=30)
+        r.raise_for_status()
+
+        return json.loads(r.text.replace(upstream, f"http://{self.headers['Host']}/"))
+
+    def get_assets(self, url, parts, params):
+        if len(parts) > 1:
+            uid = parts[1]
+
+            if self.kpi_upstream:
+                self.store.record_asset(self.get_upstream(self.kpi_upstream, url))
+
+            if uid not in self.store.assets:
+                return self.send_json({"detail": "Not found."}, status=404)
+
+            return self.send_json(self.store.assets[uid])
+
+        if self.kpi_upstream:
+            r = self.get_upstream(self.kpi_upstream, url)
+            self.store.record_listing(r["results"])
+            return self.send_json(r)
+
+        listing = self.store.get_listing()
+        limit = int(params.get("limit", None) or ASSETS_PAGE_SIZE)
+        offset = int(params.get("offset", None) or 0)
+        next_url = None
+
+        if offset + limit < len(listing):
+            next_url = (
+                f"http://{self.headers['Host']}/assets/"
+                f"?limit={limit}&offset={offset + limit}"
+            )
+
+        self.send_json(
+            {
+                "count": len(listing),
+                "next": next_url,
+                "previous": None,
+                "results": listing[offset : offset + limit],
+            }
+        )
+
+    def get_forms(self, url, params):
+        if self.kobocat_upstream:
+            self.store.record_forms(self.get_upstream(self.kobocat_upstream, url))
+
+        forms = self.store.forms
+
+        if "id_string" in params:
+            forms = [f for f in forms if f["id_string"] == params["id_string"]]
+
+        self.send_json(forms)
+
+    def get_data(self, url, form_pk, params):
+        if self.kobocat_upstream:
+            r = self.get_upstream(self.kobocat_upstream, url)
+
+            if type(r) is list:
+                self.store.record_submissions(form_pk, r)
+
+            return self.send_json(r)
+
+        if form_pk not in self.store.data:
+            return self.send_json({"detail": "Not found."}, status=404)
+
+        self.send_json(query_submissions(self.store.data[form_pk], params))
+
+
+def make_standin_server(
+    host="127.0.0.1",
+    port=8001,
+    store=None,
+    latency=0,
+    jitter=0,
+    error_rate=0,
+    kpi_upstream=None,
+    kobocat_upstream=None,
+):
+    """
+        @param latency - seconds added to every response
+        @param jitter - up to this many seconds more or less latency
+        @param error_rate - fraction of requests answered with a 503
+        @param kpi_upstream, kobocat_upstream - real servers to record from
+        @returns the server, call serve_forever() to run it
+    """
+    if store is None:
+        store = StandinStore()
+        store.seed()
+
+    handler = type(
+        "StandinHandler",
+        (StandinHandler,),
+        {
+            "store": store,
+            "latency": latency,
+            "jitter": jitter,
+            "error_rate": error_rate,
+            "kpi_upstream": kpi_upstream,
+            "kobocat_upstream": kobocat_upstream,
+        },
+    )
+
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    return server
@@ -0,0 +1,53 @@
+import logging
+
+from django.conf import settings
+from huey import crontab
+from huey.contrib.djhuey import db_periodic_task, db_task, lock_task
+
+from .controllers import (
+    forward_submissions,
+    purge_sent_submissions,
+    refresh_form_schemas,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@db_periodic_task(crontab(minute=f"*/{settings.SCHEMA_REFRESH_MINUTES}"))
+@lock_task("refresh-form-schemas")
+def refresh_form_schemas_task():
+    """
+        Keeps the form listing and schema cache warm and picks up form
+        changes from the form server in the background
+    """
+    changed = refresh_form_schemas()
+
+    if changed:
+        logger.info("Refreshed form schemas for {}".format(", ".join(changed)))
+
+
+@db_task(priority=settings.SUBMISSION_PRIORITY)
+def forward_submissions_task():
+    """
+        Forwards queued submissions to kobocat a batch at a time, running
+        again while there are due submissions left
+    """
+    sent, remaining = forward_submissions()
+
+    if remaining:
+        forward_submissions_task()
+
+
+@db_periodic_task(crontab(minute="*"), priority=settings.SUBMISSION_PRIORITY)
+def forward_submissions_periodic_task():
+    """ picks up retries and submissions that couldn't be enqueued """
+    forward_submissions_task()
+
+
+@db_periodic_task(crontab(minute="0"))
+def purge_sent_submissions_task():
+    """ drops forwarded submissions past SUBMISSION_RETENTION_DAYS """
+    deleted = purge_sent_submissions()
+
+    if deleted:
+        logger.info(f"Purged {deleted} sent submissions")
@@ -1,3 +1,1673 @@
-from django.test import TestCase
+import asyncio
+import collections
+import datetime
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import django
+import httpx
+import requests
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from languages_plus.models import Language
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from beatcovid.api import controllers, externs, tasks, transformers, views
+from beatcovid.api.benchmarks import find_regressions, run_benchmarks, stub_kobo
+from beatcovid.api.externs import clear_externs, get_extern_choices
+from beatcovid.api.models import QueuedSubmission
+from beatcovid.api.standin import (
+    make_standin_server,
+    match_query,
+    query_submissions,
+    sort_submissions,
+)
+from beatcovid.api.transformers import (
+    TRANSLATIONS_PATH,
+    clear_compiled_schemas,
+    get_compiled_schema,
+    get_schema_etag,
+    get_schema_version,
+    get_static_schema,
+    get_user_schema,
+    parse_kobo_json,
+    translate_form_label,
+)
+from beatcovid.core import cache, mongo
+from beatcovid.core.http_connection import (
+    AsyncKoboClient,
+    CircuitOpenError,
+    KoboClient,
+    serialise_response,
+)
+from beatcovid.core.metrics import CacheMetrics, render_prometheus
+from beatcovid.core.parsers import FastJSONParser
+from beatcovid.core.renderers import FastJSONRenderer
+from beatcovid.respondent.models import Respondent
+
+BASE_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def get_fixture(fixture_name):
+    fixture_file_name = os.path.join(BASE_PATH, f"{fixture_name}.json")
+    if not os.path.isfile(fixture_file_name):
+        raise Exception(f"Fixture {fixture_name} not found")
+
+    fixture = None
+
+    with open(fixture_file_name) as fh:
+        fixture = json.load(fh)
+
+    return fixture
+
+
+def get_request(language="en"):
+    request = RequestFactory().get("/")
+    request.LANGUAGE_CODE = language
+    return request
+
+
+class CompiledSchemaTestCase(TestCase):
+    def setUp(self):
+        clear_compiled_schemas()
+        self.asset = get_fixture("kobo_asset")
+
+    def test_template_reused_between_users(self):
+        first = Respondent()
+        second = Respondent()
+
+        a = parse_kobo_json(self.asset, get_request(), first)
+        b = parse_kobo_json(self.asset, get_request(), second)
+
+        self.assertEqual(a["user"]["id"], str(first.id))
+        self.assertEqual(b["user"]["id"], str(second.id))
+        self.assertIs(a["survey"]["steps"], b["survey"]["steps"])
+        self.assertIs(a["labels"], b["labels"])
+
+    def test_user_id_calculation(self):
+        user = Respondent()
+
+        schema = parse_kobo_json(self.asset, get_request(), user)
+        user_global = [g for g in schema["survey"]["global"] if g["name"] == "user_id"][0]
+
+        self.assertEqual(user_global["calculation"], str(user.id))
+        self.assertTrue(user_global["required"])
+
+        # the shared template is not modified
+        compiled = get_compiled_schema(self.asset, "en")
+        template_global = [
+            g for g in compiled["schema"]["survey"]["global"] if g["name"] == "user_id"
+        ][0]
+        self.assertNotEqual(template_global["calculation"], str(user.id))
+
+    def test_last_submission_retained_fields(self):
+        last_submission = {"age": "30_39", "symptom_cough": "none_0"}
+
+        schema = parse_kobo_json(self.asset, get_request(), Respondent(), last_submission)
+
+        self.assertEqual(schema["user"]["last_submission"], {"age": "30_39"})
+
+    def test_template_per_locale(self):
+        en = parse_kobo_json(self.asset, get_request("en"), Respondent())
+        de = parse_kobo_json(self.asset, get_request("de"), Respondent())
+
+        self.assertEqual(de["user"]["language"], "de")
+        self.assertNotEqual(en["labels"]["symptom_cough"], de["labels"]["symptom_cough"])
+
+    def test_template_per_translation_locale(self):
+        compiled = get_compiled_schema(self.asset, "en")
+
+        for locale in ["en-us", "en-gb", "xx-junk123"] + [
+            f"x{n}-junk" for n in range(70)
+        ]:
+            self.assertIs(get_compiled_schema(self.asset, locale), compiled)
+
+        de = get_compiled_schema(self.asset, "de")
+
+        self.assertIs(get_compiled_schema(self.asset, "de-de"), de)
+        self.assertIsNot(de, compiled)
+
+
+class SchemaETagTestCase(TestCase):
+    def setUp(self):
+        self.asset = get_fixture("kobo_asset")
+        self.user = Respondent()
+
+    def test_etag_stable(self):
+        self.assertEqual(
+            get_schema_etag(self.asset, "en", self.user, {"age": "30_39"}),
+            get_schema_etag(self.asset, "en", self.user, {"age": "30_39"}),
+        )
+
+    def test_etag_ignores_unretained_values(self):
+        self.assertEqual(
+            get_schema_etag(self.asset, "en", self.user, {"age": "30_39"}),
+            get_schema_etag(
+                self.asset, "en", self.user, {"age": "30_39", "symptom_cough": "mild_1"}
+            ),
+        )
+
+    def test_etag_changes(self):
+        etag = get_schema_etag(self.asset, "en", self.user, {"age": "30_39"})
+
+        self.assertNotEqual(
+            etag, get_schema_etag(self.asset, "en", self.user, {"age": "40_49"})
+        )
+        self.assertNotEqual(
+            etag, get_schema_etag(self.asset, "de", self.user, {"age": "30_39"})
+        )
+        self.assertNotEqual(
+            etag, get_schema_etag(self.asset, "en", Respondent(), {"age": "30_39"})
+        )
+
+        asset = dict(self.asset, version_count=self.asset["version_count"] + 1)
+        self.assertNotEqual(
+            etag, get_schema_etag(asset, "en", self.user, {"age": "30_39"})
+        )
+
+    def test_if_none_match_weak(self):
+        etag = get_schema_etag(self.asset, "en", self.user)
+        request = get_request()
+
+        for if_none_match in [[etag], [f"W/{etag}"], ['"other"', "*"]]:
+            self.assertEqual(
+                controllers.build_form_schema_conditional(
+                    self.asset, request, self.user, None, if_none_match
+                ),
+                (None, etag),
+            )
+
+        schema, _ = controllers.build_form_schema_conditional(
+            self.asset, request, self.user, None, ['W/"other"']
+        )
+
+        self.assertEqual(schema["uid"], self.asset["uid"])
+
+
+class SplitSchemaTestCase(TestCase):
+    def setUp(self):
+        self.asset = get_fixture("kobo_asset")
+
+    def test_static_and_user_schema_make_up_schema(self):
+        user = Respondent()
+        last_submission = {"age": "30_39"}
+
+        schema = parse_kobo_json(self.asset, get_request(), user, last_submission)
+        static = get_static_schema(self.asset, "en")
+
+        self.assertNotIn("user", static)
+        self.assertEqual(static["labels"], schema["labels"])
+        self.assertEqual(static["survey"]["steps"], schema["survey"]["steps"])
+        self.assertEqual(
+            get_user_schema(self.asset, "en", user, last_submission), schema["user"]
+        )
+
+    def test_schema_version(self):
+        asset = dict(self.asset, version_count=self.asset["version_count"] + 1)
+
+        self.assertEqual(get_schema_version(self.asset), get_schema_version(self.asset))
+        self.assertNotEqual(get_schema_version(self.asset), get_schema_version(asset))
+
+
+class StaticSchemaViewTestCase(TestCase):
+    def setUp(self):
+        clear_compiled_schemas()
+        self.asset = get_fixture("kobo_asset")
+        self.url = f"/api/form/schema/{self.asset['name']}/static/"
+        self.version = get_schema_version(self.asset)
+
+    def test_negotiated_redirect_private(self):
+        with stub_kobo(self.asset):
+            de = self.client.get(self.url, HTTP_ACCEPT_LANGUAGE="de")
+            fr = self.client.get(self.url, HTTP_ACCEPT_LANGUAGE="fr")
+
+        self.assertEqual(de.status_code, 302)
+        self.assertTrue(de["Location"].endswith(f"/{self.version}/de/"))
+        self.assertTrue(fr["Location"].endswith(f"/{self.version}/fr/"))
+        self.assertIn("private", de["Cache-Control"])
+        self.assertIn("Accept-Language", de["Vary"])
+
+    def test_unsupported_locale_redirects(self):
+        with stub_kobo(self.asset):
+            r = self.client.get(f"{self.url}{self.version}/xx-junk123/")
+            de = self.client.get(f"{self.url}{self.version}/de-DE/")
+            en = self.client.get(f"{self.url}{self.version}/en/")
+
+        self.assertEqual(r.status_code, 302)
+        self.assertTrue(r["Location"].endswith(f"/{self.version}/en/"))
+        self.assertIn("public", r["Cache-Control"])
+        self.assertTrue(de["Location"].endswith(f"/{self.version}/de/"))
+        self.assertEqual(en.status_code, 200)
+        self.assertIn("immutable", en["Cache-Control"])
+
+    def test_extern_change_changes_version(self):
+        user = Respondent()
+        Language.objects.create(
+            iso_639_1="de",
+            iso_639_2T="deu",
+            iso_639_2B="deu",
+            iso_639_3="deu",
+            name_en="German",
+        )
+        version = get_schema_version(self.asset)
+        etag = get_schema_etag(self.asset, "en", user)
+
+        # the languages fixture is reloaded with a changed row
+        language = Language.objects.get(iso_639_1="de")
+        language.name_en = "Deutsch"
+        language.save()
+
+        with stub_kobo(self.asset):
+            r = self.client.get(self.url, HTTP_ACCEPT_LANGUAGE="en")
+
+        self.assertNotEqual(get_schema_version(self.asset), version)
+        self.assertNotEqual(get_schema_etag(self.asset, "en", user), etag)
+        self.assertTrue(r["Location"].endswith(f"/{get_schema_version(self.asset)}/en/"))
+        self.assertNotIn(f"/{version}/", r["Location"])
+
+
+class LabelTableTestCase(TestCase):
+    def test_core_locale_resolution(self):
+        self.assertEqual(
+            translate_form_label("symptom_cough", "de-DE"),
+            translate_form_label("symptom_cough", "de"),
+        )
+
+    def test_en_fallback(self):
+        with open(TRANSLATIONS_PATH) as fh:
+            translations = json.load(fh)
+
+        missing = [k for k in translations["en"] if k not in translations["de"]]
+
+        self.assertTrue(missing)
+        self.assertEqual(
+            translate_form_label(missing[0], "de"), translate_form_label(missing[0], "en")
+        )
+
+    def test_markdown_rendered(self):
+        self.assertEqual(
+            translate_form_label("covid_contact.yes_confirmed", "en"),
+            "Yes, <strong>confirmed</strong> COVID-19",
+        )
+
+    def test_missing_key(self):
+        self.assertEqual(translate_form_label("not.a.key", "en"), "")
+
+    def test_missing_keys_sampled(self):
+        translate_form_label("symptom_cough", "en")
+
+        with self.assertLogs("beatcovid.api.transformers", "DEBUG") as logs:
+            for n in range(transformers.MISSING_LABEL_LOG_EVERY * 2):
+                translate_form_label(f"not.a.key.{n}", "de-DE")
+
+        self.assertEqual(len(logs.output), 2)
+
+
+class ExternChoicesTestCase(TestCase):
+    def setUp(self):
+        clear_externs()
+        self.add_language("en", "eng", "English")
+        self.add_language("de", "deu", "German")
+
+    def add_language(self, iso, iso3, name):
+        Language.objects.create(
+            iso_639_1=iso, iso_639_2T=iso3, iso_639_2B=iso3, iso_639_3=iso3, name_en=name
+        )
+
+    def test_user_language_first(self):
+        choices = get_extern_choices("languages", "de-DE")
+
+        self.assertEqual(
+            [c["label"] for c in choices], ["German", "--", "English"],
+        )
+        self.assertIs(choices, get_extern_choices("languages", "de"))
+
+    def test_invalidated_by_other_process(self):
+        r = mock.MagicMock()
+        r.get.return_value = b"1"
+        externs._version_checked = None
+
+        with mock.patch.object(externs, "get_redis", return_value=r):
+            choices = get_extern_choices("languages", "en")
+
+            self.assertIs(get_extern_choices("languages", "en"), choices)
+
+            # another process loaded the fixture
+            r.get.return_value = b"2"
+            self.assertIs(get_extern_choices("languages", "en"), choices)
+
+            later = time.monotonic() + externs.VERSION_CHECK_INTERVAL
+
+            with mock.patch.object(externs.time, "monotonic", return_value=later):
+                self.assertIsNot(get_extern_choices("languages", "en"), choices)
+
+        self.assertEqual(r.get.call_count, 2)
+
+    def test_change_published(self):
+        r = mock.MagicMock()
+
+        with mock.patch.object(externs, "get_redis", return_value=r):
+            self.add_language("fr", "fra", "French")
+
+        r.incr.assert_called_with(externs.EXTERNS_VERSION_KEY)
+
+    def test_unknown_locales_share_list(self):
+        choices = get_extern_choices("languages", "xx-junk123")
+
+        self.assertEqual(choices[0]["label"], "--")
+        self.assertIs(choices, get_extern_choices("languages", "zz"))
+
+    def test_invalidated_on_change(self):
+        get_extern_choices("languages", "en")
+
+        self.add_language("fr", "fra", "French")
+
+        self.assertEqual(
+            [c["label"] for c in get_extern_choices("languages", "en")],
+            ["English", "--", "French", "German"],
+        )
+
+    def test_unknown_extern(self):
+        self.assertIsNone(get_extern_choices("not_an_extern", "en"))
+
+    def test_countries_opt_in(self):
+        self.assertIsNone(get_extern_choices("countries", "en-AU"))
+
+        with override_settings(EXTERNS=["languages", "countries"]):
+            externs.register_default_externs()
+
+        self.addCleanup(externs._extern_sources.pop, "countries")
+        self.addCleanup(clear_externs)
+
+        self.assertEqual(get_extern_choices("countries", "en-AU")[-1]["label"], "--")
+
+
+class BenchmarkTestCase(TestCase):
+    def test_benchmarks_run_offline(self):
+        results = run_benchmarks(iterations=1, locales=["en"])
+
+        self.assertIn("get_form_schema[stubbed kobo,en]", results)
+        self.assertEqual(
+            results["get_form_schema[stubbed kobo,en]"]["size"],
+            results["parse_kobo_json[warm,en]"]["size"],
+        )
+
+    def test_find_regressions(self):
+        baseline = {"case": {"p50": 1.0, "peak_kb": 10.0}}
+
+        self.assertEqual(
+            find_regressions({"case": {"p50": 1.2, "peak_kb": 10.0}}, baseline), []
+        )
+        self.assertEqual(
+            find_regressions({"case": {"p50": 2.0, "peak_kb": 10.0}}, baseline),
+            [("case", "p50", 1.0, 2.0)],
+        )
+
+
+class FastJSONTestCase(TestCase):
+    def test_render_matches_drf(self):
+        data = {
+            "last_login": datetime.datetime(
+                2020, 4, 1, 12, 30, 0, 123456, tzinfo=datetime.timezone.utc
+            ),
+            "date": datetime.date(2020, 4, 1),
+            "id": uuid.UUID("6f1c5f8e-0c2b-4d0e-9b1a-2a4c8e1f0d3b"),
+            "label": gettext_lazy("cough"),
+            "text": "caf\u00e9 \u2028",
+            1: [1.5, None, True],
+        }
+
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+        schema = parse_kobo_json(get_fixture("kobo_asset"), get_request(), Respondent())
+
+        self.assertEqual(FastJSONRenderer().render(schema), JSONRenderer().render(schema))
+
+    def test_render_indent(self):
+        self.assertEqual(
+            FastJSONRenderer().render({"a": 1}, "application/json; indent=2"),
+            b'{\n  "a": 1\n}',
+        )
+
+    def test_parse(self):
+        body = json.dumps(get_fixture("kobo_asset")["content"]).encode("utf-8")
+
+        self.assertEqual(
+            FastJSONParser().parse(io.BytesIO(body)), JSONParser().parse(io.BytesIO(body))
+        )
+
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b"{bad"))
+
+
+class CachedFormTestCase(TestCase):
+    def test_warm_schema_reads_cache_once(self):
+        asset = get_fixture("kobo_asset")
+        user = Respondent()
+
+        with stub_kobo(asset):
+            schema, etag = controllers.get_form_schema_conditional(
+                asset["name"], get_request(), user
+            )
+
+            with mock.patch.object(
+                controllers, "get_many", wraps=controllers.get_many
+            ) as get_many, mock.patch.object(
+                cache, "get_or_set_cache", wraps=cache.get_or_set_cache
+            ) as get_or_set_cache, mock.patch.object(
+                controllers.kobo, "get", wraps=controllers.kobo.get
+            ) as http_get:
+                warm_schema, warm_etag = controllers.get_form_schema_conditional(
+                    asset["name"], get_request(), user
+                )
+
+        self.assertEqual(warm_schema, schema)
+        self.assertEqual(warm_etag, etag)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(get_or_set_cache.call_count, 0)
+
+        # only the user's last submission is fetched
+        self.assertEqual(http_get.call_count, 1)
+        self.assertIn("api/v1/data/1", http_get.call_args[0][0])
+
+
+class FormIndexTestCase(TestCase):
+    def test_paginated_index(self):
+        asset = get_fixture("kobo_asset")
+        listing = {k: v for k, v in asset.items() if k != "content"}
+        pages = {
+            "http://kpi.test/assets/": {
+                "count": 3,
+                "next": "http://kpi.test/assets/?offset=2",
+                "results": [dict(listing, name="other", uid="other"), listing],
+            },
+            "http://kpi.test/assets/?offset=2": {
+                "count": 3,
+                "next": None,
+                "results": [dict(listing, name="block", asset_type="block")],
+            },
+            "http://kc.test/api/v1/forms": [
+                {"formid": 7, "id_string": asset["uid"]},
+                {"formid": 8, "id_string": "other"},
+            ],
+        }
+
+        def get(url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(pages[url]).encode("utf-8")
+            return response
+
+        with override_settings(
+            KOBO_FORM_SERVER="http://kpi.test/",
+            KOBO_FORM_TOKEN="test",
+            KOBOCAT_API="http://kc.test/",
+            KOBOCAT_CREDENTIALS="test",
+        ), mock.patch.object(controllers.kobo, "get", side_effect=get):
+            index = controllers.build_form_index()
+
+        self.assertEqual(set(index), {asset["name"], "other"})
+        self.assertEqual(
+            index[asset["name"]],
+            {
+                "uid": asset["uid"],
+                "pk": 7,
+                "version": asset["deployed_version_id"],
+                "date_modified": asset["date_modified"],
+            },
+        )
+
+    def test_lookups_use_index(self):
+        asset = get_fixture("kobo_asset")
+
+        with stub_kobo(asset):
+            self.assertEqual(controllers.get_form_pk_from_name(asset["name"]), 1)
+
+            with mock.patch.object(
+                controllers.kobo, "get", wraps=controllers.kobo.get
+            ) as http_get:
+                self.assertEqual(controllers.get_form_pk_from_name(asset["name"]), 1)
+                self.assertEqual(
+                    controllers.get_form_id_from_name(asset["name"]), asset["uid"]
+                )
+                self.assertIsNone(controllers.get_form_pk_from_name("not-a-form"))
+
+        self.assertEqual(http_get.call_count, 0)
+
+    def test_kobocat_down(self):
+        asset = get_fixture("kobo_asset")
+
+        with stub_kobo(asset):
+            stub_get = controllers.kobo.get
+
+            def get(url, **kwargs):
+                if url.startswith(settings.KOBOCAT_API):
+                    raise requests.ConnectionError("kobocat is down")
+                return stub_get(url, **kwargs)
+
+            with mock.patch.object(controllers.kobo, "get", side_effect=get):
+                self.assertEqual(
+                    controllers.get_form_id_from_name(asset["name"]), asset["uid"]
+                )
+                self.assertIsNone(controllers.get_form_pk_from_name(asset["name"]))
+                self.assertEqual(
+                    controllers.get_kobo_form_schema(asset["name"])["uid"], asset["uid"]
+                )
+
+
+class RefreshFormSchemasTestCase(TestCase):
+    def setUp(self):
+        self.asset = get_fixture("kobo_asset")
+
+    def test_refresh_warms_cache(self):
+        with stub_kobo(self.asset):
+            self.assertEqual(controllers.refresh_form_schemas(), [self.asset["name"]])
+
+            with mock.patch.object(
+                controllers.kobo, "get", wraps=controllers.kobo.get
+            ) as http_get:
+                form, form_pk, kobo_schema = controllers.get_cached_form(
+                    self.asset["name"]
+                )
+
+                self.assertEqual(form["uid"], self.asset["uid"])
+                self.assertEqual(form_pk, 1)
+                self.assertEqual(kobo_schema["uid"], self.asset["uid"])
+                self.assertEqual(http_get.call_count, 0)
+
+                # unchanged forms aren't fetched again
+                self.assertEqual(controllers.refresh_form_schemas(), [])
+                self.assertFalse(
+                    [
+                        c
+                        for c in http_get.call_args_list
+                        if c[0][0].endswith(self.asset["uid"])
+                    ]
+                )
+
+            controllers.kobo.asset = dict(
+                self.asset, date_modified="2030-01-01T00:00:00Z"
+            )
+
+            self.assertEqual(controllers.refresh_form_schemas(), [self.asset["name"]])
+            self.assertEqual(
+                controllers.get_cached_form(self.asset["name"])[2]["date_modified"],
+                "2030-01-01T00:00:00Z",
+            )
+
+    def test_form_server_down(self):
+        with stub_kobo(self.asset), mock.patch.object(
+            controllers.kobo, "get", side_effect=requests.ConnectionError()
+        ), mock.patch.object(controllers, "set_many") as set_many:
+            with self.assertRaises(requests.ConnectionError):
+                controllers.refresh_form_schemas()
+
+        self.assertEqual(set_many.call_count, 0)
+
+    def test_task(self):
+        huey = tasks.refresh_form_schemas_task.huey
+
+        with mock.patch.object(
+            huey, "put_if_empty", return_value=True
+        ), mock.patch.object(huey, "delete"), mock.patch.object(
+            tasks, "refresh_form_schemas", return_value=["form"]
+        ) as refresh_form_schemas:
+            tasks.refresh_form_schemas_task.call_local()
+
+        refresh_form_schemas.assert_called_once_with()
+
+
+class LocalCacheTestCase(TestCase):
+    def test_ttl(self):
+        local = cache.LocalCache(60, 1024)
+        local.set("get_form_schema", "form", {"a": 1}, 10)
+
+        self.assertEqual(local.get("get_form_schema", "form"), {"a": 1})
+
+        expired = cache.time.monotonic() + 61
+
+        with mock.patch.object(cache.time, "monotonic", return_value=expired):
+            self.assertIs(local.get("get_form_schema", "form"), cache.MISSING)
+
+        self.assertEqual(local.size, 0)
+
+    def test_size_bound(self):
+        local = cache.LocalCache(60, 100)
+        local.set("n", "a", "a", 40)
+        local.set("n", "b", "b", 40)
+        local.get("n", "a")
+        local.set("n", "c", "c", 40)
+
+        # b was least recently used
+        self.assertIs(local.get("n", "b"), cache.MISSING)
+        self.assertEqual(local.get("n", "a"), "a")
+        self.assertEqual(local.size, 80)
+
+        local.set("n", "d", "d", 101)
+        self.assertIs(local.get("n", "d"), cache.MISSING)
+
+    def test_evict(self):
+        local = cache.LocalCache(60, 1024)
+        local.set("n", "a", "a", 1)
+        local.set("n", "b", "b", 1)
+        local.set("m", "a", "a", 1)
+
+        generation = local.generation
+        local.evict("n", "a")
+
+        self.assertIs(local.get("n", "a"), cache.MISSING)
+        self.assertEqual(local.get("n", "b"), "b")
+
+        # a read that started before the eviction is not stored
+        local.set("n", "a", "stale", 1, generation)
+        self.assertIs(local.get("n", "a"), cache.MISSING)
+
+        local.evict("n")
+        self.assertIs(local.get("n", "b"), cache.MISSING)
+        self.assertEqual(local.get("m", "a"), "a")
+
+    def test_handle_invalidation(self):
+        local = cache.LocalCache(60, 1024)
+        local.set("n", "a", "a", 1)
+
+        cache.handle_invalidation(local, json.dumps([cache._sender_id, "n", "a"]))
+        self.assertEqual(local.get("n", "a"), "a")
+
+        cache.handle_invalidation(local, json.dumps(["other", "n", "a"]))
+        self.assertIs(local.get("n", "a"), cache.MISSING)
+
+
+class CacheEntryTestCase(TestCase):
+    def test_ttl(self):
+        with self.settings(CACHE_TTLS={"get_form_schema": 5}):
+            self.assertEqual(cache.get_ttl("get_form_schema"), 5)
+            self.assertEqual(cache.get_ttl("get_form_schema", 1), 1)
+            self.assertEqual(cache.get_ttl("other"), cache.CACHE_TTL)
+
+    def test_entry_expiry(self):
+        serialised, _ = cache.serialise_entry("get_form_schema", {"a": 1}, 1)
+        value, expires_in, _ = cache.deserialise_entry("get_form_schema", serialised)
+
+        self.assertEqual(value, {"a": 1})
+        self.assertTrue(55 < expires_in <= 60)
+
+        serialised, _ = cache.serialise_entry("get_form_schema", {"a": 1}, -1)
+        value, expires_in, _ = cache.deserialise_entry("get_form_schema", serialised)
+
+        # stale entries keep their value
+        self.assertEqual(value, {"a": 1})
+        self.assertLess(expires_in, 0)
+
+        self.assertEqual(
+            cache.deserialise_entry("get_form_schema", None), (False, None, 0)
+        )
+
+    def test_codecs(self):
+        asset = get_fixture("kobo_asset")
+        entries = []
+
+        for codec in cache.CODECS:
+            for compression in [""] + list(cache.COMPRESSORS):
+                with self.settings(
+                    CACHE_CODEC=codec,
+                    CACHE_COMPRESSION=compression,
+                    CACHE_COMPRESS_MIN_BYTES=4096,
+                ):
+                    entries.append(cache.serialise_entry("get_form_schema", asset, 1))
+                    small, size = cache.serialise_entry("get_form_pk_from_name", 12, 1)
+
+                    # below the threshold values are not compressed
+                    self.assertEqual(len(small), cache._entry_header.size + size)
+
+        # entries decode whichever codec the reader is configured with, pickled
+        # ones only if it is configured for pickle
+        for serialised, size in entries:
+            with self.settings(CACHE_CODEC="pickle"):
+                value, _, decoded_size = cache.deserialise_entry(
+                    "get_form_schema", serialised
+                )
+
+            self.assertEqual(value, asset)
+            self.assertEqual(decoded_size, size)
+
+    def test_pickle_opt_in(self):
+        with self.settings(CACHE_CODEC="pickle"):
+            serialised, _ = cache.serialise_entry("get_form_schema", {"a": 1}, 1)
+
+        self.assertNotEqual(cache.get_codec()[0], cache.CODECS["pickle"][0])
+        self.assertEqual(
+            cache.deserialise_entry("get_form_schema", serialised), (False, None, 0)
+        )
+
+
+class CachedDecoratorTestCase(TestCase):
+    def test_key_includes_defaults(self):
+        @cache.cached("test_cached")
+        def get_count(form_name="beatcovid19now"):
+            return 1
+
+        with mock.patch.object(cache, "get_or_set_cache") as get_or_set_cache:
+            get_count()
+            get_count("beatcovid19now")
+            get_count(form_name="other")
+
+        keys = [c[0][1] for c in get_or_set_cache.call_args_list]
+
+        self.assertEqual(keys, ["beatcovid19now", "beatcovid19now", "other"])
+
+        # the compute callable calls the undecorated function
+        self.assertEqual(get_or_set_cache.call_args[0][2](), 1)
+
+
+@override_settings(CACHE_L1_TTL=0, CACHE_LOCK_TIMEOUT=1)
+class GetOrSetCacheTestCase(TestCase):
+    def setUp(self):
+        self.redis = mock.MagicMock()
+        self.lock = self.redis.lock.return_value
+        self.compute = mock.Mock(return_value="new")
+
+        patcher = mock.patch.object(cache, "get_redis", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def entry(self, value, ttl):
+        return cache.serialise_entry("test_cache", value, ttl)[0]
+
+    def test_fresh(self):
+        self.redis.mget.return_value = [self.entry("cached", 5)]
+
+        value = cache.get_or_set_cache("test_cache", "k", self.compute)
+
+        self.assertEqual(value, "cached")
+        self.compute.assert_not_called()
+        self.redis.lock.assert_not_called()
+
+    def test_lock_holder_computes(self):
+        self.redis.mget.return_value = [None]
+        self.lock.acquire.return_value = True
+
+        value = cache.get_or_set_cache("test_cache", "k", self.compute)
+
+        self.assertEqual(value, "new")
+        self.compute.assert_called_once_with()
+        self.redis.lock.assert_called_once_with("lock:test_cache:k", timeout=1)
+        self.lock.acquire.assert_called_once_with(blocking=False)
+        self.lock.release.assert_called_once_with()
+
+        # the computed value is written back
+        pipe = self.redis.pipeline.return_value
+        self.assertEqual(pipe.set.call_args[0][0], "test_cache:k")
+
+    def test_lock_released_on_error(self):
+        self.redis.mget.return_value = [None]
+        self.lock.acquire.return_value = True
+        self.compute.side_effect = ValueError
+
+        with self.assertRaises(ValueError):
+            cache.get_or_set_cache("test_cache", "k", self.compute)
+
+        self.lock.release.assert_called_once_with()
+
+    def test_stale_while_locked(self):
+        self.redis.mget.return_value = [self.entry("old", -1)]
+        self.lock.acquire.return_value = False
+
+        value = cache.get_or_set_cache("test_cache", "k", self.compute)
+
+        self.assertEqual(value, "old")
+        self.compute.assert_not_called()
+        self.lock.locked.assert_not_called()
+
+    def test_waits_for_lock_holder(self):
+        self.redis.mget.side_effect = [[None], [self.entry("theirs", 5)]]
+        self.lock.acquire.return_value = False
+        self.lock.locked.side_effect = [True, False]
+
+        with mock.patch.object(cache.time, "sleep") as sleep:
+            value = cache.get_or_set_cache("test_cache", "k", self.compute)
+
+        self.assertEqual(value, "theirs")
+        self.compute.assert_not_called()
+        sleep.assert_called_once()
+
+    def test_computes_after_lock_timeout(self):
+        self.redis.mget.return_value = [None]
+        self.lock.acquire.return_value = False
+        self.lock.locked.return_value = True
+        clock = iter(range(100))
+
+        with mock.patch.object(cache.time, "sleep"), mock.patch.object(
+            cache.time, "monotonic", side_effect=lambda: next(clock)
+        ):
+            value = cache.get_or_set_cache("test_cache", "k", self.compute)
+
+        self.assertEqual(value, "new")
+        # gave up waiting once CACHE_LOCK_TIMEOUT passed
+        self.compute.assert_called_once_with()
+
+    def test_stale_refreshed_in_background(self):
+        self.redis.mget.return_value = [self.entry("old", -1)]
+        # the refresh marker is only set by the first caller
+        self.redis.set.side_effect = [True, None]
+        refresh = mock.Mock()
+
+        for _ in range(2):
+            value = cache.get_or_set_cache(
+                "test_cache", "k", self.compute, refresh=refresh
+            )
+            self.assertEqual(value, "old")
+
+        refresh.assert_called_once_with()
+        self.compute.assert_not_called()
+        self.redis.lock.assert_not_called()
+        self.redis.set.assert_called_with("refresh:test_cache:k", 1, nx=True, ex=1)
+
+    def test_failed_refresh_clears_marker(self):
+        self.redis.mget.return_value = [self.entry("old", -1)]
+        self.redis.set.return_value = True
+        refresh = mock.Mock(side_effect=Exception("queue down"))
+
+        value = cache.get_or_set_cache("test_cache", "k", self.compute, refresh=refresh)
+
+        self.assertEqual(value, "old")
+        self.redis.delete.assert_called_once_with("refresh:test_cache:k")
+
+    def test_missing_blocks_on_compute(self):
+        self.redis.mget.return_value = [None]
+        self.lock.acquire.return_value = True
+        refresh = mock.Mock()
+
+        value = cache.get_or_set_cache("test_cache", "k", self.compute, refresh=refresh)
+
+        self.assertEqual(value, "new")
+        self.compute.assert_called_once_with()
+        refresh.assert_not_called()
+
+    def test_cached_enqueues_refresh(self):
+        @cache.cached("test_cache")
+        def get_value(form_name):
+            return "new"
+
+        self.redis.mget.return_value = [self.entry("old", -1)]
+        self.redis.set.return_value = True
+
+        with mock.patch.object(cache, "refresh_cache_task") as refresh_cache_task:
+            self.assertEqual(get_value("beatcovid19now"), "old")
+
+        refresh_cache_task.assert_called_once_with("test_cache", ("beatcovid19now",))
+
+        # the task stores the new value and clears the marker
+        self.assertEqual(cache.refresh_cached("test_cache", ("beatcovid19now",)), "new")
+        pipe = self.redis.pipeline.return_value
+        self.assertEqual(pipe.set.call_args[0][0], "test_cache:beatcovid19now")
+        self.redis.delete.assert_called_once_with("refresh:test_cache:beatcovid19now")
+
+
+class CacheMetricsTestCase(TestCase):
+    def test_flush_and_render(self):
+        metrics = CacheMetrics()
+        metrics.count("get_form_schema", "hit")
+        metrics.count("get_form_schema", "hit")
+        metrics.count("get_form_schema", "miss")
+        metrics.observe("get_form_schema", "get", 0.0002)
+        metrics.observe("get_form_schema", "get", 0.003)
+        metrics.observe("get_form_schema", "get", 5)
+
+        stats = collections.defaultdict(dict)
+
+        class Pipe:
+            def hincrby(self, key, field, n):
+                stats[key][field] = stats[key].get(field, 0) + n
+
+            hincrbyfloat = hincrby
+
+        metrics.flush(Pipe(), cache.get_stats_key)
+
+        self.assertEqual(metrics.counts, {})
+
+        stats = {name[len(cache.get_stats_key("")) :]: s for name, s in stats.items()}
+        text = render_prometheus(stats)
+
+        self.assertIn(
+            'beatcovid_cache_requests_total{cache="get_form_schema",result="hit"} 2', text
+        )
+        self.assertIn(
+            'beatcovid_cache_get_seconds_bucket{cache="get_form_schema",le="0.0005"} 1',
+            text,
+        )
+        self.assertIn(
+            'beatcovid_cache_get_seconds_bucket{cache="get_form_schema",le="0.005"} 2',
+            text,
+        )
+        self.assertIn(
+            'beatcovid_cache_get_seconds_bucket{cache="get_form_schema",le="+Inf"} 3',
+            text,
+        )
+        self.assertIn(
+            'beatcovid_cache_get_seconds_count{cache="get_form_schema"} 3', text
+        )
+
+    def test_admin_only(self):
+        response = self.client.get("/api/admin/metrics/", HTTP_HOST="localhost")
+
+        self.assertIn(response.status_code, [401, 403])
+
+
+class KoboClientTestCase(TestCase):
+    def setUp(self):
+        self.kobo = KoboClient(retries=2, retry_backoff=0, failure_threshold=2)
+
+    def response(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return response
+
+    def test_get_retried(self):
+        with mock.patch.object(
+            requests.Session,
+            "request",
+            side_effect=[
+                requests.ConnectionError(),
+                self.response(503),
+                self.response(200),
+            ],
+        ) as request:
+            response = self.kobo.get("http://kpi.test/assets/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(request.call_args[1]["timeout"], self.kobo.timeout)
+
+    def test_post_not_retried(self):
+        with mock.patch.object(
+            requests.Session, "request", side_effect=requests.ConnectionError()
+        ) as request:
+            with self.assertRaises(requests.ConnectionError):
+                self.kobo.post("http://kc.test/api/v1/submissions", json={})
+
+        self.assertEqual(request.call_count, 1)
+
+    def test_circuit_breaker(self):
+        with mock.patch.object(
+            requests.Session, "request", side_effect=requests.Timeout()
+        ) as request:
+            for _ in range(2):
+                with self.assertRaises(requests.Timeout):
+                    self.kobo.get("http://kpi.test/assets/")
+
+            self.assertEqual(request.call_count, 6)
+
+            with self.assertRaises(CircuitOpenError):
+                self.kobo.get("http://kpi.test/assets/x")
+
+            self.assertEqual(request.call_count, 6)
+
+        # other hosts are unaffected
+        with mock.patch.object(
+            requests.Session, "request", return_value=self.response(200)
+        ):
+            self.assertEqual(self.kobo.get("http://kc.test/").status_code, 200)
+
+        breaker = self.kobo.get_breaker("kpi.test")
+        breaker.opened -= breaker.reset_timeout
+
+        # one trial request closes the circuit again
+        with mock.patch.object(
+            requests.Session, "request", return_value=self.response(200)
+        ):
+            self.assertEqual(self.kobo.get("http://kpi.test/assets/").status_code, 200)
+            self.assertEqual(self.kobo.get("http://kpi.test/assets/").status_code, 200)
+
+    def test_trial_released_on_any_error(self):
+        breaker = self.kobo.get_breaker("kpi.test")
+        breaker.opened = time.monotonic() - breaker.reset_timeout
+        breaker.failures = 2
+
+        with mock.patch.object(requests.Session, "request", side_effect=ValueError()):
+            with self.assertRaises(ValueError):
+                self.kobo.get("http://kpi.test/assets/")
+
+        self.assertFalse(breaker.trial)
+
+        breaker.opened -= breaker.reset_timeout
+
+        with mock.patch.object(
+            requests.Session, "request", return_value=self.response(200)
+        ):
+            self.assertEqual(self.kobo.get("http://kpi.test/assets/").status_code, 200)
+
+    def test_concurrent_gets_coalesced(self):
+        release = threading.Event()
+        responses = []
+
+        def request(*args, **kwargs):
+            release.wait()
+            return self.response(200)
+
+        def get():
+            responses.append(
+                self.kobo.get(
+                    "http://kpi.test/assets/", params={"q": "asset_type:survey"}
+                )
+            )
+
+        with mock.patch.object(requests.Session, "request", side_effect=request) as r:
+            threads = [threading.Thread(target=get) for _ in range(5)]
+
+            for t in threads:
+                t.start()
+
+            # let every thread join the call in flight
+            time.sleep(0.1)
+            release.set()
+
+            for t in threads:
+                t.join()
+
+            self.assertEqual(r.call_count, 1)
+            self.assertEqual(len(responses), 5)
+            self.assertEqual(len({id(r) for r in responses}), 1)
+
+            # a later call makes its own request
+            self.kobo.get("http://kpi.test/assets/", params={"q": "asset_type:survey"})
+            self.assertEqual(r.call_count, 2)
+
+    def test_gets_coalesced_across_processes(self):
+        self.kobo.coalesce_redis = True
+        shared = self.response(200)
+        shared._content = b"[]"
+        shared.headers["Content-Type"] = "application/json"
+        shared.request = requests.Request(
+            "GET", "http://kpi.test/assets/", headers={"Authorization": "Token secret"}
+        ).prepare()
+
+        r = mock.MagicMock()
+        r.lock.return_value.acquire.return_value = False
+        r.lock.return_value.locked.return_value = False
+        r.get.return_value = serialise_response(shared)
+
+        with mock.patch.object(cache, "get_redis", return_value=r), mock.patch.object(
+            requests.Session, "request"
+        ) as request:
+            response = self.kobo.get("http://kpi.test/assets/")
+
+        self.assertEqual(request.call_count, 0)
+        self.assertEqual(response.json(), [])
+        self.assertEqual(response.headers["content-type"], "application/json")
+
+        # the process holding the lock shares its response
+        r.lock.return_value.acquire.return_value = True
+
+        with mock.patch.object(cache, "get_redis", return_value=r), mock.patch.object(
+            requests.Session, "request", return_value=shared
+        ) as request:
+            self.kobo.get("http://kpi.test/assets/")
+
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(r.set.call_args[1]["ex"], self.kobo.coalesce_ttl)
+
+        # the request and its credentials aren't shared
+        self.assertNotIn(b"secret", r.set.call_args[0][1])
+        r.lock.return_value.release.assert_called_once()
+
+
+@override_settings(KOBOCAT_API="http://kc.test/", KOBOCAT_CREDENTIALS="test")
+class AsyncKoboClientTestCase(TestCase):
+    def setUp(self):
+        self.akobo = AsyncKoboClient(retries=2, retry_backoff=0, failure_threshold=2)
+        self.requests = []
+
+    def mock_client(self, *responses):
+        """ patches the httpx client to answer with responses in turn """
+        responses = list(responses)
+
+        def handler(request):
+            self.requests.append(request)
+            response = responses.pop(0)
+
+            if isinstance(response, Exception):
+                raise response
+
+            return response
+
+        return self.patch_client(handler)
+
+    def patch_client(self, handler):
+        """ patches the httpx client to answer with handler """
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        return mock.patch.object(
+            AsyncKoboClient, "get_client", mock.AsyncMock(return_value=client)
+        )
+
+    def test_get_retried(self):
+        with self.mock_client(
+            httpx.ConnectError("refused"), httpx.Response(503), httpx.Response(200)
+        ):
+            response = asyncio.run(self.akobo.get("http://kpi.test/assets/"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.requests), 3)
+
+    def test_post_not_retried(self):
+        with self.mock_client(httpx.ConnectError("refused")):
+            with self.assertRaises(httpx.ConnectError):
+                asyncio.run(self.akobo.post("http://kc.test/api/v1/submissions", json={}))
+
+        self.assertEqual(len(self.requests), 1)
+
+    def test_circuit_breaker(self):
+        with self.mock_client(*[httpx.ReadTimeout("timeout")] * 6):
+            for _ in range(2):
+                with self.assertRaises(httpx.ReadTimeout):
+                    asyncio.run(self.akobo.get("http://kpi.test/assets/"))
+
+            with self.assertRaises(CircuitOpenError):
+                asyncio.run(self.akobo.get("http://kpi.test/assets/"))
+
+        self.assertEqual(len(self.requests), 6)
+
+    def test_client_closed_with_loop(self):
+        async def get_clients():
+            return await self.akobo.get_client(), await self.akobo.get_client()
+
+        first, again = asyncio.run(get_clients())
+        second, _ = asyncio.run(get_clients())
+
+        self.assertIs(first, again)
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed)
+        self.assertTrue(second.is_closed)
+        self.assertEqual(self.akobo._clients, {})
+
+    def test_cancelled_trial_released(self):
+        breaker = self.akobo.get_breaker("kc.test")
+        breaker.opened = time.monotonic() - breaker.reset_timeout
+        breaker.failures = 2
+
+        async def handler(request):
+            self.requests.append(request)
+            await asyncio.sleep(10)
+
+        async def cancel_post():
+            task = asyncio.ensure_future(
+                self.akobo.post("http://kc.test/api/v1/submissions", json={})
+            )
+            await asyncio.sleep(0.01)
+            task.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with self.patch_client(handler):
+            asyncio.run(cancel_post())
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertFalse(breaker.trial)
+
+    def test_concurrent_gets_coalesced(self):
+        async def handler(request):
+            self.requests.append(request)
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json=[])
+
+        async def get_all():
+            return await asyncio.gather(
+                *[self.akobo.get("http://kpi.test/assets/") for _ in range(5)]
+            )
+
+        with self.patch_client(handler):
+            responses = asyncio.run(get_all())
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual([r.json() for r in responses], [[]] * 5)
+
+    def test_user_submissions(self):
+        user = Respondent.objects.create()
+        submissions = [
+            {"user_id": str(user.id), "_id": 2, "_xform_id_string": "beatcovid19now"},
+            {"user_id": str(user.id), "_id": 1, "_xform_id_string": "beatcovid19now"},
+        ]
+
+        with self.mock_client(httpx.Response(200, json=submissions)), mock.patch.object(
+            controllers, "akobo", self.akobo
+        ), mock.patch.object(controllers, "get_form_pk_from_name", return_value=1):
+            result = asyncio.run(
+                controllers.get_user_submissions_async("beatcovid19now", user)
+            )
+
+        self.assertEqual(result, [{"user_id": str(user.id), "_id": i} for i in [2, 1]])
+        self.assertEqual(self.requests[0].url.path, "/api/v1/data/1")
+        self.assertIn(str(user.id), self.requests[0].url.params["query"])
+
+    @skipUnless(django.VERSION >= (3, 1), "async views need Django 3.1")
+    def test_async_view(self):
+        request = RequestFactory().get("/api/user/submissions/")
+        request.session = SessionStore()
+
+        with self.mock_client(httpx.Response(200, json=[])), mock.patch.object(
+            controllers, "akobo", self.akobo
+        ), mock.patch.object(controllers, "get_form_pk_from_name", return_value=1):
+            response = async_to_sync(views.UserSubmissionViewAsync)(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), [])
+
+        request = RequestFactory().post("/api/user/submissions/")
+        response = async_to_sync(views.UserSubmissionViewAsync)(request)
+
+        self.assertEqual(response.status_code, 405)
+
+
+class KoboStandinTestCase(TestCase):
+    def setUp(self):
+        self.server = make_standin_server(port=0, latency=0.02)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}
+        )
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_query_submissions(self):
+        submissions = [
+            {"_id": 1, "user_id": "a", "_submission_time": "2020-05-01"},
+            {"_id": 2, "user_id": "b", "_submission_time": "2020-05-03"},
+            {"_id": 3, "user_id": "a", "_submission_time": "2020-05-02"},
+        ]
+
+        def query(**params):
+            return query_submissions(
+                submissions, {k: json.dumps(v) for k, v in params.items()}
+            )
+
+        self.assertEqual(query(query={"user_id": "a"}, count=1), {"count": 2})
+        self.assertEqual(
+            [s["_id"] for s in query(query={}, sort={"_submission_time": -1}, limit=2)],
+            [2, 3],
+        )
+        self.assertEqual(
+            [
+                s["_id"]
+                for s in query(query={"_id": {"$in": [1, 2]}, "user_id": {"$ne": "b"}})
+            ],
+            [1],
+        )
+
+    def test_forms_by_id_string(self):
+        asset = get_fixture("kobo_asset")
+        store = self.server.RequestHandlerClass.store
+        store.forms.append({"formid": 2, "id_string": "other", "title": "Other"})
+
+        def get_forms(**params):
+            return requests.get(f"{self.base_url}api/v1/forms", params=params).json()
+
+        self.assertEqual([f["formid"] for f in get_forms()], [1, 2])
+        self.assertEqual([f["formid"] for f in get_forms(id_string="other")], [2])
+        self.assertEqual([f["formid"] for f in get_forms(id_string=asset["uid"])], [1])
+        self.assertEqual(get_forms(id_string="missing"), [])
+
+    def test_controllers_against_standin(self):
+        asset = get_fixture("kobo_asset")
+        user = Respondent.objects.create()
+
+        with override_settings(
+            KOBO_FORM_SERVER=self.base_url,
+            KOBO_FORM_TOKEN="test",
+            KOBOCAT_API=self.base_url,
+            KOBOCAT_CREDENTIALS="test",
+        ):
+            started = time.monotonic()
+            index = controllers.build_form_index()
+
+            self.assertGreaterEqual(time.monotonic() - started, 0.04)
+            self.assertEqual(index[asset["name"]]["pk"], 1)
+            self.assertEqual(index[asset["name"]]["uid"], asset["uid"])
+
+            self.assertEqual(
+                controllers.get_submission_data(asset["name"], {}, count=1, form_pk=1),
+                {"count": len(self.server.RequestHandlerClass.store.data[1])},
+            )
+
+            response = requests.post(
+                f"{self.base_url}api/v1/submissions",
+                json={
+                    "id": asset["uid"],
+                    "submission": {"user_id": str(user.id)},
+                    "meta": {"instanceID": "uuid:test"},
+                },
+            )
+
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(
+                controllers.get_user_last_submission(asset["name"], user, 1)["_uuid"],
+                "test",
+            )
+
+
+@override_settings(
+    KOBOCAT_API="http://kc.test/", KOBOCAT_CREDENTIALS="test", SUBMISSION_QUEUE=True
+)
+class SubmissionQueueTestCase(TestCase):
+    def response(self, status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = b"{}"
+        return response
+
+    def queue(self, n):
+        for _ in range(n):
+            controllers.queue_submission(
+                "aBcDeFgHiJkLmNoPqRsTuV",
+                {
+                    "id": "aBcDeFgHiJkLmNoPqRsTuV",
+                    "meta": {"instanceID": f"uuid:{uuid.uuid4()}"},
+                },
+            )
+
+    def test_submit_acknowledged_without_kobo(self):
+        user = Respondent.objects.create()
+        request = get_request()
+        request.session = SessionStore()
+        request.META["HTTP_USER_AGENT"] = "Mozilla/5.0"
+
+        with mock.patch.object(
+            controllers, "get_form_id_from_name", return_value="aBcDeFgHiJkLmNoPqRsTuV"
+        ), mock.patch.object(controllers.kobo, "post") as post:
+            result = controllers.submit_form("beatcovid19now", {"a": "1"}, user, request)
+
+        self.assertEqual(post.call_count, 0)
+
+        submission = QueuedSubmission.objects.get()
+        parcel = json.loads(submission.parcel)
+
+        self.assertEqual(result["instanceID"], f"uuid:{submission.instance_id}")
+        self.assertEqual(parcel["meta"]["instanceID"], result["instanceID"])
+        self.assertEqual(parcel["submission"]["user_id"], str(user.id))
+        self.assertEqual(submission.status, QueuedSubmission.PENDING)
+
+    def test_forward_batch(self):
+        self.queue(4)
+
+        with mock.patch.object(
+            controllers.kobo,
+            "post",
+            side_effect=[
+                self.response(201),
+                self.response(202),
+                self.response(503),
+                self.response(400),
+            ],
+        ) as post:
+            sent, remaining = controllers.forward_submissions()
+
+        self.assertEqual((sent, remaining), (2, 0))
+        self.assertEqual(post.call_count, 4)
+
+        statuses = list(
+            QueuedSubmission.objects.order_by("id").values_list("status", "attempts")
+        )
+
+        self.assertEqual(
+            statuses,
+            [
+                (QueuedSubmission.SENT, 1),
+                (QueuedSubmission.SENT, 1),
+                (QueuedSubmission.PENDING, 1),
+                (QueuedSubmission.FAILED, 1),
+            ],
+        )
+
+        retry = QueuedSubmission.objects.get(status=QueuedSubmission.PENDING)
+
+        self.assertGreater(retry.next_attempt_at, timezone.now())
+        self.assertEqual(retry.last_error, "503 {}")
+
+        # not due yet
+        with mock.patch.object(controllers.kobo, "post") as post:
+            self.assertEqual(controllers.forward_submissions(), (0, 0))
+
+        self.assertEqual(post.call_count, 0)
+
+        stats = controllers.get_submission_queue_stats()
+
+        self.assertEqual((stats["pending"], stats["failed"]), (1, 1))
+        self.assertIn(
+            'beatcovid_submission_queue_depth{status="pending"} 1',
+            controllers.render_submission_queue_metrics(stats),
+        )
+
+    def test_batches_continue(self):
+        self.queue(3)
+        forward_submissions_task = tasks.forward_submissions_task
+
+        with override_settings(SUBMISSION_BATCH_SIZE=2), mock.patch.object(
+            controllers.kobo, "post", return_value=self.response(201)
+        ) as post, mock.patch.object(
+            tasks, "forward_submissions_task", wraps=forward_submissions_task.call_local
+        ) as task:
+            forward_submissions_task.call_local()
+
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(task.call_count, 1)
+        self.assertFalse(QueuedSubmission.objects.exclude(status=QueuedSubmission.SENT))
+
+    def test_circuit_open_stops_batch(self):
+        self.queue(2)
+
+        with mock.patch.object(
+            controllers.kobo, "post", side_effect=CircuitOpenError()
+        ) as post:
+            self.assertEqual(controllers.forward_submissions(), (0, 0))
+
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(
+            list(QueuedSubmission.objects.values_list("status", "attempts")),
+            [(QueuedSubmission.PENDING, 0)] * 2,
+        )
+
+    def test_purge_sent(self):
+        self.queue(4)
+        now = timezone.now()
+        old, recent, failed, pending = QueuedSubmission.objects.order_by("id")
+
+        for submission, status, sent_at in [
+            (old, QueuedSubmission.SENT, now - datetime.timedelta(days=8)),
+            (recent, QueuedSubmission.SENT, now - datetime.timedelta(days=1)),
+            (failed, QueuedSubmission.FAILED, None),
+        ]:
+            submission.status = status
+            submission.sent_at = sent_at
+            submission.save()
+
+        with override_settings(SUBMISSION_RETENTION_DAYS=7):
+            tasks.purge_sent_submissions_task.call_local()
+
+        self.assertEqual(
+            set(QueuedSubmission.objects.values_list("pk", flat=True)),
+            {recent.pk, failed.pk, pending.pk},
+        )
+        self.assertEqual(controllers.purge_sent_submissions(days=0), 1)
+
+
+class FakeMongoCursor:
+    """ the cursor methods get_submission_data_mongo uses """
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, keys):
+        return FakeMongoCursor(sort_submissions(self.documents, dict(keys)))
+
+    def limit(self, limit):
+        return FakeMongoCursor(self.documents[:limit])
+
+    def __iter__(self):
+        return iter(self.documents)
+
+
+class FakeMongoCollection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.filters = []
+
+    def matching(self, _filter):
+        self.filters.append(_filter)
+        return [d for d in self.documents if match_query(d, _filter)]
+
+    def find(self, _filter, projection):
+        return FakeMongoCursor(
+            [
+                {k: v for k, v in d.items() if projection.get(k, True)}
+                for d in self.matching(_filter)
+            ]
+        )
+
+    def count_documents(self, _filter):
+        return len(self.matching(_filter))
+
+
+class MongoSubmissionsTestCase(TestCase):
+    def setUp(self):
+        self.asset = get_fixture("kobo_asset")
+        self.user = Respondent(id=uuid.uuid4())
+        self.submissions = [
+            {
+                "_id": n,
+                "_uuid": str(uuid.uuid4()),
+                "_submission_time": f"2020-04-0{n}T10:00:00",
+                "_xform_id_string": self.asset["uid"],
+                "_userform_id": f"beatcovid_{self.asset['uid']}",
+                "_deleted_at": None,
+                "_attachments": [],
+                "_notes": [],
+                "_media_count": 0,
+                "user_id": str(self.user.id) if n != 3 else "other",
+                "today": f"04/0{n}/2020 10:00:00",
+                "cough": "mild",
+            }
+            for n in range(1, 6)
+        ]
+        self.submissions.append(
+            dict(self.submissions[0], _id=6, _xform_id_string="other")
+        )
+        self.submissions.append(
+            dict(self.submissions[0], _id=7, _deleted_at="2020-04-08T10:00:00")
+        )
+
+    def get_kobocat(self, call):
+        """
+            runs call with kobocat answering as it would from the same
+            documents, 6 and 7 are another form's and deleted
+        """
+        query = controllers.get_user_submissions_query(self.user)
+        params = {
+            "query": json.dumps(dict(query["query"], _id={"$lt": 6})),
+            "sort": json.dumps(query["sort"]),
+        }
+
+        with stub_kobo(self.asset, query_submissions(self.submissions, params)):
+            return call()
+
+    def get_mongo(self, call):
+        collection = FakeMongoCollection(self.submissions)
+
+        with stub_kobo(self.asset), override_settings(
+            SUBMISSIONS_FROM_MONGO=True
+        ), mock.patch.object(controllers, "get_mongo_db", return_value=collection):
+            return call(), collection
+
+    def test_user_submissions_match_kobocat(self):
+        call = lambda: controllers.get_user_submissions(self.asset["name"], self.user)
+        kobocat = self.get_kobocat(call)
+        mongo, collection = self.get_mongo(call)
+
+        self.assertEqual(mongo, kobocat)
+        self.assertEqual([s["_id"] for s in mongo], [5, 4, 2, 1])
+        self.assertEqual(mongo[0]["today"], "2020-04-05T10:00:00")
+        self.assertEqual(
+            collection.filters,
+            [
+                {
+                    "user_id": str(self.user.id),
+                    "_xform_id_string": self.asset["uid"],
+                    "_deleted_at": None,
+                }
+            ],
+        )
+
+    def test_last_submission_and_count(self):
+        call = lambda: controllers.get_user_last_submission(self.asset["name"], self.user)
+        last, _ = self.get_mongo(call)
+
+        self.assertEqual(last["_id"], 5)
+        self.assertNotIn("_notes", last)
+
+        call = lambda: controllers.get_submission_data(self.asset["name"], {}, count=1)
+        count, _ = self.get_mongo(call)
+
+        self.assertEqual(count, {"count": 5})
+
+    def test_mongo_error(self):
+        with stub_kobo(self.asset), override_settings(
+            SUBMISSIONS_FROM_MONGO=True
+        ), mock.patch.object(
+            controllers, "get_mongo_db", side_effect=Exception("No mongo")
+        ):
+            self.assertIsNone(
+                controllers.get_user_submissions(self.asset["name"], self.user)
+            )
+
+
+@override_settings(MONGO_HOST="mongodb://127.0.0.1/beatcovid", MONGO_MAX_POOL_SIZE=7)
+class MongoClientTestCase(TestCase):
+    def setUp(self):
+        mongo._client_pid = None
+        self.addCleanup(setattr, mongo, "_client_pid", None)
+
+    def test_client_shared_per_process(self):
+        client = mongo.get_mongo()
+
+        self.assertIs(mongo.get_mongo(), client)
+        self.assertEqual(client.max_pool_size, 7)
+        self.assertEqual(client.read_preference.mongos_mode, "primary")
+
+        collection = mongo.get_mongo_db()
+
+        self.assertIs(mongo.get_mongo_db(), collection)
+        self.assertEqual(collection.full_name, "beatcovid.instances")
+
+        with mock.patch.object(mongo.os, "getpid", return_value=-1):
+            forked = mongo.get_mongo()
+
+            self.assertIsNot(forked, client)
+            self.assertIsNot(mongo.get_mongo_db(), collection)
+
+    def test_pool_metrics(self):
+        mongo.get_mongo()
+
+        for event in ["connection_created"] * 2 + ["connection_checked_out"]:
+            getattr(mongo.pool_metrics, event)(None)
+
+        text = mongo.render_mongo_pool_metrics()
+
+        self.assertIn('beatcovid_mongo_connections{state="open"} 2', text)
+        self.assertIn('beatcovid_mongo_connections{state="in_use"} 1', text)
+        self.assertIn(
+            'beatcovid_mongo_connection_events_total{event="checkouts"} 1', text
+        )
@@ -1,18 +1,51 @@
+import collections
+import functools
+import hashlib
 import html
 import json
 import logging
 import os
 import re
+import threading
 
-import markdown
-from django.utils.translation import get_language_from_request
+from beatcovid.intl.bundle import get_translations_digest, open_bundle
+
+from .externs import get_extern_choices, get_extern_top_values, get_externs_version
 
 logger = logging.getLogger(__name__)
 
+TRANSLATIONS_PATH = os.path.join(os.path.dirname(__file__), "translations.json")
+
+# pre-rendered labels written by translate_survey
+TRANSLATIONS_BUNDLE_PATH = os.path.join(os.path.dirname(__file__), "translations.bundle")
+
 translations = None
 
-with open(os.path.join(os.path.dirname(__file__), "translations.json")) as fh:
-    translations = json.load(fh)
+# rendered labels keyed by locale then translation key, loaded on first use
+label_table = None
+_label_table_lock = threading.Lock()
+
+# hex sha1 of the translations.json the label table was built from
+translations_version = None
+
+MARKDOWN_EXTENSIONS = ["pymdownx.emoji", "pymdownx.smartsymbols", "extra"]
+
+# bound for the memo of labels rendered outside the label table
+LABEL_MEMO_SIZE = 1024
+
+# only every this many missing translation keys are logged
+MISSING_LABEL_LOG_EVERY = 100
+
+_missing_labels = 0
+
+# compiled, user independent schemas keyed by asset version and locale
+SCHEMA_TEMPLATE_CACHE_SIZE = 64
+
+_schema_templates = collections.OrderedDict()
+_schema_templates_lock = threading.Lock()
+
+# Markdown instances are not thread safe so keep one per thread
+_markdown = threading.local()
 
 
 def _strip_outer_tags(s):
@@ -24,26 +57,41 @@ def _strip_outer_tags(s):
     return s[start:end]
 
 
-def parse_form_label(label, language_index=0):
-    if type(label) is list:
-        label = "".join(label)
+def _get_markdown():
+    if not hasattr(_markdown, "md"):
+        # only needed when there is no translation bundle
+        import markdown
+
+        _markdown.md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+
+    return _markdown.md
 
-    if not label:
-        return ""
 
+def _render_label(label):
     _output = label.replace("\n", "")
 
     _output = html.unescape(_output)
 
-    _output = markdown.markdown(
-        _output, extensions=["pymdownx.emoji", "pymdownx.smartsymbols", "extra"]
-    )
+    _output = _get_markdown().reset().convert(_output)
 
     _output = _strip_outer_tags(_output)
 
     return _output
 
 
+_render_label_memo = functools.lru_cache(maxsize=LABEL_MEMO_SIZE)(_render_label)
+
+
+def parse_form_label(label, language_index=0):
+    if type(label) is list:
+        label = "".join(label)
+
+    if not label:
+        return ""
+
+    return _render_label_memo(label)
+
+
 def get_core_language_from_locale(locale):
     if "-" in locale:
         return locale.split("-", 1)[0]
@@ -52,35 +100,162 @@ def get_core_language_from_locale(locale):
     return locale
 
 
-def translate_form_label(key, locale="en"):
+def build_label_table(translations):
+    """
+        Renders every translation key for every locale, with missing keys
+        falling back to the en label. Identical strings are only rendered
+        once.
+    """
+    rendered = {}
+    table = {}
+
+    for locale in translations:
+        messages = dict(translations["en"])
+        messages.update(translations[locale])
+
+        for label in messages.values():
+            if label not in rendered:
+                rendered[label] = parse_form_label(label) if label else ""
+
+        table[locale] = {k: rendered[v] for k, v in messages.items()}
+
+    return table
+
+
+def set_label_table(table, digest):
+    global label_table, translations_version
+
+    label_table = table
+    translations_version = digest.hex()
+    resolve_translation_locale.cache_clear()
+
+    # compiled schemas hold labels from the previous translations
+    with _schema_templates_lock:
+        _schema_templates.clear()
+
+
+def load_translations(translations_path):
+    """ loads and renders translations.json without the bundle """
+    global translations
+
+    with open(translations_path) as fh:
+        translations = json.load(fh)
+
+    set_label_table(
+        build_label_table(translations), get_translations_digest(translations_path)
+    )
+
+
+def get_label_table():
+    """
+        Returns the label table, memory mapping the translation bundle on
+        first use. Falls back to rendering translations.json if there is
+        no bundle or it was built from a different translations.json
+    """
+    if label_table is None:
+        with _label_table_lock:
+            if label_table is None:
+                bundle = open_bundle(TRANSLATIONS_BUNDLE_PATH, TRANSLATIONS_PATH)
+
+                if bundle:
+                    set_label_table(bundle, bundle.digest)
+                else:
+                    logger.info("No translation bundle, rendering translations.json")
+                    load_translations(TRANSLATIONS_PATH)
+
+    return label_table
+
+
+def get_supported_locales():
+    """ the translated locales as request language codes, ie. ar-eg """
+    return [locale.replace("_", "-") for locale in get_label_table().keys()]
+
+
+def get_translations_version():
+    get_label_table()
+
+    return translations_version
+
+
+@functools.lru_cache(maxsize=256)
+def resolve_translation_locale(locale):
+    """ maps a request locale onto a locale in the translations """
     locale = locale.replace("-", "_")
+    table = get_label_table()
 
-    if not locale in translations:
-        _k = translations.keys()
-        # logger.debug(f"Trying core locale since {locale} not found in {_k}")
+    if not locale in table:
+        # logger.debug(f"Trying core locale since {locale} not found")
         locale = get_core_language_from_locale(locale)
 
-    if not locale in translations:
+    if not locale in table:
         # logger.debug(f"falling back to default locale since {locale} not found")
         locale = "en"
 
-    translation = translations[locale]
+    return locale
 
-    if not key in translation:
-        if key in translations["en"]:
-            label_translated = translations["en"][key]
-        else:
-            logger.debug("Could not find key {} in translations".format(key))
-            return ""
-    else:
-        label_translated = translation[key]
 
-    label_translated_parsed = parse_form_label(label_translated)
+def get_canonical_locale(locale):
+    """ the supported locale a request locale is translated to, ie. ar-eg """
+    return resolve_translation_locale((locale or "en").lower()).replace("_", "-")
+
+
+def log_missing_label(key):
+    """ compiling a schema looks up its missing keys for every locale, so sample them """
+    global _missing_labels
+
+    _missing_labels += 1
+
+    if _missing_labels % MISSING_LABEL_LOG_EVERY == 1:
+        logger.debug(
+            f"Could not find key {key} in translations, {_missing_labels} missing so far"
+        )
+
+
+def translate_form_label(key, locale="en"):
+    table = get_label_table()[resolve_translation_locale(locale)]
+    label = table.get(key, None)
+
+    if label is None:
+        log_missing_label(key)
+        return ""
+
+    return label
+
+
+def build_choice_index(choices):
+    """ groups the asset choices by their list name """
+    index = collections.defaultdict(list)
+
+    for i in choices:
+        index[i["list_name"]].append(i)
 
-    return label_translated_parsed
+    return index
 
 
-def _parse_question(si, choices, request, user_language):
+def build_choice_lists(choices, user_language):
+    """
+        Translates each choice list once so select questions sharing a
+        list only need to attach their question id
+    """
+    choice_lists = {}
+
+    for list_name, c in build_choice_index(choices).items():
+        choice_lists[list_name] = [
+            {
+                "value": i["name"],
+                "key": "{}.{}".format(list_name, i["name"]),
+                "label": translate_form_label(
+                    "{}.{}".format(list_name, i["name"]), user_language
+                ),
+            }
+            for i in c
+            if "name" in i
+        ]
+
+    return choice_lists
+
+
+def _parse_question(si, choice_lists, user_language):
     q = {"id": si["$kuid"]}
 
     mapped_fields = [
@@ -110,68 +285,42 @@ def _parse_question(si, choices, request, user_language):
 
     # load externs
     if "extern" in si and (si["extern"] == True or si["extern"].lower() == "true"):
-        q["choices"] = load_externs(si["select_from_list_name"], request)
+        q["choices"] = load_externs(si["select_from_list_name"], user_language)
 
     # only load choices if it's not an extern
     elif "select_from_list_name" in si:
-        c = list(filter(lambda d: d["list_name"] == si["select_from_list_name"], choices))
-        c = [
-            {
-                "id": si["name"],
-                "value": i["name"],
-                "key": "{}.{}".format(i["list_name"], i["name"]),
-                "label": translate_form_label(
-                    "{}.{}".format(i["list_name"], i["name"]), user_language
-                ),
-            }
-            for i in c
-            if "name" in si and "name" in i
-        ]
+        c = choice_lists.get(si["select_from_list_name"], [])
+        c = [dict(id=si["name"], **i) for i in c if "name" in si]
         q["choices"] = c
 
     return q
 
 
-def load_externs(list_name, request):
-    if list_name == "languages":
-        from languages_plus.models import Language
-
-        languages = []
-        languages_top = []
-
-        user_language = get_language_from_request(request)
-
-        if not user_language:
-            user_language = "en"
+def load_externs(list_name, user_language):
+    return get_extern_choices(list_name, user_language)
 
-        for l in Language.objects.all():
-            if l.iso_639_1 == user_language[:2]:
-                languages_top.append(
-                    {"id": "languages", "value": l.iso_639_1, "label": l.name_en}
-                )
-            else:
-                languages.append(
-                    {"id": "languages", "value": l.iso_639_1, "label": l.name_en}
-                )
 
-        languages_top.append({"id": "languages", "value": None, "label": "--"})
-
-        return languages_top + languages
+def get_schema_template_key(form_json, user_language):
+    """
+        the asset uid, version, translation locale and the extern values
+        listed first uniquely identify a compiled schema. Request locales
+        that compile to the same schema share the key
+    """
+    return (
+        form_json["uid"],
+        form_json["version_count"],
+        form_json["date_modified"],
+        resolve_translation_locale(user_language or "en"),
+        get_extern_top_values(user_language),
+    )
 
 
-def parse_kobo_json(form_json, request, user, last_submission=None):
+def compile_kobo_json(form_json, user_language):
     """
-        Takes JSON form output from KOBO and translates it into
-        something more useful we can use in our clients. preference
-        is to do it here on the server to make it consistent for all
-        client rather than messing about with managing the JSON on the
-        client.
-
-        @TODO write unit tests
+        Builds everything in the parsed schema that does not depend on
+        the respondent - the survey steps, globals and label map. The
+        per-user fields are spliced in by parse_kobo_json
     """
-    if not user or not user.id:
-        logger.error("did not receive a user id when transforming form")
-
     _json = form_json
     choices = []
 
@@ -180,22 +329,13 @@ def parse_kobo_json(form_json, request, user, last_submission=None):
 
     survey = _json["content"]["survey"]
 
-    user_language = request.LANGUAGE_CODE
-
-    user_id = str(user.id)
+    choice_lists = build_choice_lists(choices, user_language)
 
     _output = {
         "uid": _json["uid"],
         "name": _json["name"],
         "url": _json["url"],
-        "user": {
-            "id": user_id,
-            "language": user_language,
-            # "country": user_locale,
-            "submission": user.submissions,
-            "last_login": user.last_login,
-            "first_login": user.created_at,
-        },
+        "user": None,
         "date_created": _json["date_created"],
         "summary": _json["summary"],
         "date_modified": _json["date_modified"],
@@ -231,34 +371,175 @@ def parse_kobo_json(form_json, request, user, last_submission=None):
         elif in_step:
             if "retain" in si:
                 retained.append(si["name"])
-            q = _parse_question(si, choices, request, user_language)
+            q = _parse_question(si, choice_lists, user_language)
 
             if "name" in q and "label" in q:
-                _label_map[q["name"]] = translate_form_label(si["name"], user_language)
+                _label_map[q["name"]] = q["label"]
 
             step["questions"].append(q)
         else:
-            _global = _parse_question(si, choices, request, user_language)
+            _global = _parse_question(si, choice_lists, user_language)
+            _globals.append(_global)
+
+    _output["survey"] = {"global": _globals, "steps": steps}
+    _output["labels"] = _label_map
 
-            if _global["name"] == "user_id" and user_id:
-                _global["calculation"] = user_id
-                _global["required"] = True
+    return {"schema": _output, "retained": retained}
 
-            _globals.append(_global)
+
+def get_compiled_schema(form_json, user_language):
+    """
+        Returns the compiled schema for this asset version and locale,
+        compiling it on first use. Compiled schemas are shared between
+        requests so must not be mutated.
+    """
+    key = get_schema_template_key(form_json, user_language)
+
+    with _schema_templates_lock:
+        if key in _schema_templates:
+            _schema_templates.move_to_end(key)
+            return _schema_templates[key]
+
+    logger.debug("Compiling schema template for {}".format(key))
+
+    compiled = compile_kobo_json(form_json, user_language)
+
+    with _schema_templates_lock:
+        _schema_templates[key] = compiled
+
+        while len(_schema_templates) > SCHEMA_TEMPLATE_CACHE_SIZE:
+            _schema_templates.popitem(last=False)
+
+    return compiled
+
+
+def clear_compiled_schemas():
+    with _schema_templates_lock:
+        _schema_templates.clear()
+
+
+def get_retained_submission(compiled, last_submission):
+    """ the values from the last submission the survey retains between submissions """
+    if not last_submission:
+        return {}
+
+    return {k: last_submission[k] for k in compiled["retained"] if k in last_submission}
+
+
+def get_schema_etag(form_json, user_language, user, last_submission=None, variant=""):
+    """
+        Strong ETag for the output of parse_kobo_json. Covers everything the
+        output is built from - the asset version, locale, translations,
+        externs, the user block and the retained last submission values - so a match
+        means the schema does not have to be parsed. variant distinguishes
+        different renderings of the same schema.
+    """
+    compiled = get_compiled_schema(form_json, user_language)
+
+    parts = [
+        get_schema_template_key(form_json, user_language),
+        user_language,
+        get_translations_version(),
+        get_externs_version(),
+        str(user.id),
+        user.submissions,
+        user.last_login,
+        user.created_at,
+        get_retained_submission(compiled, last_submission),
+        variant,
+    ]
+
+    digest = hashlib.sha1(
+        json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+    return f'"{digest}"'
+
+
+def get_schema_version(form_json):
+    """
+        Identifies the content of the static schema for every locale -
+        changes whenever the asset, the translations or the externs change
+    """
+    parts = [
+        form_json["uid"],
+        form_json["version_count"],
+        form_json["date_modified"],
+        get_translations_version(),
+        get_externs_version(),
+    ]
+
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def get_static_schema(form_json, user_language):
+    """
+        The user independent schema for a locale. Clients fill in the
+        user_id calculation from the user block (see get_user_schema)
+    """
+    compiled = get_compiled_schema(form_json, user_language)
+
+    return {k: v for k, v in compiled["schema"].items() if k != "user"}
+
+
+def get_user_schema(form_json, user_language, user, last_submission=None):
+    """ the per respondent block of the schema """
+    compiled = get_compiled_schema(form_json, user_language)
+
+    user_block = {
+        "id": str(user.id),
+        "language": user_language,
+        # "country": user_locale,
+        "submission": user.submissions,
+        "last_login": user.last_login,
+        "first_login": user.created_at,
+    }
 
     # filter last submission
-    if last_submission:
-        _l = {k: last_submission[k] for k in retained if k in last_submission}
-    else:
-        _l = {}
+    _l = get_retained_submission(compiled, last_submission)
 
     # attach if it contains values
     if len(list(_l.keys())):
-        _output["user"]["last_submission"] = _l
+        user_block["last_submission"] = _l
     else:
-        _output["user"]["last_submission"] = False
+        user_block["last_submission"] = False
 
-    _output["survey"] = {"global": _globals, "steps": steps}
-    _output["labels"] = _label_map
+    return user_block
+
+
+def parse_kobo_json(form_json, request, user, last_submission=None):
+    """
+        Takes JSON form output from KOBO and translates it into
+        something more useful we can use in our clients. preference
+        is to do it here on the server to make it consistent for all
+        client rather than messing about with managing the JSON on the
+        client.
+
+        The static part of the schema is compiled once per asset version
+        and locale (see get_compiled_schema) and only the user block and
+        user_id calculation are filled in here.
+    """
+    if not user or not user.id:
+        logger.error("did not receive a user id when transforming form")
+
+    user_language = request.LANGUAGE_CODE
+
+    user_id = str(user.id)
+
+    compiled = get_compiled_schema(form_json, user_language)
+
+    _output = dict(compiled["schema"])
+
+    _output["user"] = get_user_schema(form_json, user_language, user, last_submission)
+
+    _globals = []
+
+    for _global in _output["survey"]["global"]:
+        if _global["name"] == "user_id" and user_id:
+            _global = dict(_global, calculation=user_id, required=True)
+
+        _globals.append(_global)
+
+    _output["survey"] = {"global": _globals, "steps": _output["survey"]["steps"]}
 
     return _output
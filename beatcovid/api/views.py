@@ -4,32 +4,60 @@ import logging
 import re
 import uuid
 
+from asgiref.sync import sync_to_async
 from django.db.models import Avg, Count, F
-from django.http import Http404, HttpResponseBadRequest
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags
 from django.utils.translation import get_language_from_request
 from django.utils.translation import ugettext as _
 from django.views.decorators.cache import cache_page
 from rest_framework import generics, permissions, status, viewsets
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ParseError
+from rest_framework.decorators import (
+    api_view,
+    authentication_classes,
+    permission_classes,
+    renderer_classes,
+)
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
+from beatcovid.core.cache import flush_metrics, get_cache_stats
+from beatcovid.core.metrics import PROMETHEUS_CONTENT_TYPE, render_prometheus
+from beatcovid.core.mongo import render_mongo_pool_metrics
+from beatcovid.core.renderers import FastJSONRenderer
+from beatcovid.core.views import async_api_view, json_response, parse_json_body
 from beatcovid.respondent.controllers import get_user_from_request
 
 from .controllers import (
-    get_form_schema,
+    get_form_schema_conditional,
+    get_form_schema_conditional_async,
+    get_form_schema_static,
+    get_form_schema_user,
     get_stats,
     get_submission_data,
+    get_submission_queue_stats,
     get_submission_stats,
     get_user_submissions,
+    get_user_submissions_async,
+    render_submission_queue_metrics,
     submit_form,
+    submit_form_async,
 )
+from .transformers import get_canonical_locale
 
 logger = logging.getLogger(__name__)
 
 # valid KOBO form names
 _clean_form_name = re.compile("[^a-zA-Z\-\_0-9]")
+_clean_locale = re.compile("[^a-zA-Z\-\_]")
+
+# versioned static schemas never change
+STATIC_SCHEMA_MAX_AGE = 60 * 60 * 24 * 365
 
 
 @api_view(["POST"])
@@ -54,18 +82,151 @@ def FormSubmission(request, form_name):
     return Response(result)
 
 
+@async_api_view(["POST"])
+async def FormSubmissionAsync(request, form_name):
+    user = await sync_to_async(get_user_from_request, thread_sensitive=True)(request)
+
+    try:
+        submission = parse_json_body(request)
+    except ParseError as e:
+        return json_response({"detail": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+
+    if "user_id" in submission:
+        submitted_user = submission["user_id"]
+        if submitted_user != str(user.id):
+            logger.info(
+                f"Mismatch error: User is {user.id} while submitted is {submitted_user} "
+            )
+
+    result = await submit_form_async(form_name, submission, user, request)
+
+    if not result:
+        raise Http404
+
+    return json_response(result)
+
+
 @api_view(["GET"])
 def FormSchema(request, form_name):
     user = get_user_from_request(request)
     form_name = _clean_form_name.sub("", form_name)
 
+    if_none_match = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+
     # @TODO avoid prop drilling request down
-    result = get_form_schema(form_name, request, user)
+    result, etag = get_form_schema_conditional(form_name, request, user, if_none_match)
+
+    if not etag:
+        raise Http404
+
+    if result is None:
+        r = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        r = Response(result)
+
+    r["ETag"] = etag
+    r["Cache-Control"] = "private, no-cache"
+
+    return r
+
+
+@async_api_view(["GET"])
+async def FormSchemaAsync(request, form_name):
+    user = await sync_to_async(get_user_from_request, thread_sensitive=True)(request)
+    form_name = _clean_form_name.sub("", form_name)
+
+    if_none_match = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+
+    result, etag = await get_form_schema_conditional_async(
+        form_name, request, user, if_none_match
+    )
+
+    if not etag:
+        raise Http404
+
+    if result is None:
+        r = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        r = json_response(result)
+
+    r["ETag"] = etag
+    r["Cache-Control"] = "private, no-cache"
+
+    return r
+
+
+def get_static_schema_url(form_name, version, locale):
+    return reverse(
+        "form-schema-static",
+        kwargs={"form_name": form_name, "version": version, "locale": locale},
+    )
+
+
+@api_view(["GET"])
+@authentication_classes([])
+@renderer_classes([FastJSONRenderer])
+def FormSchemaStatic(request, form_name, version=None, locale=None):
+    """
+        The user independent part of the form schema. Versioned URLs are
+        immutable and publicly cacheable, anything else redirects to the
+        current version in a supported locale. Doesn't authenticate so the
+        session is never touched and the response doesn't vary on cookies.
+    """
+    form_name = _clean_form_name.sub("", form_name)
+    canonical_locale = get_canonical_locale(
+        _clean_locale.sub("", locale or request.LANGUAGE_CODE)
+    )
+
+    result, current_version = get_form_schema_static(form_name, canonical_locale)
 
     if not result:
         raise Http404
 
-    return Response(result)
+    if version != current_version or locale != canonical_locale:
+        r = redirect(get_static_schema_url(form_name, current_version, canonical_locale))
+
+        if locale:
+            r["Cache-Control"] = "public, max-age=60"
+        else:
+            # the locale was negotiated by LocaleMiddleware
+            r["Cache-Control"] = "private, max-age=60"
+            patch_vary_headers(r, ["Accept-Language", "Cookie", "X-Locale"])
+
+        return r
+
+    r = Response(result)
+    r["ETag"] = f'"{current_version}"'
+    r["Cache-Control"] = f"public, max-age={STATIC_SCHEMA_MAX_AGE}, immutable"
+
+    return r
+
+
+@api_view(["GET"])
+def FormSchemaUser(request, form_name):
+    """
+        The per user part of the form schema along with the URL of the
+        static schema it goes with. Clients set the user_id calculation
+        from user.id
+    """
+    user = get_user_from_request(request)
+    form_name = _clean_form_name.sub("", form_name)
+
+    result, version = get_form_schema_user(form_name, request, user)
+
+    if not result:
+        raise Http404
+
+    r = Response(
+        {
+            "user": result,
+            "schema": get_static_schema_url(
+                form_name, version, get_canonical_locale(result["language"])
+            ),
+        }
+    )
+    r["Cache-Control"] = "private, no-cache"
+
+    return r
 
 
 @api_view(["GET"])
@@ -96,6 +257,19 @@ def UserSubmissionView(request, form_name="beatcovid19now"):
     return Response(result)
 
 
+@async_api_view(["GET"])
+async def UserSubmissionViewAsync(request, form_name="beatcovid19now"):
+    form_name = _clean_form_name.sub("", form_name)
+    user = await sync_to_async(get_user_from_request, thread_sensitive=True)(request)
+
+    if not user:
+        raise Http404
+
+    result = await get_user_submissions_async(form_name, user)
+
+    return json_response(result)
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated, IsAdminUser])
 def FormData(request, form_name):
@@ -124,6 +298,23 @@ def FormData(request, form_name):
     return Response(result)
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def Metrics(request):
+    """
+        cache metrics of all workers, the submission queue and this worker's
+        mongo connection pool in Prometheus text format
+    """
+    flush_metrics()
+
+    return HttpResponse(
+        render_prometheus(get_cache_stats())
+        + render_submission_queue_metrics(get_submission_queue_stats())
+        + render_mongo_pool_metrics(),
+        content_type=PROMETHEUS_CONTENT_TYPE,
+    )
+
+
 @api_view(["GET"])
 def TranslationTest(request):
     result = {
@@ -1 +1 @@
-from .http_connection import http
+from .http_connection import akobo, http, kobo
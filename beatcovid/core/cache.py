@@ -1,13 +1,85 @@
+import collections
+import functools
+import inspect
 import json
 import logging
 import os
-from datetime import datetime, timedelta
+import pickle
+import struct
+import threading
+import time
+import uuid
+import zlib
+from datetime import timedelta
 
 import redis
 from django.conf import settings
+from huey.contrib.djhuey import db_task
+
+from .metrics import CacheMetrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 logger = logging.getLogger(__name__)
 
+# minutes entries are fresh for when CACHE_TTLS doesn't list their name
+CACHE_TTL = 15
+
+_redis = None
+_redis_lock = threading.Lock()
+
+# workers evict their in process copy of an entry when it is published here
+INVALIDATION_CHANNEL = "beatcovid:cache:invalidate"
+
+# seconds between reconnection attempts of the invalidation listener
+INVALIDATION_RETRY = 5
+
+MISSING = object()
+
+# name -> (function, ttl, stale_ttl) for functions decorated with cached
+_cached_functions = {}
+
+# codec id, compression id and expiry timestamp of an entry
+_entry_header = struct.Struct("<BBd")
+
+# name -> (id, dumps, loads). ids are stored with the entries, so entries
+# written with another CACHE_CODEC can still be read, apart from pickles
+CODECS = {
+    "json": (1, lambda v: json.dumps(v).encode("utf-8"), json.loads),
+    "pickle": (
+        2,
+        lambda v: pickle.dumps(v, min(5, pickle.HIGHEST_PROTOCOL)),
+        pickle.loads,
+    ),
+}
+
+if msgpack:
+    CODECS["msgpack"] = (3, msgpack.packb, msgpack.unpackb)
+
+COMPRESSORS = {
+    "zlib": (1, lambda b: zlib.compress(b, 1), zlib.decompress),
+}
+
+if lz4:
+    COMPRESSORS["lz4"] = (2, lz4.frame.compress, lz4.frame.decompress)
+
+_metrics = CacheMetrics()
+
+# counts are per process, a forked worker starts from zero
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_metrics.reset)
+
+_codecs_by_id = {c[0]: c for c in CODECS.values()}
+_compressors_by_id = {c[0]: c for c in COMPRESSORS.values()}
+
 
 def get_redis_url():
     redis_url = os.environ.get("REDIS_URL", default=None)
@@ -22,44 +94,652 @@ def get_redis_url():
 
 
 def get_redis():
-    r = redis.Redis.from_url(settings.REDIS_URL)
-    return r
+    """
+        Returns the process wide redis client. Its connection pool is
+        shared by all threads and is reset by redis-py in forked workers.
+    """
+    global _redis
 
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                pool = redis.ConnectionPool.from_url(
+                    get_redis_url(),
+                    max_connections=getattr(settings, "REDIS_MAX_CONNECTIONS", None),
+                    socket_timeout=getattr(settings, "REDIS_SOCKET_TIMEOUT", None),
+                )
+                _redis = redis.Redis(connection_pool=pool)
 
-def set_cache(name, key, value, ttl=None):
-    r = get_redis()
+    return _redis
+
+
+class LocalCache:
+    """
+        In process LRU of decoded cache values, bounded by the total size
+        of their serialised form and expiring entries after ttl seconds.
+        Values are shared between threads and must not be modified.
+    """
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # bumped on every eviction so a read that raced one isn't stored
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, name, key):
+        with self.lock:
+            entry = self.entries.get((name, key), None)
+
+            if entry is None:
+                return MISSING
+
+            expires, value, size = entry
+
+            if expires < time.monotonic():
+                self._remove((name, key))
+                return MISSING
+
+            self.entries.move_to_end((name, key))
+
+            return value
+
+    def set(self, name, key, value, size, generation=None, ttl=None):
+        if size > self.max_bytes:
+            return
+
+        ttl = min(ttl, self.ttl) if ttl else self.ttl
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._remove((name, key))
+            self.entries[(name, key)] = (time.monotonic() + ttl, value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def evict(self, name, key=None):
+        with self.lock:
+            self.generation += 1
+
+            if key is not None:
+                self._remove((name, key))
+                return
+
+            for k in [k for k in self.entries if k[0] == name]:
+                self._remove(k)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, k):
+        entry = self.entries.pop(k, None)
+
+        if entry:
+            self.size -= entry[2]
+
+
+_local = None
+_local_pid = None
+_local_lock = threading.Lock()
+_sender_id = None
+_subscribed = threading.Event()
+
+
+def get_local_cache():
+    """
+        Returns the in process cache, starting its invalidation listener
+        on first use in each process. None if CACHE_L1_TTL is 0 or while
+        the listener isn't subscribed, as entries could then go stale.
+    """
+    global _local, _local_pid, _sender_id, _subscribed
+
+    ttl = getattr(settings, "CACHE_L1_TTL", 0)
+
+    if not ttl:
+        return None
+
+    if _local_pid != os.getpid():
+        with _local_lock:
+            if _local_pid != os.getpid():
+                _local = LocalCache(ttl, settings.CACHE_L1_MAX_BYTES)
+                _sender_id = f"{os.getpid()}:{uuid.uuid4().hex}"
+                _subscribed = threading.Event()
+
+                threading.Thread(
+                    target=listen_invalidations,
+                    args=(_local, _subscribed),
+                    name="cache-invalidation",
+                    daemon=True,
+                ).start()
+
+                _local_pid = os.getpid()
 
-    serialised = None
+    if not _subscribed.is_set():
+        return None
+
+    return _local
+
+
+def listen_invalidations(local, subscribed):
+    """ evicts entries other processes published on INVALIDATION_CHANNEL """
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            subscribed.set()
+
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+
+                if message:
+                    handle_invalidation(local, message["data"])
+        except Exception as e:
+            logger.warning(f"Cache invalidation listener disconnected: {e}")
+
+        # invalidations may be missed until we are subscribed again
+        subscribed.clear()
+        local.clear()
 
+        time.sleep(INVALIDATION_RETRY)
+
+
+def handle_invalidation(local, data):
     try:
-        serialised = json.dumps(value)
+        sender, name, key = json.loads(data)
     except Exception:
-        logger.error(f"cache.get Error serializing for {name} {value}")
+        logger.error(f"Bad cache invalidation message {data}")
+        return
+
+    if sender != _sender_id:
+        local.evict(name, key)
+
+
+def publish_invalidation(pipe, name, key=None):
+    if getattr(settings, "CACHE_L1_TTL", 0):
+        pipe.publish(INVALIDATION_CHANNEL, json.dumps([_sender_id, name, key]))
+
+
+def get_cache_key(name, key):
+    return f"{name}:{key}"
+
+
+def get_ttl(name, ttl=None):
+    """
+        Minutes an entry of name is fresh for - ttl if given, else the
+        CACHE_TTLS setting for name, else CACHE_TTL
+    """
+    if ttl:
+        return ttl
+
+    return getattr(settings, "CACHE_TTLS", {}).get(name, CACHE_TTL)
+
+
+def get_codec():
+    codec = getattr(settings, "CACHE_CODEC", None) or ("msgpack" if msgpack else "json")
+
+    if codec not in CODECS:
+        raise Exception(
+            f"CACHE_CODEC {codec} is not available, use one of {list(CODECS)}"
+        )
+
+    return CODECS[codec]
+
+
+def get_compressor():
+    compression = getattr(settings, "CACHE_COMPRESSION", None)
+
+    if not compression:
         return None
 
-    success = r.hset(name, key, serialised)
+    if compression not in COMPRESSORS:
+        raise Exception(
+            f"CACHE_COMPRESSION {compression} is not available, "
+            f"use one of {list(COMPRESSORS)}"
+        )
 
-    if not ttl:
-        ttl = 15
+    return COMPRESSORS[compression]
 
-    ttl_dtime = timedelta(minutes=ttl)
-    r.expire(name, ttl_dtime)
 
-    return success
+def serialise_entry(name, value, ttl):
+    """
+        Encodes an entry as a header (codec, compression, expiry timestamp)
+        followed by the value, encoded with CACHE_CODEC and compressed with
+        CACHE_COMPRESSION if it is at least CACHE_COMPRESS_MIN_BYTES long
 
+        @returns (serialised entry, size of the value before compression)
+            or (None, 0)
+    """
+    codec_id, dumps, _ = get_codec()
 
-def get_cache(name, key):
-    r = get_redis()
+    try:
+        payload = dumps(value)
+    except Exception:
+        logger.error(f"cache.set Error serializing for {name} {value}")
+        return None, 0
+
+    size = len(payload)
+    compression_id = 0
+    compressor = get_compressor()
+
+    if compressor and size >= getattr(settings, "CACHE_COMPRESS_MIN_BYTES", 0):
+        compression_id, compress, _ = compressor
+        payload = compress(payload)
+
+    return (
+        _entry_header.pack(codec_id, compression_id, time.time() + ttl * 60) + payload,
+        size,
+    )
 
-    serialised = r.hget(name, key)
 
+def deserialise_entry(name, serialised):
+    """
+        @returns (value, seconds until the entry expires, size of the
+            value before compression) or (False, None, 0)
+    """
     if not serialised:
-        return False
+        return False, None, 0
 
     try:
-        value = json.loads(serialised)
+        codec_id, compression_id, expires = _entry_header.unpack_from(serialised)
+        payload = serialised[_entry_header.size :]
+
+        # loading a pickle runs code, only trust redis with them when asked to
+        if codec_id == CODECS["pickle"][0] and get_codec()[0] != codec_id:
+            logger.warning(
+                f"cache.get Not loading pickled {name}, CACHE_CODEC is not pickle"
+            )
+            return False, None, 0
+
+        if compression_id:
+            payload = _compressors_by_id[compression_id][2](payload)
+
+        value = _codecs_by_id[codec_id][2](payload)
     except Exception:
-        logger.error(f"cache.get Error deserializing for {name} {value}")
-        return None
+        logger.error(f"cache.get Error deserializing for {name} {serialised[:64]}")
+        return False, None, 0
+
+    return value, expires - time.time(), len(payload)
+
+
+def read_entries(items, local=None):
+    """
+        Reads entries, fresh or expired, in one round trip. Fresh values
+        are stored in the local cache for the rest of their lifetime.
+
+        @returns list of (value, seconds until expiry), negative once the
+            entry is stale and None if it is missing
+    """
+    if local:
+        generation = local.generation
+
+    entries = []
+    keys = [get_cache_key(name, key) for name, key in items]
+
+    for (name, key), serialised in zip(items, get_redis().mget(keys)):
+        value, expires_in, size = deserialise_entry(name, serialised)
+
+        if local and value and expires_in > 0:
+            local.set(name, key, value, size, generation, expires_in)
+
+        entries.append((value, expires_in))
+
+    return entries
+
+
+def write_entries(items, ttl=None, local=None, stale_ttl=None):
+    """
+        Writes (name, key, value) entries in one round trip. Redis keeps
+        each one stale_ttl (default CACHE_STALE_TTL) minutes past its
+        expiry so it can be served while it is recomputed.
+
+        @returns number of entries written
+    """
+    started = time.perf_counter()
+    pipe = get_redis().pipeline(transaction=False)
+    written = []
+
+    if stale_ttl is None:
+        stale_ttl = getattr(settings, "CACHE_STALE_TTL", 0)
+
+    for name, key, value in items:
+        entry_ttl = get_ttl(name, ttl)
+        serialised, size = serialise_entry(name, value, entry_ttl)
+
+        if serialised is None:
+            continue
+
+        pipe.set(
+            get_cache_key(name, key),
+            serialised,
+            ex=timedelta(minutes=entry_ttl + stale_ttl),
+        )
+        publish_invalidation(pipe, name, key)
+        record_size(pipe, name, len(serialised), size)
+        written.append((name, key, value, size, None, entry_ttl * 60))
+
+    if not written:
+        return 0
+
+    pipe.execute()
+
+    if local:
+        for entry in written:
+            local.set(*entry)
+
+    record_latency("set", [entry[0] for entry in written], started)
+
+    return len(written)
+
+
+def get_stats_key(name):
+    return f"cache:stats:{name}"
+
+
+def record_size(pipe, name, encoded_size, size):
+    """ accumulates the stored and uncompressed sizes written to name """
+    stats_key = get_stats_key(name)
+
+    pipe.hincrby(stats_key, "writes", 1)
+    pipe.hincrby(stats_key, "encoded_bytes", encoded_size)
+    pipe.hincrby(stats_key, "raw_bytes", size)
+    pipe.hset(stats_key, "last_encoded_bytes", encoded_size)
+
+
+def get_cache_stats(names=None):
+    """
+        @param names - cache names, defaults to every name with stats
+        @returns {name: {stat: value}}
+    """
+    r = get_redis()
+
+    if names is None:
+        prefix = get_stats_key("")
+        names = sorted(
+            k.decode("utf-8")[len(prefix) :] for k in r.scan_iter(match=f"{prefix}*")
+        )
+
+    pipe = r.pipeline(transaction=False)
+
+    for name in names:
+        pipe.hgetall(get_stats_key(name))
+
+    return {
+        name: {k.decode("utf-8"): parse_stat(v) for k, v in stats.items()}
+        for name, stats in zip(names, pipe.execute())
+    }
+
+
+def parse_stat(value):
+    value = value.decode("utf-8")
+
+    return float(value) if "." in value else int(value)
+
+
+def record_read(name, value, expires_in):
+    """ counts a read of name that wasn't in the local cache """
+    if expires_in is None:
+        _metrics.count(name, "miss")
+    elif expires_in > 0:
+        _metrics.count(name, "hit")
+    else:
+        _metrics.count(name, "stale")
+
+
+def record_latency(op, names, started):
+    elapsed = time.perf_counter() - started
+
+    for name in set(names):
+        _metrics.observe(name, op, elapsed)
+
+    if _metrics.due():
+        try:
+            flush_metrics()
+        except Exception as e:
+            logger.warning(f"Could not flush cache metrics: {e}")
+
+
+def flush_metrics():
+    """ adds this process's cache metrics to the totals in redis """
+    pipe = get_redis().pipeline(transaction=False)
+
+    if _metrics.flush(pipe, get_stats_key):
+        pipe.execute()
+
+
+def set_cache(name, key, value, ttl=None):
+    """
+        @param ttl - minutes the entry is fresh for, defaults to the
+            CACHE_TTLS setting for name
+    """
+    return write_entries([(name, key, value)], ttl, get_local_cache()) == 1
+
+
+def get_cache(name, key):
+    """ @returns the fresh value or False """
+    return get_many([(name, key)])[0]
+
+
+def get_many(items):
+    """
+        Reads several cache entries in one round trip
+
+        @param items - list of (name, key)
+        @returns list of fresh values in the same order, False for misses
+    """
+    if not items:
+        return []
+
+    started = time.perf_counter()
+    local = get_local_cache()
+    values = [MISSING] * len(items)
+    names = [name for name, _ in items]
+
+    if local:
+        values = [local.get(name, key) for name, key in items]
+
+    misses = [i for i, value in enumerate(values) if value is MISSING]
+
+    for i, value in enumerate(values):
+        if value is not MISSING:
+            _metrics.count(names[i], "local_hit")
+
+    if misses:
+        entries = read_entries([items[i] for i in misses], local)
+
+        for i, (value, expires_in) in zip(misses, entries):
+            values[i] = value if expires_in and expires_in > 0 else False
+            record_read(names[i], value, expires_in)
+
+    record_latency("get", names, started)
+
+    return values
+
+
+def set_many(items, ttl=None):
+    """
+        Writes several cache entries in one round trip
+
+        @param items - list of (name, key, value)
+        @returns number of entries written
+    """
+    return write_entries(items, ttl, get_local_cache())
+
+
+def get_or_set_cache(name, key, compute, ttl=None, stale_ttl=None, refresh=None):
+    """
+        Returns the cached value, calling compute() to fill a missing or
+        expired entry. A lock makes sure only one worker computes the
+        value, the others get the expired value if there is one or wait
+        for the new one. A result of None is not cached.
+
+        @param compute - callable returning the value
+        @param ttl - minutes the entry is fresh for
+        @param stale_ttl - minutes an expired entry is still served
+        @param refresh - callable that recomputes the entry in the
+            background. If given an expired entry is always served and
+            refresh is called once, by one worker, instead of compute
+    """
+    started = time.perf_counter()
+    local = get_local_cache()
+
+    if local:
+        value = local.get(name, key)
+
+        if value is not MISSING:
+            _metrics.count(name, "local_hit")
+            record_latency("get", [name], started)
+            return value
+
+    value, expires_in = read_entries([(name, key)], local)[0]
+
+    record_read(name, value, expires_in)
+    record_latency("get", [name], started)
+
+    if expires_in is not None and expires_in > 0:
+        return value
+
+    lock_timeout = getattr(settings, "CACHE_LOCK_TIMEOUT", 30)
+
+    if expires_in is not None and refresh:
+        refresh_key = f"refresh:{get_cache_key(name, key)}"
+
+        if get_redis().set(refresh_key, 1, nx=True, ex=lock_timeout):
+            try:
+                refresh()
+            except Exception as e:
+                logger.error(f"Could not refresh {name} {key}: {e}")
+                get_redis().delete(refresh_key)
+
+        return value
+
+    lock = get_redis().lock(f"lock:{get_cache_key(name, key)}", timeout=lock_timeout)
+
+    if lock.acquire(blocking=False):
+        try:
+            value = compute()
+
+            if value is not None:
+                write_entries([(name, key, value)], ttl, local, stale_ttl)
+
+            return value
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                logger.warning(f"Cache lock for {name} {key} expired while computing")
+
+    if expires_in is not None:
+        logger.debug(f"Serving stale {name} {key} while it is recomputed")
+        return value
+
+    deadline = time.monotonic() + lock_timeout
+
+    while lock.locked() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    value, expires_in = read_entries([(name, key)], local)[0]
+
+    if expires_in is not None and expires_in > 0:
+        return value
+
+    # the worker holding the lock failed or timed out
+    return compute()
+
+
+def invalidate_cache(name, key=None):
+    """
+        Deletes an entry, or every entry of name when key is None, from
+        redis and from the in process cache of every worker
+    """
+    local = get_local_cache()
+    r = get_redis()
+
+    if key is None:
+        keys = list(r.scan_iter(match=get_cache_key(name, "*")))
+    else:
+        keys = [get_cache_key(name, key)]
+
+    pipe = r.pipeline(transaction=False)
+
+    if keys:
+        pipe.delete(*keys)
+
+    publish_invalidation(pipe, name, key)
+    pipe.execute()
+
+    if local:
+        local.evict(name, key)
+
+
+def get_args_key(args):
+    return ":".join(str(arg) for arg in args)
+
+
+def cached(name, ttl=None, stale_ttl=None):
+    """
+        Caches the result of the decorated function under name, keyed by
+        its arguments, which must be strings or numbers.
+
+        Once ttl minutes pass the value is stale but is still returned
+        straight away while refresh_cache_task recomputes it. Callers only
+        wait on the function when there is no entry at all, stale_ttl
+        minutes after that. None results are not cached.
+
+        @param ttl - soft ttl, defaults to the CACHE_TTLS setting for name
+        @param stale_ttl - hard ttl past the soft one, defaults to
+            CACHE_STALE_TTL
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        _cached_functions[name] = (func, ttl, stale_ttl)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            args = bound.args
+
+            return get_or_set_cache(
+                name,
+                get_args_key(args),
+                lambda: func(*args),
+                ttl,
+                stale_ttl,
+                refresh=lambda: refresh_cache_task(name, args),
+            )
+
+        return wrapper
+
+    return decorator
+
+
+def refresh_cached(name, args):
+    """ recomputes the entry of a cached function and stores it """
+    func, ttl, stale_ttl = _cached_functions[name]
+    key = get_args_key(args)
+
+    try:
+        value = func(*args)
+
+        if value is not None:
+            write_entries([(name, key, value)], ttl, get_local_cache(), stale_ttl)
+    finally:
+        get_redis().delete(f"refresh:{get_cache_key(name, key)}")
 
     return value
+
+
+@db_task()
+def refresh_cache_task(name, args):
+    logger.debug(f"Refreshing {name} {args}")
+    refresh_cached(name, args)
@@ -0,0 +1,44 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+        The process wide thread pool for concurrent kobo requests. Forked
+        workers don't get the parent's threads so each process makes its own.
+    """
+    global _executor, _executor_pid
+
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "KOBO_FANOUT_WORKERS", 10),
+                    thread_name_prefix="kobo-fanout",
+                )
+                _executor_pid = os.getpid()
+
+    return _executor
+
+
+def run_concurrently(*calls):
+    """
+        Runs the callables at the same time, the first on the calling
+        thread and the rest on the thread pool. The callables must not use
+        the ORM, the pool threads don't get their connections closed.
+
+        @returns their results in order
+        @raises the exception of the first callable that raised, in order
+    """
+    futures = [get_executor().submit(call) for call in calls[1:]]
+
+    first = calls[0]()
+
+    return [first] + [f.result() for f in futures]
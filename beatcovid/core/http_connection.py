@@ -1,5 +1,25 @@
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import random
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import redis
 import requests as requestslib
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
 
 
 def get_connection_pool_option():
@@ -24,3 +44,502 @@ def get_connection():
 
 
 http = get_connection()
+
+
+# requests that are safe to send again
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+# gateway errors are retried, kobo returns these while it restarts
+RETRY_STATUSES = [502, 503, 504]
+
+RETRY_EXCEPTIONS = (
+    requestslib.exceptions.ConnectionError,
+    requestslib.exceptions.Timeout,
+    requestslib.exceptions.ChunkedEncodingError,
+)
+
+ASYNC_RETRY_EXCEPTIONS = (
+    (
+        httpx.ConnectError,
+        httpx.TimeoutException,
+        httpx.ReadError,
+        httpx.RemoteProtocolError,
+    )
+    if httpx
+    else ()
+)
+
+
+class CircuitOpenError(requestslib.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """
+        Opens after failure_threshold consecutive failed requests to a
+        host. While open requests fail straight away; after reset_timeout
+        seconds one trial request is let through, closing the circuit if
+        it succeeds.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+
+            if self.trial or time.monotonic() - self.opened < self.reset_timeout:
+                return False
+
+            self.trial = True
+
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+
+            if self.opened is not None or self.failures >= self.failure_threshold:
+                self.opened = time.monotonic()
+
+
+class SingleFlight:
+    """
+        Shares the result of a call between the threads that make it
+        concurrently, only the first caller of a key runs it
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def do(self, key, fn):
+        with self.lock:
+            # calls in flight when the process forked never finish here
+            if self.pid != os.getpid():
+                self.calls = {}
+                self.pid = os.getpid()
+
+            call = self.calls.get(key, None)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+
+        if not leader:
+            call.done.wait()
+
+            if call.error:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+            call.done.set()
+
+        return call.result
+
+
+def serialise_response(response):
+    """
+        The parts of a response other processes need. Not the response
+        itself, its request holds our credentials
+    """
+    return pickle.dumps(
+        (
+            response.status_code,
+            response.reason,
+            dict(response.headers),
+            response.content,
+            response.url,
+            response.encoding,
+        )
+    )
+
+
+def deserialise_response(serialised):
+    response = requestslib.Response()
+    (
+        response.status_code,
+        response.reason,
+        headers,
+        response._content,
+        response.url,
+        response.encoding,
+    ) = pickle.loads(serialised)
+    response.headers = requestslib.structures.CaseInsensitiveDict(headers)
+
+    return response
+
+
+class KoboClient:
+    """
+        HTTP client for the form server and kobocat. Connections are pooled
+        per host, requests have connect and read timeouts, idempotent
+        requests are retried with jittered backoff and a circuit breaker
+        per host fails requests fast while it is down.
+
+        Identical concurrent GETs share one request. With coalesce_redis
+        a redis lock extends that to every process: the process holding
+        it shares the response in redis for coalesce_ttl seconds.
+    """
+
+    def __init__(
+        self,
+        pool_size=None,
+        connect_timeout=None,
+        read_timeout=None,
+        retries=None,
+        retry_backoff=None,
+        failure_threshold=None,
+        reset_timeout=None,
+        coalesce=None,
+        coalesce_redis=None,
+        coalesce_ttl=None,
+    ):
+        self.pool_size = pool_size or getattr(settings, "KOBO_POOL_SIZE", 10)
+        self.timeout = (
+            connect_timeout or getattr(settings, "KOBO_CONNECT_TIMEOUT", 3.05),
+            read_timeout or getattr(settings, "KOBO_READ_TIMEOUT", 15),
+        )
+        self.retries = (
+            retries if retries is not None else getattr(settings, "KOBO_RETRIES", 2)
+        )
+        self.retry_backoff = (
+            retry_backoff
+            if retry_backoff is not None
+            else getattr(settings, "KOBO_RETRY_BACKOFF", 0.25)
+        )
+        self.failure_threshold = failure_threshold or getattr(
+            settings, "KOBO_CIRCUIT_FAILURES", 5
+        )
+        self.reset_timeout = reset_timeout or getattr(settings, "KOBO_CIRCUIT_RESET", 30)
+        self.coalesce = (
+            coalesce if coalesce is not None else getattr(settings, "KOBO_COALESCE", True)
+        )
+        self.coalesce_redis = (
+            coalesce_redis
+            if coalesce_redis is not None
+            else getattr(settings, "KOBO_COALESCE_REDIS", False)
+        )
+        self.coalesce_ttl = coalesce_ttl or getattr(settings, "KOBO_COALESCE_TTL", 5)
+
+        self.inflight = SingleFlight()
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        """ one session per process, pooled connections can't be shared by forks """
+        if self._pid != os.getpid():
+            with self.lock:
+                if self._pid != os.getpid():
+                    session = requestslib.Session()
+                    adapter = HTTPAdapter(pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+
+                    self._session = session
+                    self.breakers = {}
+                    self._pid = os.getpid()
+
+        return self._session
+
+    def get_breaker(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout
+                )
+
+            return self.breakers[host]
+
+    def get_backoff(self, attempt):
+        """ full jitter, up to retry_backoff * 2 ^ attempt seconds """
+        return random.uniform(0, self.retry_backoff * 2 ** attempt)
+
+    def request(self, method, url, **kwargs):
+        session = self.session
+        host = urlsplit(url).netloc
+        breaker = self.get_breaker(host)
+
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {host}, not requesting {url}")
+
+        kwargs.setdefault("timeout", self.timeout)
+
+        retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+
+        succeeded = False
+
+        # the breaker is always told the outcome, an exception of any kind
+        # counts as a failure so a half open circuit's trial is released
+        try:
+            for attempt in range(retries + 1):
+                last_attempt = attempt == retries
+
+                try:
+                    response = session.request(method, url, **kwargs)
+                except requestslib.exceptions.RequestException as e:
+                    if last_attempt or not isinstance(e, RETRY_EXCEPTIONS):
+                        raise
+
+                    logger.warning(f"{method} {url} failed, retrying: {e}")
+                else:
+                    if response.status_code not in RETRY_STATUSES:
+                        succeeded = True
+                        return response
+
+                    if last_attempt:
+                        return response
+
+                    logger.warning(
+                        f"{method} {url} returned {response.status_code}, retrying"
+                    )
+
+                time.sleep(self.get_backoff(attempt))
+        finally:
+            if succeeded:
+                breaker.success()
+            else:
+                breaker.failure()
+
+    def get_coalesce_key(self, url, kwargs):
+        """
+            @returns the key GETs with these arguments are coalesced on,
+                None if they aren't coalesced
+        """
+        if not self.coalesce or set(kwargs) - {"params", "headers"}:
+            return None
+
+        params = kwargs.get("params", None) or {}
+        headers = kwargs.get("headers", None) or {}
+
+        return (url, tuple(sorted(params.items())), tuple(sorted(headers.items())))
+
+    def get(self, url, **kwargs):
+        key = self.get_coalesce_key(url, kwargs)
+
+        if key is None:
+            return self.request("GET", url, **kwargs)
+
+        if self.coalesce_redis:
+            return self.inflight.do(key, lambda: self.get_shared(key, url, **kwargs))
+
+        return self.inflight.do(key, lambda: self.request("GET", url, **kwargs))
+
+    def get_shared(self, key, url, **kwargs):
+        """
+            GET coalesced across processes. The process that gets the lock
+            makes the request, the others wait for its response.
+        """
+        from .cache import get_redis
+
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        response_key = f"kobo:response:{digest}"
+        lock_timeout = sum(self.timeout) * (self.retries + 1)
+
+        try:
+            r = get_redis()
+            lock = r.lock(f"lock:kobo:{digest}", timeout=lock_timeout)
+            leader = lock.acquire(blocking=False)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Not coalescing {url}: {e}")
+            return self.request("GET", url, **kwargs)
+
+        if leader:
+            try:
+                response = self.request("GET", url, **kwargs)
+
+                if response.status_code == 200:
+                    r.set(
+                        response_key, serialise_response(response), ex=self.coalesce_ttl
+                    )
+
+                return response
+            finally:
+                try:
+                    lock.release()
+                except redis.exceptions.RedisError:
+                    logger.warning(f"Coalescing lock for {url} expired while requesting")
+
+        try:
+            deadline = time.monotonic() + lock_timeout
+
+            while lock.locked() and time.monotonic() < deadline:
+                time.sleep(0.05)
+
+            shared = r.get(response_key)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not read the shared response for {url}: {e}")
+            shared = None
+
+        if shared:
+            logger.debug(f"Coalesced GET {url} with another process")
+            return deserialise_response(shared)
+
+        # the request failed or the lock timed out
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class AsyncKoboClient(KoboClient):
+    """
+        asyncio version of KoboClient for the async views, built on httpx.
+        Each event loop gets its own client holding up to max_connections
+        requests in flight, retries, circuit breakers and coalescing of
+        identical GETs work as they do for KoboClient. GETs are only
+        coalesced within the process.
+    """
+
+    def __init__(self, max_connections=None, **kwargs):
+        super().__init__(**kwargs)
+
+        self.max_connections = max_connections or getattr(
+            settings, "KOBO_ASYNC_MAX_CONNECTIONS", 200
+        )
+        # loop -> (client, async generator that closes it)
+        self._clients = {}
+        # loop -> {coalesce key: request task}
+        self.inflight = weakref.WeakKeyDictionary()
+
+    async def get_client(self):
+        """
+            httpx clients are bound to the loop they were created on. Each
+            loop's client is closed when the loop shuts down its async
+            generators, as asyncio.run and async_to_sync do before closing
+        """
+        if httpx is None:
+            raise Exception("httpx is required for the async kobo client")
+
+        loop = asyncio.get_running_loop()
+
+        if loop not in self._clients:
+            connect_timeout, read_timeout = self.timeout
+
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.pool_size,
+                ),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+            closer = self.close_on_shutdown(loop, client)
+            await closer.__anext__()
+
+            self._clients[loop] = (client, closer)
+
+        return self._clients[loop][0]
+
+    async def close_on_shutdown(self, loop, client):
+        try:
+            yield
+        finally:
+            self._clients.pop(loop, None)
+            await client.aclose()
+
+    async def close(self):
+        _, closer = self._clients.get(asyncio.get_running_loop(), (None, None))
+
+        if closer:
+            await closer.aclose()
+
+    async def request(self, method, url, **kwargs):
+        client = await self.get_client()
+        host = urlsplit(url).netloc
+        breaker = self.get_breaker(host)
+
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {host}, not requesting {url}")
+
+        retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+
+        succeeded = False
+
+        # as KoboClient.request, cancelling the request counts as a failure
+        try:
+            for attempt in range(retries + 1):
+                last_attempt = attempt == retries
+
+                try:
+                    response = await client.request(method, url, **kwargs)
+                except httpx.HTTPError as e:
+                    if last_attempt or not isinstance(e, ASYNC_RETRY_EXCEPTIONS):
+                        raise
+
+                    logger.warning(f"{method} {url} failed, retrying: {e}")
+                else:
+                    if response.status_code not in RETRY_STATUSES:
+                        succeeded = True
+                        return response
+
+                    if last_attempt:
+                        return response
+
+                    logger.warning(
+                        f"{method} {url} returned {response.status_code}, retrying"
+                    )
+
+                await asyncio.sleep(self.get_backoff(attempt))
+        finally:
+            if succeeded:
+                breaker.success()
+            else:
+                breaker.failure()
+
+    async def get(self, url, **kwargs):
+        key = self.get_coalesce_key(url, kwargs)
+
+        if key is None:
+            return await self.request("GET", url, **kwargs)
+
+        inflight = self.inflight.setdefault(asyncio.get_running_loop(), {})
+
+        if key not in inflight:
+            task = asyncio.ensure_future(self.request("GET", url, **kwargs))
+            task.add_done_callback(lambda _: inflight.pop(key, None))
+            inflight[key] = task
+
+        # a cancelled caller doesn't cancel the request for the others
+        return await asyncio.shield(inflight[key])
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+
+kobo = KoboClient()
+
+akobo = AsyncKoboClient()
@@ -0,0 +1,156 @@
+"""
+    Cache metrics. Each process counts cache operations per cache name in
+    memory and adds them to the cache:stats:<name> hashes in redis every
+    CACHE_METRICS_FLUSH seconds, so the totals cover all workers.
+"""
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# outcome of a cache read
+RESULTS = ["local_hit", "hit", "stale", "miss"]
+
+
+class CacheMetrics:
+    """ per process counters, keyed by (cache name, stats field) """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.seconds = collections.Counter()
+        self.flushed = time.monotonic()
+
+    def count(self, name, result, n=1):
+        with self.lock:
+            self.counts[(name, f"get_{result}")] += n
+
+    def observe(self, name, op, seconds):
+        """ records the latency of a get or set of name """
+        bucket = "inf"
+
+        for le in LATENCY_BUCKETS:
+            if seconds <= le:
+                bucket = str(le)
+                break
+
+        with self.lock:
+            self.counts[(name, f"{op}_count")] += 1
+            self.counts[(name, f"{op}_bucket_{bucket}")] += 1
+            self.seconds[(name, f"{op}_seconds")] += seconds
+
+    def due(self):
+        return time.monotonic() - self.flushed >= getattr(
+            settings, "CACHE_METRICS_FLUSH", 10
+        )
+
+    def flush(self, pipe, get_stats_key):
+        """ adds the counters to the stats hashes and resets them """
+        with self.lock:
+            counts, self.counts = self.counts, collections.Counter()
+            seconds, self.seconds = self.seconds, collections.Counter()
+            self.flushed = time.monotonic()
+
+        for (name, field), n in counts.items():
+            pipe.hincrby(get_stats_key(name), field, n)
+
+        for (name, field), n in seconds.items():
+            pipe.hincrbyfloat(get_stats_key(name), field, n)
+
+        return len(counts) + len(seconds)
+
+
+def format_labels(**labels):
+    return ",".join(
+        '{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels.items()
+    )
+
+
+def format_metric(metric_name, metric_type, help_text, samples):
+    """
+        @param samples - [(name suffix, {label: value}, value)]
+        @returns the Prometheus text lines of a metric
+    """
+    lines = [f"# HELP {metric_name} {help_text}", f"# TYPE {metric_name} {metric_type}"]
+
+    for suffix, labels, value in samples:
+        label_set = f"{{{format_labels(**labels)}}}" if labels else ""
+        lines.append(f"{metric_name}{suffix}{label_set} {value}")
+
+    return lines
+
+
+def render_prometheus(stats):
+    """
+        Formats the cache stats ({name: {field: value}}) as Prometheus
+        text exposition
+
+        @returns str
+    """
+    lines = []
+
+    def metric(metric_name, metric_type, help_text, samples):
+        lines.extend(format_metric(metric_name, metric_type, help_text, samples))
+
+    metric(
+        "beatcovid_cache_requests_total",
+        "counter",
+        "Cache reads by result",
+        [
+            ("", {"cache": name, "result": result}, s.get(f"get_{result}", 0))
+            for name, s in stats.items()
+            for result in RESULTS
+        ],
+    )
+
+    for op, description in [("get", "reads"), ("set", "writes")]:
+        samples = []
+
+        for name, s in stats.items():
+            cumulative = 0
+
+            for le in LATENCY_BUCKETS + ["inf"]:
+                cumulative += s.get(f"{op}_bucket_{le}", 0)
+                samples.append(
+                    (
+                        "_bucket",
+                        {"cache": name, "le": "+Inf" if le == "inf" else le},
+                        cumulative,
+                    )
+                )
+
+            samples.append(("_sum", {"cache": name}, s.get(f"{op}_seconds", 0)))
+            samples.append(("_count", {"cache": name}, s.get(f"{op}_count", 0)))
+
+        metric(
+            f"beatcovid_cache_{op}_seconds",
+            "histogram",
+            f"Latency of cache {description}",
+            samples,
+        )
+
+    for field, metric_type, help_text in [
+        ("encoded_bytes", "counter", "Bytes written to redis, after compression"),
+        ("raw_bytes", "counter", "Bytes written to redis, before compression"),
+        ("last_encoded_bytes", "gauge", "Stored size of the last entry written"),
+    ]:
+        metric(
+            f"beatcovid_cache_{field}" + ("_total" if metric_type == "counter" else ""),
+            metric_type,
+            help_text,
+            [("", {"cache": name}, s.get(field, 0)) for name, s in stats.items()],
+        )
+
+    return "\n".join(lines) + "\n"
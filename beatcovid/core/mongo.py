@@ -1,8 +1,69 @@
+import collections
 import os
+import threading
 from urllib.parse import urlparse
 
 from django.conf import settings
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
+
+from .metrics import format_metric
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_collections = {}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """ per process connection pool counters, over all the client's servers """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def count(self, field, n=1):
+        with self.lock:
+            self.counts[field] += n
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.count("pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.count("connections_created")
+        self.count("connections_open")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.count("connections_closed")
+        self.count("connections_open", -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.count("checkouts_failed")
+
+    def connection_checked_out(self, event):
+        self.count("checkouts")
+        self.count("connections_in_use")
+
+    def connection_checked_in(self, event):
+        self.count("connections_in_use", -1)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+pool_metrics = PoolMetrics()
 
 
 def get_mongo_host():
@@ -18,14 +79,47 @@ def get_mongo_host():
 
 
 def get_mongo():
-    mongo_host_connection = get_mongo_host()
+    """
+        The process wide mongo client. Clients aren't fork safe so forked
+        workers make their own, the parent's is left for the parent. The
+        client connects on its first operation.
+    """
+    global _client, _client_pid, _collections, pool_metrics
+
+    if _client_pid != os.getpid():
+        with _client_lock:
+            if _client_pid != os.getpid():
+                # the pool listener is registered with the client
+                pool_metrics = PoolMetrics()
+                _collections = {}
+                _client = MongoClient(
+                    get_mongo_host(),
+                    connect=False,
+                    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+                    connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT,
+                    socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT,
+                    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT,
+                    waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT,
+                    readPreference=settings.MONGO_READ_PREFERENCE,
+                    event_listeners=[pool_metrics],
+                )
+                _client_pid = os.getpid()
+
+    return _client
 
-    mongo_connection = MongoClient(mongo_host_connection)
 
-    return mongo_connection
+def get_mongo_db(collection_name="instances"):
+    """
+        @returns the collection of the MONGO_HOST database, the handle is
+            kept for the process
+    """
+    c = get_mongo()
+    collection = _collections.get(collection_name, None)
 
+    if collection is not None:
+        return collection
 
-def get_mongo_db(collection_name="instances"):
     mongo_host = get_mongo_host()
 
     _parsed = urlparse(mongo_host)
@@ -35,8 +129,6 @@ def get_mongo_db(collection_name="instances"):
 
     db_name = _parsed.path.lstrip("/")
 
-    c = get_mongo()
-
     if not hasattr(c, db_name):
         raise Exception(
             f"Not a valid database for this MONGO host ({mongo_host}): {db_name}"
@@ -49,4 +141,51 @@ def get_mongo_db(collection_name="instances"):
             f"Not a valid collection {collection_name} for database {db_name}"
         )
 
-    return getattr(db, collection_name)
+    collection = getattr(db, collection_name)
+    _collections[collection_name] = collection
+
+    return collection
+
+
+def render_mongo_pool_metrics(stats=None):
+    """
+        Formats this worker's mongo connection pool counters as Prometheus
+        text exposition
+
+        @returns str
+    """
+    if stats is None:
+        stats = pool_metrics.get_stats()
+
+    lines = []
+
+    lines.extend(
+        format_metric(
+            "beatcovid_mongo_connections",
+            "gauge",
+            "Mongo connections of this worker by state",
+            [
+                ("", {"state": state}, stats.get(f"connections_{state}", 0))
+                for state in ["open", "in_use"]
+            ],
+        )
+    )
+    lines.extend(
+        format_metric(
+            "beatcovid_mongo_connection_events_total",
+            "counter",
+            "Mongo connection pool events of this worker",
+            [
+                ("", {"event": event}, stats.get(event, 0))
+                for event in [
+                    "connections_created",
+                    "connections_closed",
+                    "checkouts",
+                    "checkouts_failed",
+                    "pool_cleared",
+                ]
+            ],
+        )
+    )
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,36 @@
+import codecs
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from .renderers import FastJSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONParser(JSONParser):
+    """
+        JSONParser that decodes with orjson, falling back to the stdlib
+        parser when orjson is not installed
+    """
+
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+
+        parser_context = parser_context or {}
+        encoding = parser_context.get("encoding", settings.DEFAULT_CHARSET)
+
+        try:
+            if codecs.lookup(encoding).name == "utf-8":
+                return orjson.loads(stream.read())
+
+            return orjson.loads(codecs.getreader(encoding)(stream).read())
+        except ValueError as exc:
+            raise ParseError("JSON parse error - %s" % str(exc))
@@ -0,0 +1,48 @@
+import logging
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# orjson serialises dicts, lists, str, int, float, UUID and dataclasses
+# itself, everything else (lazy translations, Decimal, QuerySet ..) goes
+# through DRF's encoder. datetimes are passed through as well so they keep
+# DRF's format - millisecond precision and Z for UTC
+_default = JSONEncoder().default
+
+
+def orjson_dumps(data):
+    return orjson.dumps(
+        data,
+        default=_default,
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+    )
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+        JSONRenderer that encodes with orjson. Output matches DRF's compact
+        unicode JSON. Indented output (the browsable API, or an indent
+        parameter in the Accept header) and installs without orjson use
+        the stdlib encoder.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson_dumps(data)
+
+        # same as DRF, these are valid JSON but not valid javascript
+        return ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(
+            b"\xe2\x80\xa9", b"\\u2029"
+        )
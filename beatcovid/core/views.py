@@ -0,0 +1,45 @@
+import functools
+import io
+
+from django.http import HttpResponse, HttpResponseNotAllowed
+
+from .parsers import FastJSONParser
+from .renderers import FastJSONRenderer
+
+
+def async_api_view(http_method_names):
+    """
+        @api_view for async views. DRF can't run coroutines so async views
+        are plain Django views, this checks the method and exempts them
+        from CSRF as @api_view does. Django's decorators wrap views in
+        sync functions so the attribute is set directly.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapped_view(request, *args, **kwargs):
+            if request.method not in http_method_names:
+                return HttpResponseNotAllowed(http_method_names)
+
+            return await view(request, *args, **kwargs)
+
+        wrapped_view.csrf_exempt = True
+
+        return wrapped_view
+
+    return decorator
+
+
+def json_response(data, status=200):
+    """ renders data the way a DRF Response is rendered """
+    return HttpResponse(
+        FastJSONRenderer().render(data), status=status, content_type="application/json"
+    )
+
+
+def parse_json_body(request):
+    """
+        @returns the JSON request body
+        @raises ParseError if the body isn't JSON
+    """
+    return FastJSONParser().parse(io.BytesIO(request.body))
@@ -0,0 +1,242 @@
+"""
+    Translation bundle layout (all integers little endian u32)
+
+    header          magic, version, string count, key count, locale count,
+                    sha1 digest of the translations.json the bundle was built from
+    string index    (offset, length) into the string data for every string
+    keys            string id of every translation key, sorted
+    locales         string id of every locale name
+    labels          string id of the rendered label for every locale x key,
+                    MISSING if the key has no label in that locale
+    string data     utf-8 strings, each stored once
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_MAGIC = b"BCTB"
+BUNDLE_VERSION = 1
+
+MISSING = 0xFFFFFFFF
+
+_header = struct.Struct("<4sIIII20s")
+_string_index = struct.Struct("<II")
+_u32 = struct.Struct("<I")
+
+
+def get_translations_digest(translations_path):
+    with open(translations_path, "rb") as fh:
+        return hashlib.sha1(fh.read()).digest()
+
+
+def write_bundle(bundle_path, label_table, digest):
+    """
+        Writes a label table ({locale: {key: rendered label}}) as a
+        translation bundle. The file is replaced atomically so running
+        workers keep their existing mapping.
+    """
+    strings = []
+    string_ids = {}
+
+    def intern(s):
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s)
+        return string_ids[s]
+
+    locales = sorted(label_table.keys())
+    keys = sorted({k for locale in locales for k in label_table[locale]})
+
+    key_ids = [intern(k) for k in keys]
+    locale_ids = [intern(l) for l in locales]
+    label_ids = []
+
+    for locale in locales:
+        table = label_table[locale]
+        for k in keys:
+            label_ids.append(intern(table[k]) if k in table else MISSING)
+
+    data = []
+    index = []
+    offset = 0
+
+    for s in strings:
+        encoded = s.encode("utf-8")
+        index.append(_string_index.pack(offset, len(encoded)))
+        data.append(encoded)
+        offset += len(encoded)
+
+    def u32s(values):
+        return struct.pack("<{}I".format(len(values)), *values)
+
+    tmp_path = bundle_path + ".tmp"
+
+    with open(tmp_path, "wb") as fh:
+        fh.write(
+            _header.pack(
+                BUNDLE_MAGIC,
+                BUNDLE_VERSION,
+                len(strings),
+                len(keys),
+                len(locales),
+                digest,
+            )
+        )
+        fh.write(b"".join(index))
+        fh.write(u32s(key_ids))
+        fh.write(u32s(locale_ids))
+        fh.write(u32s(label_ids))
+        fh.write(b"".join(data))
+
+    os.replace(tmp_path, bundle_path)
+
+    logger.info(
+        "Wrote translation bundle {} with {} strings for {} keys in {} locales".format(
+            bundle_path, len(strings), len(keys), len(locales)
+        )
+    )
+
+
+class BundleLocale:
+    """ read only view of the labels for one locale in a bundle """
+
+    def __init__(self, bundle, locale_index):
+        self.bundle = bundle
+        self.locale_index = locale_index
+
+    def _label_id(self, key):
+        key_index = self.bundle.key_index.get(key, None)
+
+        if key_index is None:
+            return MISSING
+
+        return self.bundle.label_id(self.locale_index, key_index)
+
+    def __contains__(self, key):
+        return self._label_id(key) != MISSING
+
+    def __getitem__(self, key):
+        label_id = self._label_id(key)
+
+        if label_id == MISSING:
+            raise KeyError(key)
+
+        return self.bundle.string(label_id)
+
+    def get(self, key, default=None):
+        label_id = self._label_id(key)
+
+        if label_id == MISSING:
+            return default
+
+        return self.bundle.string(label_id)
+
+    def keys(self):
+        return [k for k in self.bundle.key_index if k in self]
+
+
+class TranslationBundle:
+    """
+        Memory mapped translation bundle. The mapping is read only and
+        backed by the file so its pages are shared between worker
+        processes.
+    """
+
+    def __init__(self, bundle_path):
+        with open(bundle_path, "rb") as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            self.string_count,
+            self.key_count,
+            self.locale_count,
+            self.digest,
+        ) = _header.unpack_from(self.mm, 0)
+
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            raise Exception(f"{bundle_path} is not a version {BUNDLE_VERSION} bundle")
+
+        self.index_offset = _header.size
+        self.keys_offset = self.index_offset + self.string_count * _string_index.size
+        self.locales_offset = self.keys_offset + self.key_count * _u32.size
+        self.labels_offset = self.locales_offset + self.locale_count * _u32.size
+        self.data_offset = (
+            self.labels_offset + self.locale_count * self.key_count * _u32.size
+        )
+
+        self.key_index = {
+            self.string(self._u32(self.keys_offset, i)): i for i in range(self.key_count)
+        }
+        self.locale_index = {
+            self.string(self._u32(self.locales_offset, i)): i
+            for i in range(self.locale_count)
+        }
+
+    def _u32(self, offset, i):
+        return _u32.unpack_from(self.mm, offset + i * _u32.size)[0]
+
+    def string(self, string_id):
+        offset, length = _string_index.unpack_from(
+            self.mm, self.index_offset + string_id * _string_index.size
+        )
+        start = self.data_offset + offset
+
+        return self.mm[start : start + length].decode("utf-8")
+
+    def label_id(self, locale_index, key_index):
+        return self._u32(self.labels_offset, locale_index * self.key_count + key_index)
+
+    def __contains__(self, locale):
+        return locale in self.locale_index
+
+    def __getitem__(self, locale):
+        return BundleLocale(self, self.locale_index[locale])
+
+    def keys(self):
+        return self.locale_index.keys()
+
+
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+
+def open_bundle(bundle_path, translations_path=None):
+    """
+        Opens (once per process) the bundle at bundle_path. When
+        translations_path is given the bundle is only used if it was built
+        from that file, otherwise None is returned.
+    """
+    with _bundles_lock:
+        if bundle_path in _bundles:
+            return _bundles[bundle_path]
+
+        if not os.path.isfile(bundle_path):
+            return None
+
+        try:
+            bundle = TranslationBundle(bundle_path)
+        except Exception as e:
+            logger.error(
+                "Could not open translation bundle {}: {}".format(bundle_path, e)
+            )
+            return None
+
+        if translations_path and bundle.digest != get_translations_digest(
+            translations_path
+        ):
+            logger.warning(
+                "Translation bundle {} is stale for {}, "
+                "rebuild it with translate_survey".format(bundle_path, translations_path)
+            )
+            return None
+
+        _bundles[bundle_path] = bundle
+
+        return bundle
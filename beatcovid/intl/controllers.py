@@ -14,6 +14,9 @@ from beatcovid.api.controllers import (
     get_formserver_token,
     get_formserver_uri,
 )
+from beatcovid.api.transformers import build_label_table
+
+from .bundle import get_translations_digest, write_bundle
 
 logger = logging.getLogger(__name__)
 
@@ -169,9 +172,30 @@ def schema_messages(l):
     with open(save_path, "w+") as fh:
         json.dump(translations, fh, indent=4)
 
+    write_translation_bundle(save_path)
+
     return None
 
 
+def write_translation_bundle(translations_path):
+    """
+        Renders every label in translations.json and writes them as a
+        memory mappable bundle next to it for the api workers
+    """
+    with open(translations_path) as fh:
+        translations = json.load(fh)
+
+    bundle_path = os.path.join(os.path.dirname(translations_path), "translations.bundle")
+
+    write_bundle(
+        bundle_path,
+        build_label_table(translations),
+        get_translations_digest(translations_path),
+    )
+
+    return bundle_path
+
+
 def get_form_schema(form_name):
     """
         Get the form schema from kobo toolbox
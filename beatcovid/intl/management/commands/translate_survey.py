@@ -2,8 +2,13 @@ import logging
 
 from django.core.management.base import BaseCommand, CommandError
 
+from beatcovid.api.transformers import TRANSLATIONS_PATH
 from beatcovid.core.lokalise import Lokalise
-from beatcovid.intl.controllers import schema_messages, update_survey_keys
+from beatcovid.intl.controllers import (
+    schema_messages,
+    update_survey_keys,
+    write_translation_bundle,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -15,9 +20,20 @@ class Command(BaseCommand):
         parser.add_argument(
             "--dry-run", action="store_true", help="Don't save new translations",
         )
+        parser.add_argument(
+            "--bundle-only",
+            action="store_true",
+            help="Only rebuild the translation bundle from translations.json",
+        )
 
     def handle(self, *args, **options):
         dry_run = options["dry_run"]
+
+        if options["bundle_only"]:
+            bundle_path = write_translation_bundle(TRANSLATIONS_PATH)
+            self.stdout.write(f"Wrote {bundle_path}")
+            return
+
         l = Lokalise()
 
         update_survey_keys(l)
@@ -1,3 +1,50 @@
+import json
+import os
+import shutil
+import tempfile
+
 from django.test import TestCase
 
-# Create your tests here.
+from beatcovid.api.transformers import TRANSLATIONS_PATH, build_label_table
+from beatcovid.intl.bundle import (
+    TranslationBundle,
+    get_translations_digest,
+    open_bundle,
+    write_bundle,
+)
+
+
+class TranslationBundleTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bundle_path = os.path.join(self.tmp_dir, "translations.bundle")
+
+        with open(TRANSLATIONS_PATH) as fh:
+            self.label_table = build_label_table(json.load(fh))
+
+        write_bundle(
+            self.bundle_path, self.label_table, get_translations_digest(TRANSLATIONS_PATH)
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bundle_matches_label_table(self):
+        bundle = TranslationBundle(self.bundle_path)
+
+        self.assertEqual(set(bundle.keys()), set(self.label_table.keys()))
+
+        for locale, labels in self.label_table.items():
+            for key, label in labels.items():
+                self.assertEqual(bundle[locale][key], label)
+
+        self.assertNotIn("not.a.key", bundle["en"])
+        self.assertIsNone(bundle["en"].get("not.a.key"))
+
+    def test_stale_bundle_not_used(self):
+        translations_path = os.path.join(self.tmp_dir, "translations.json")
+
+        with open(translations_path, "w") as fh:
+            json.dump({"en": {}}, fh)
+
+        self.assertIsNone(open_bundle(self.bundle_path, translations_path))
@@ -1,6 +1,7 @@
 import logging
 import os
 
+import django
 import sentry_sdk
 from dotenv import load_dotenv
 from sentry_sdk.integrations.django import DjangoIntegration
@@ -161,12 +162,71 @@ RESPONDENT_COUNT_BASE = env("RESPONDENT_COUNT_BASE", default=0)
 # HTTP connection settings
 HTTP_CONNECTION_POOLING = env("HTTP_CONNECTION_POOLING", default=False)
 
+# kobo client, connections kept per host should cover a worker's threads
+KOBO_POOL_SIZE = env.int("KOBO_POOL_SIZE", default=10)
+KOBO_CONNECT_TIMEOUT = env.float("KOBO_CONNECT_TIMEOUT", default=3.05)
+KOBO_READ_TIMEOUT = env.float("KOBO_READ_TIMEOUT", default=15)
+# retries of GET requests and the backoff base in seconds
+KOBO_RETRIES = env.int("KOBO_RETRIES", default=2)
+KOBO_RETRY_BACKOFF = env.float("KOBO_RETRY_BACKOFF", default=0.25)
+# failed requests before a host's circuit opens and seconds it stays open
+KOBO_CIRCUIT_FAILURES = env.int("KOBO_CIRCUIT_FAILURES", default=5)
+KOBO_CIRCUIT_RESET = env.int("KOBO_CIRCUIT_RESET", default=30)
+# threads per process for making independent kobo requests at once
+KOBO_FANOUT_WORKERS = env.int("KOBO_FANOUT_WORKERS", default=10)
+# requests the async client keeps in flight per process
+KOBO_ASYNC_MAX_CONNECTIONS = env.int("KOBO_ASYNC_MAX_CONNECTIONS", default=200)
+# identical concurrent GETs share one request, with KOBO_COALESCE_REDIS
+# across processes too. The shared response is kept for KOBO_COALESCE_TTL
+# seconds for the processes waiting on it
+KOBO_COALESCE = env.bool("KOBO_COALESCE", default=True)
+KOBO_COALESCE_REDIS = env.bool("KOBO_COALESCE_REDIS", default=False)
+KOBO_COALESCE_TTL = env.int("KOBO_COALESCE_TTL", default=5)
+
+# serve the form, submission and tracker endpoints from the async views,
+# Django runs async views from 3.1. Only for the ASGI (daphne) deployment,
+# WSGI workers would run each async view in a new event loop
+ASYNC_VIEWS = env.bool("ASYNC_VIEWS", default=False) and django.VERSION >= (3, 1)
+
+# submissions are saved and acknowledged, then forwarded to kobocat by
+# the huey workers, which must be running (manage.py run_huey). Off sends
+# them to kobocat while the client waits
+SUBMISSION_QUEUE = env.bool("SUBMISSION_QUEUE", default=False)
+# huey priority of the forwarding tasks, higher runs first
+SUBMISSION_PRIORITY = env.int("SUBMISSION_PRIORITY", default=100)
+SUBMISSION_BATCH_SIZE = env.int("SUBMISSION_BATCH_SIZE", default=50)
+# seconds a worker has to send a batch before others may take it over
+SUBMISSION_LEASE = env.int("SUBMISSION_LEASE", default=300)
+# failed sends back off from SUBMISSION_RETRY_BACKOFF seconds doubling up
+# to SUBMISSION_RETRY_MAX, and are given up after SUBMISSION_MAX_ATTEMPTS
+SUBMISSION_RETRY_BACKOFF = env.int("SUBMISSION_RETRY_BACKOFF", default=30)
+SUBMISSION_RETRY_MAX = env.int("SUBMISSION_RETRY_MAX", default=3600)
+SUBMISSION_MAX_ATTEMPTS = env.int("SUBMISSION_MAX_ATTEMPTS", default=10)
+# days forwarded submissions are kept before they are purged
+SUBMISSION_RETENTION_DAYS = env.int("SUBMISSION_RETENTION_DAYS", default=7)
+
+# select lists loaded from the database rather than the form choices,
+# languages and/or countries
+EXTERNS = env.list("EXTERNS", default=["languages"])
+
+# how often the scheduler polls the form server for changed forms
+SCHEMA_REFRESH_MINUTES = env.int("SCHEMA_REFRESH_MINUTES", default=5)
+
 # auth methods
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework.authentication.BasicAuthentication",
         "rest_framework.authentication.SessionAuthentication",
-    ]
+    ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "beatcovid.core.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "beatcovid.core.parsers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
 }
 
 # session cookie settings
@@ -214,9 +274,51 @@ COUNTRIES_FIRST = ["AU", "NZ"]
 # redis
 REDIS_HOST = env("REDIS_HOST", default="127.0.0.6")
 REDIS_URL = env("REDIS_URL", default="redis://127.0.0.10:6379/")
+REDIS_MAX_CONNECTIONS = env.int("REDIS_MAX_CONNECTIONS", default=50)
+REDIS_SOCKET_TIMEOUT = env.float("REDIS_SOCKET_TIMEOUT", default=5.0)
+
+# in process cache in front of redis, seconds an entry is kept (0 disables)
+CACHE_L1_TTL = env.int("CACHE_L1_TTL", default=60)
+CACHE_L1_MAX_BYTES = env.int("CACHE_L1_MAX_BYTES", default=16 * 1024 * 1024)
+
+# minutes cache entries are fresh for, by cache name
+CACHE_TTLS = {
+    "get_form_index": 15,
+    "get_form_schema": 15,
+    "get_survey_user_count": 5,
+}
+# minutes an expired entry is kept to be served while one worker recomputes it
+CACHE_STALE_TTL = env.int("CACHE_STALE_TTL", default=60)
+# seconds a worker may hold the lock to recompute an entry
+CACHE_LOCK_TIMEOUT = env.int("CACHE_LOCK_TIMEOUT", default=30)
+# json or msgpack, empty for msgpack if it is installed and json if not.
+# pickle lets anyone who can write to redis run code in the workers, it is
+# only read when set here
+CACHE_CODEC = env("CACHE_CODEC", default="")
+# zlib, lz4 (if installed) or empty for none, used for values of at least
+# CACHE_COMPRESS_MIN_BYTES
+CACHE_COMPRESSION = env("CACHE_COMPRESSION", default="zlib")
+CACHE_COMPRESS_MIN_BYTES = env.int("CACHE_COMPRESS_MIN_BYTES", default=4096)
+# seconds between each worker adding its cache metrics to the totals in redis
+CACHE_METRICS_FLUSH = env.int("CACHE_METRICS_FLUSH", default=10)
 
 # mongo
 MONGO_HOST = env("MONGO_HOST", default="mongodb://127.0.0.1/")
+# connections each worker's client keeps to each mongo server
+MONGO_MAX_POOL_SIZE = env.int("MONGO_MAX_POOL_SIZE", default=50)
+MONGO_MIN_POOL_SIZE = env.int("MONGO_MIN_POOL_SIZE", default=0)
+# milliseconds to connect, for a reply, to find a server and to wait for
+# a free connection when the pool is full
+MONGO_CONNECT_TIMEOUT = env.int("MONGO_CONNECT_TIMEOUT", default=5000)
+MONGO_SOCKET_TIMEOUT = env.int("MONGO_SOCKET_TIMEOUT", default=30000)
+MONGO_SERVER_SELECTION_TIMEOUT = env.int("MONGO_SERVER_SELECTION_TIMEOUT", default=5000)
+MONGO_WAIT_QUEUE_TIMEOUT = env.int("MONGO_WAIT_QUEUE_TIMEOUT", default=5000)
+# primary, primaryPreferred, secondary, secondaryPreferred or nearest,
+# anything but primary may read submissions a secondary hasn't caught up on
+MONGO_READ_PREFERENCE = env("MONGO_READ_PREFERENCE", default="primary")
+# read submission queries from kobocat's mongo instances collection
+# rather than its data API
+SUBMISSIONS_FROM_MONGO = env.bool("SUBMISSIONS_FROM_MONGO", default=False)
 
 from ..scheduler import scheduler  # isort:skip pylint: disable=wrong-import-position
 
@@ -1,19 +1,25 @@
+import asyncio
 import json
 import logging
 import os
 import re
 import sys
 
+from asgiref.sync import sync_to_async
 from django.utils import dateparse
 from django.utils.translation import ugettext_lazy as _
 
 from beatcovid.api.controllers import (
-    get_form_schema,
+    build_form_schema,
+    get_kobo_form_schema,
     get_submission_data,
     get_survey_user_count,
     get_user_last_submission,
     get_user_submissions,
+    get_user_submissions_async,
+    pick_last_submission,
 )
+from beatcovid.core.concurrency import run_concurrently
 
 logger = logging.getLogger(__name__)
 
@@ -200,13 +206,41 @@ def cast_strings_to_bool(tag):
 
 
 def get_user_report(user, request):
-    surveys = get_user_submissions("beatcovid19now", user)
-    schema = get_form_schema("beatcovid19now", request, user)
+    """
+        The user's submissions, the form asset and the participant count
+        are fetched concurrently. The schema is built with the last of
+        the user's submissions rather than fetching it again.
+    """
+    surveys, kobo_schema, user_count = run_concurrently(
+        lambda: get_user_submissions("beatcovid19now", user),
+        lambda: get_kobo_form_schema("beatcovid19now"),
+        get_survey_user_count,
+    )
+
+    return build_user_report(surveys, kobo_schema, user_count, request, user)
+
+
+async def get_user_report_async(user, request):
+    """ get_user_report for the async views """
+    surveys, kobo_schema, user_count = await asyncio.gather(
+        get_user_submissions_async("beatcovid19now", user),
+        sync_to_async(get_kobo_form_schema, thread_sensitive=False)("beatcovid19now"),
+        sync_to_async(get_survey_user_count, thread_sensitive=False)(),
+    )
 
-    if surveys and type(surveys) is list:
-        return get_user_report_from_survey(surveys, schema)
+    return await sync_to_async(build_user_report, thread_sensitive=True)(
+        surveys, kobo_schema, user_count, request, user
+    )
+
+
+def build_user_report(surveys, kobo_schema, user_count, request, user):
+    if not surveys or type(surveys) is not list:
+        return None
 
-    return None
+    # surveys are newest first, as the last submission query sorts them
+    schema = build_form_schema(kobo_schema, request, user, pick_last_submission(surveys))
+
+    return get_user_report_from_survey(surveys, schema, user_count)
 
 
 def parse_survey(survey):
@@ -382,7 +416,7 @@ def pick_field(field_name, surveys):
     return list(field_values)
 
 
-def get_user_report_from_survey(surveys, schema=None):
+def get_user_report_from_survey(surveys, schema=None, user_count=None):
     survey_most_recent = surveys[0]
     _parsed_survey_most_recent = parse_survey(survey_most_recent)
 
@@ -470,6 +504,9 @@ def get_user_report_from_survey(surveys, schema=None):
 
         _scores.append(_score)
 
+    if user_count is None:
+        user_count = get_survey_user_count()
+
     report = {
         "id": survey_most_recent["_id"],
         "uuid": survey_most_recent["_uuid"],
@@ -483,8 +520,8 @@ def get_user_report_from_survey(surveys, schema=None):
         if "end" in survey_most_recent
         else None,
         "app_version": "1.1.0",
-        "total_participants": get_survey_user_count(),
-        "respondents_total": get_survey_user_count(),
+        "total_participants": user_count,
+        "respondents_total": user_count,
         "dates": dates,
         "scores": _scores,
     }
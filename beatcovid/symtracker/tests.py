@@ -1,11 +1,20 @@
 import json
 import logging
 import os
+import threading
 from pprint import pprint
+from unittest import mock
 
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
 
-from beatcovid.symtracker.controllers import get_user_report_from_survey
+from beatcovid.api import controllers
+from beatcovid.api.benchmarks import (
+    load_asset_fixture,
+    load_submissions_fixture,
+    stub_kobo,
+)
+from beatcovid.respondent.models import Respondent
+from beatcovid.symtracker.controllers import get_user_report, get_user_report_from_survey
 
 BASE_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
 
@@ -50,3 +59,40 @@ class SymptomTrackerSingleEntryTestCase(TestCase):
         pprint(report)
         # for f in fixture
         # self.assertEqual(f, "f.value")
+
+
+class UserReportTestCase(TestCase):
+    def test_report_fetches_concurrently(self):
+        asset = load_asset_fixture()
+        submissions = load_submissions_fixture()
+
+        for n, survey in enumerate(submissions):
+            survey.setdefault("_id", n)
+            survey.setdefault("_uuid", f"benchmark-{n}")
+
+        request = RequestFactory().get("/")
+        request.LANGUAGE_CODE = "en"
+        user = Respondent()
+        fetches = []
+
+        with stub_kobo(asset, submissions):
+            stub_get = controllers.kobo.get
+
+            def get(url, **kwargs):
+                fetches.append((url, threading.current_thread()))
+                return stub_get(url, **kwargs)
+
+            with mock.patch.object(controllers.kobo, "get", side_effect=get):
+                report = get_user_report(user, request)
+
+        data_fetches = [
+            t for url, t in fetches if "/api/v1/data/" in url and "count" not in url
+        ]
+        asset_fetches = [t for url, t in fetches if url.endswith(asset["uid"])]
+
+        # the last submission comes from the submissions already fetched
+        self.assertEqual(len(data_fetches), 1)
+        self.assertEqual(len(asset_fetches), 1)
+        self.assertIsNot(data_fetches[0], asset_fetches[0])
+
+        self.assertIn(report["id"], [s["_id"] for s in submissions])
@@ -4,6 +4,7 @@ import logging
 import re
 import uuid
 
+from asgiref.sync import sync_to_async
 from django.http import Http404, HttpResponseBadRequest
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
@@ -11,9 +12,10 @@ from rest_framework import generics, permissions, status, viewsets
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from beatcovid.core.views import async_api_view, json_response
 from beatcovid.respondent.controllers import get_user_from_request
 
-from .controllers import get_user_report
+from .controllers import get_user_report, get_user_report_async
 
 
 @api_view(["GET"])
@@ -32,3 +34,21 @@ def SymptomTracker(request):
     r["access-control-allow-credentials"] = "true"
 
     return r
+
+
+@async_api_view(["GET"])
+async def SymptomTrackerAsync(request):
+    user = await sync_to_async(get_user_from_request, thread_sensitive=True)(request)
+
+    if not user.id:
+        raise Http404
+
+    result = await get_user_report_async(user, request)
+
+    if not result:
+        raise Http404
+
+    r = json_response(result)
+    r["access-control-allow-credentials"] = "true"
+
+    return r
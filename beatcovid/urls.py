@@ -8,10 +8,16 @@ from django.views.generic.base import RedirectView
 from beatcovid.api.views import (
     FormData,
     FormSchema,
+    FormSchemaAsync,
+    FormSchemaStatic,
+    FormSchemaUser,
     FormStats,
     FormSubmission,
+    FormSubmissionAsync,
+    Metrics,
     TranslationTest,
     UserSubmissionView,
+    UserSubmissionViewAsync,
 )
 from beatcovid.respondent.views import (
     GetUID,
@@ -19,7 +25,7 @@ from beatcovid.respondent.views import (
     UserDetailView,
     UserImportSession,
 )
-from beatcovid.symtracker.views import SymptomTracker
+from beatcovid.symtracker.views import SymptomTracker, SymptomTrackerAsync
 
 admin.site.site_header = "beatcovid19 Admin"
 admin.site.site_title = "beatcovid19 Admin"
@@ -28,15 +34,35 @@ admin.site.index_title = "beatcovid19 Admin"
 favicon_view = RedirectView.as_view(url="/staticfiles/favicon.ico", permanent=True)
 
 urlpatterns = [
-    path("api/form/schema/<str:form_name>/", (FormSchema)),
+    path(
+        "api/form/schema/<str:form_name>/",
+        FormSchemaAsync if settings.ASYNC_VIEWS else FormSchema,
+    ),
+    path("api/form/schema/<str:form_name>/static/", FormSchemaStatic),
+    path(
+        "api/form/schema/<str:form_name>/static/<str:version>/<str:locale>/",
+        FormSchemaStatic,
+        name="form-schema-static",
+    ),
+    path("api/form/schema/<str:form_name>/user/", FormSchemaUser),
     path("api/form/stats/<str:form_name>/", (FormStats)),
-    path("api/form/submit/<str:form_name>/", FormSubmission),
+    path(
+        "api/form/submit/<str:form_name>/",
+        FormSubmissionAsync if settings.ASYNC_VIEWS else FormSubmission,
+    ),
     path("api/form/data/<str:form_name>/", FormData),
-    path("api/tracker/", SymptomTracker),
-    path("api/user/submissions/<str:form_name>/", UserSubmissionView),
-    path("api/user/submissions/", UserSubmissionView),
+    path("api/tracker/", SymptomTrackerAsync if settings.ASYNC_VIEWS else SymptomTracker),
+    path(
+        "api/user/submissions/<str:form_name>/",
+        UserSubmissionViewAsync if settings.ASYNC_VIEWS else UserSubmissionView,
+    ),
+    path(
+        "api/user/submissions/",
+        UserSubmissionViewAsync if settings.ASYNC_VIEWS else UserSubmissionView,
+    ),
     path("api/user/", UserDetailView),
     path("api/admin/import/", UserImportSession),
+    path("api/admin/metrics/", Metrics),
     path("api/transfer/request/", TransferRequest.as_view()),
     path("api/transfer/getUID/", GetUID.as_view()),
     path("api/translate/", TranslationTest),